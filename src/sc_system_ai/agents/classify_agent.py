@@ -1,4 +1,4 @@
-from collections.abc import AsyncIterator
+import asyncio
 from typing import cast
 
 from langchain_openai import AzureChatOpenAI
@@ -13,9 +13,9 @@ from sc_system_ai.agents.tools.calling_agent_tools.calling_search_school_data_ag
 
 # from sc_system_ai.agents.tools import magic_function
 from sc_system_ai.agents.tools.classify_role import classify_role
-from sc_system_ai.template.agent import Agent, AgentResponse, StreamingAgentResponse
+from sc_system_ai.template.agent import Agent, AgentResponse
 from sc_system_ai.template.ai_settings import llm
-from sc_system_ai.template.calling_agent import CallingAgent
+from sc_system_ai.template.calling_agent import CallingAgent, create_session_tools
 from sc_system_ai.template.user_prompts import User
 
 classify_agent_tools = [
@@ -53,21 +53,38 @@ class ClassifyAgent(Agent):
         self.set_tools(classify_agent_tools)
 
     def set_tools(self, tools: list) -> None:
-        # エージェント呼び出しツールにユーザー情報を設定
-        for tool in tools:
+        # エージェント呼び出しツールはセッションごとのインスタンスを作成して設定
+        super().set_tools(create_session_tools(tools, self.user_info))
+
+    def set_user_info(self, user_info: User) -> None:
+        # エージェント呼び出しツールも新しいユーザーのセッションで作成し直す
+        self.tool.tools = create_session_tools(self.tool.tools, user_info)
+        super().set_user_info(user_info)
+
+    def setup_streaming(self, queue: asyncio.Queue[str | None]) -> None:
+        # 呼び出したエージェントのトークンも同じキューに送る
+        super().setup_streaming(queue)
+        for tool in self.tool.tools:
             if isinstance(tool, CallingAgent):
-                tool.set_user_info(self.user_info)
-        super().set_tools(tools)
+                tool.setup_streaming(queue)
 
-    def invoke(self, message: str) -> AgentResponse:
-        # toolの出力がAgentReaponseで返って来るので整形
+    def cancel_streaming(self) -> None:
+        super().cancel_streaming()
         for tool in self.tool.tools:
             if isinstance(tool, CallingAgent):
                 tool.cancel_streaming()
+
+    def invoke(self, message: str) -> AgentResponse:
+        # toolの出力がAgentReaponseで返って来るので整形
         resp = super().invoke(message)
         resp.document_id = self._doc_id_checker()
         return resp
 
+    async def ainvoke(self, message: str) -> AgentResponse:
+        resp = await super().ainvoke(message)
+        resp.document_id = self._doc_id_checker()
+        return resp
+
     def _doc_id_checker(self) -> list[int] | None:
         """
         ソースIDが存在するか確認する
@@ -78,13 +95,6 @@ class ClassifyAgent(Agent):
                     return list(tool.source_id)
         return None
 
-    async def stream(self, message: str, return_length: int = 5) -> AsyncIterator[StreamingAgentResponse]:
-        for tool in self.tool.tools:
-            if isinstance(tool, CallingAgent):
-                tool.setup_streaming(self.queue)
-        async for output in super().stream(message, return_length):
-            yield output
-
 
 if __name__ == "__main__":
     from sc_system_ai.logging_config import setup_logging
@@ -1,11 +1,27 @@
-from collections.abc import AsyncIterator
+import time
+from collections.abc import AsyncGenerator
+from contextlib import aclosing
+from typing import cast
 
+from langchain_core.documents import Document
 from langchain_openai import AzureChatOpenAI
 
 # from sc_system_ai.agents.tools import magic_function
-from sc_system_ai.agents.tools.search_school_data import genarate_search_word, search_school_database_cosmos
+from sc_system_ai.agents.tools.search_school_data import (
+    SearchStrategy,
+    agenarate_search_word,
+    asearch_school_database_with_score,
+    aspeculative_search,
+    genarate_search_word,
+    search_school_database_with_score,
+    speculative_search,
+)
 from sc_system_ai.template.agent import Agent, AgentResponse, StreamingAgentResponse
 from sc_system_ai.template.ai_settings import llm
+from sc_system_ai.template.context_assembly import AssembledContext, ContextPolicy, assemble_context
+from sc_system_ai.template.flush_policy import FlushPolicy
+from sc_system_ai.template.mmr import MMRPolicy
+from sc_system_ai.template.semantic_cache import CachedAnswer, SemanticAnswerCache, get_answer_cache
 from sc_system_ai.template.user_prompts import User
 
 # search_school_data_agent_tools = [
@@ -23,40 +39,198 @@ search_school_data_agent_info = """あなたの役割は学校の情報をもと
 # agentクラスの作成
 
 class SearchSchoolDataAgent(Agent):
+    """
+    学校の情報を検索し、ユーザーの質問に回答するエージェント
+
+    Args:
+        llm (AzureChatOpenAI, optional): 使用するモデル. Defaults to llm.
+        user_info (User | None, optional): ユーザー情報. Defaults to None.
+        answer_cache (SemanticAnswerCache | None, optional): 回答のキャッシュ.
+            Defaults to 既定のキャッシュ(環境変数で有効にした場合のみ).
+        search_strategy (SearchStrategy, optional): 学校の情報の検索方法.
+            `hybrid`の場合は語句の一致(BM25)とベクトル検索を組み合わせる.
+            `multi`の場合は検索ワードの語ごとに並行して検索する. Defaults to "vector".
+        speculative_search (bool, optional): 検索ワードの生成と並行して、メッセージそのもので検索するか.
+            Defaults to False.
+        speculative_accept_score (float | None, optional): メッセージによる検索のスコアがこの値以上の場合は、
+            検索ワードの生成を待たずにその結果を使用する. Defaults to None.
+        context_policy (ContextPolicy | None, optional): 検索結果からプロンプトに含める情報を組み立てる設定.
+            Defaults to ContextPolicy().
+        mmr (MMRPolicy | None, optional): ベクトル検索の候補からMMRで内容の重複が少ない結果を選ぶ設定.
+            Noneの場合は類似度の上位を使用する. Defaults to None.
+
+    直前の検索の段階ごとの時間(秒)は`search_timings`に、組み立てた情報は`context`に記録します。
+
+    類似する質問の回答がキャッシュにある場合は、検索と回答の生成を行わずにキャッシュした回答を返します。
+    回答はユーザー情報で個別化されるため、名前と専攻が同じユーザーの回答のみを再利用します。
+    会話履歴がある場合は回答が履歴に依存するため、キャッシュを使用しません。
+    """
     def __init__(
             self,
             llm: AzureChatOpenAI = llm,
             user_info: User | None = None,
+            answer_cache: SemanticAnswerCache | None = None,
+            search_strategy: SearchStrategy = "vector",
+            speculative_search: bool = False,
+            speculative_accept_score: float | None = None,
+            context_policy: ContextPolicy | None = None,
+            mmr: MMRPolicy | None = None,
     ):
         super().__init__(
             llm=llm,
             user_info=user_info if user_info is not None else User(),
         )
         self.assistant_info = search_school_data_agent_info
+        self.answer_cache = answer_cache if answer_cache is not None else get_answer_cache()
+        self.search_strategy = search_strategy
+        self.speculative_search = speculative_search
+        self.speculative_accept_score = speculative_accept_score
+        self.context_policy = context_policy if context_policy is not None else ContextPolicy()
+        self.mmr = mmr
+        self.search_timings: dict[str, float] = {}
+        self.context = AssembledContext()
+
+    def set_user_info(self, user_info: User) -> None:
+        # 前のユーザーの検索結果を破棄する
+        self.assistant_info = search_school_data_agent_info
+        self.context = AssembledContext()
+        self.search_timings = {}
+        self.prompt_template.create_prompt(assistant_info="")
+        super().set_user_info(user_info)
 
     def _add_search_result(self, message: str) -> list[int]:
+        if self.speculative_search:
+            result = speculative_search(
+                message, self.context_policy.fetch_k, self.search_strategy, self.speculative_accept_score, self.mmr
+            )
+            self.search_timings = result.timings
+            return self._set_search_result(list(zip(result.documents, result.scores, strict=True)))
+
+        start = time.perf_counter()
         word = genarate_search_word(message)
-        search = search_school_database_cosmos(word)
-        ids = []
-        for doc in search:
-            self.assistant_info += f"### {doc.metadata['title']}\n" + doc.page_content + "\n"
-            if "source_id" in doc.metadata:
-                ids.append(doc.metadata["source_id"])
+        generated = time.perf_counter()
+        search = search_school_database_with_score(
+            word, self.context_policy.fetch_k, self.search_strategy, self.mmr
+        )
+        self._record_timings(start, generated)
+        return self._set_search_result(search)
+
+    async def _aadd_search_result(self, message: str) -> list[int]:
+        if self.speculative_search:
+            result = await aspeculative_search(
+                message, self.context_policy.fetch_k, self.search_strategy, self.speculative_accept_score, self.mmr
+            )
+            self.search_timings = result.timings
+            return self._set_search_result(list(zip(result.documents, result.scores, strict=True)))
+
+        start = time.perf_counter()
+        word = await agenarate_search_word(message)
+        generated = time.perf_counter()
+        search = await asearch_school_database_with_score(
+            word, self.context_policy.fetch_k, self.search_strategy, self.mmr
+        )
+        self._record_timings(start, generated)
+        return self._set_search_result(search)
+
+    def _record_timings(self, start: float, generated: float) -> None:
+        """検索ワードの生成と検索の時間を記録する関数"""
+        end = time.perf_counter()
+        self.search_timings = {
+            "search_word": generated - start,
+            "word_search": end - generated,
+            "total": end - start,
+        }
+
+    def _set_search_result(self, search: list[tuple[Document, float | None]]) -> list[int]:
+        # 前回の検索結果を引き継がないよう、毎回元のプロンプトから作り直す
+        self.context = assemble_context(search, self.context_policy)
+        self.assistant_info = search_school_data_agent_info + self.context.text
         super().set_assistant_info(self.assistant_info)
-        return ids
+        return self.context.source_ids
+
+    def _cache_scope(self) -> str | None:
+        """回答のキャッシュのscopeを返す関数。キャッシュを使用しない場合はNoneを返す"""
+        if self.answer_cache is None or self.user_info.conversations.conversations:
+            return None
+        return f"{self.user_info.name}\n{self.user_info.major}"
+
+    def _lookup(self, message: str, scope: str | None) -> CachedAnswer | None:
+        if scope is None:
+            return None
+        return cast(SemanticAnswerCache, self.answer_cache).lookup(message, scope)
+
+    async def _alookup(self, message: str, scope: str | None) -> CachedAnswer | None:
+        if scope is None:
+            return None
+        return await cast(SemanticAnswerCache, self.answer_cache).alookup(message, scope)
+
+    def _store(self, message: str, resp: AgentResponse, scope: str | None) -> None:
+        """回答をキャッシュに保存する関数。エラーの場合やキャッシュを使用しない場合は保存しない"""
+        if scope is not None and resp.error is None and resp.output:
+            cast(SemanticAnswerCache, self.answer_cache).store(message, resp.output, resp.document_id, scope)
+
+    async def _astore(self, message: str, resp: AgentResponse, scope: str | None) -> None:
+        if scope is not None and resp.error is None and resp.output:
+            await cast(SemanticAnswerCache, self.answer_cache).astore(message, resp.output, resp.document_id, scope)
 
     def invoke(self, message: str) -> AgentResponse:
-        # Agentクラスのストリーミングを改修後にストリーミング実装
+        scope = self._cache_scope()
+        if (hit := self._lookup(message, scope)) is not None:
+            self.result = AgentResponse(output=hit.answer, document_id=hit.document_id)
+            return self.result
         ids = self._add_search_result(message)
         resp = super().invoke(message)
         resp.document_id = ids
+        self._store(message, resp, scope)
         return resp
 
-    async def stream(self, message: str, return_length: int = 5) -> AsyncIterator[StreamingAgentResponse]:
-        ids = self._add_search_result(message)
-        async for resp in super().stream(message, return_length):
-            yield resp
+    async def ainvoke(self, message: str) -> AgentResponse:
+        scope = self._cache_scope()
+        if (hit := await self._alookup(message, scope)) is not None:
+            self.result = AgentResponse(output=hit.answer, document_id=hit.document_id)
+            return self.result
+        ids = await self._aadd_search_result(message)
+        resp = await super().ainvoke(message)
+        resp.document_id = ids
+        await self._astore(message, resp, scope)
+        return resp
+
+    async def stream(
+        self,
+        message: str,
+        return_length: int = 5,
+        flush_policy: FlushPolicy | None = None,
+    ) -> AsyncGenerator[StreamingAgentResponse, None]:
+        scope = self._cache_scope()
+        if (hit := await self._alookup(message, scope)) is not None:
+            # キャッシュした回答をストリーミングと同じ形式で返す
+            replay = self.replay_stream(hit.answer, return_length, flush_policy, hit.document_id)
+            async with aclosing(replay) as stream:
+                async for resp in stream:
+                    yield resp
+            return
+
+        ids = await self._aadd_search_result(message)
+        async with aclosing(super().stream(message, return_length, flush_policy)) as stream:
+            async for resp in stream:
+                yield resp
+        self.result.document_id = ids
+        await self._astore(message, self.result, scope)
+
+    async def stream_on_tool(self, message: str) -> None:
+        scope = self._cache_scope()
+        if (hit := await self._alookup(message, scope)) is not None:
+            # 呼び出し元のキューにキャッシュした回答を一文字ずつ送る
+            self.setup_streaming(self.queue)
+            for char in hit.answer:
+                self.handler.on_llm_new_token(char)
+            self.result = AgentResponse(output=hit.answer, document_id=hit.document_id)
+            return
+
+        ids = await self._aadd_search_result(message)
+        await super().stream_on_tool(message)
         self.result.document_id = ids
+        await self._astore(message, self.result, scope)
 
 if __name__ == "__main__":
     from sc_system_ai.logging_config import setup_logging
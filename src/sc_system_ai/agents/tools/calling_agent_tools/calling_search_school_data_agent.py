@@ -1,8 +1,12 @@
 # dummyAgentの呼び出しを行うツール
 
 import logging
+from typing import Any
+
+from pydantic import Field
 
 from sc_system_ai.agents.search_school_data_agent import SearchSchoolDataAgent
+from sc_system_ai.template.agent import AgentResponse
 from sc_system_ai.template.calling_agent import CallingAgent
 from sc_system_ai.template.user_prompts import User
 
@@ -11,7 +15,7 @@ logger = logging.getLogger(__name__)
 
 class CallingSearchSchoolDataAgent(CallingAgent):
     # tool側でidを保持する
-    source_id: set[int] = set()
+    source_id: set[int] = Field(default_factory=set)
 
     def __init__(self) -> None:
         super().__init__()
@@ -21,12 +25,15 @@ class CallingSearchSchoolDataAgent(CallingAgent):
             agent=SearchSchoolDataAgent
         )
 
-    def _run(self, user_input: str) -> str:
-        resp = super()._run(user_input)
+    def _session_state(self, user_info: User) -> dict[str, Any]:
+        return {**super()._session_state(user_info), "source_id": set()}
+
+    def _handle_response(self, resp: AgentResponse) -> str:
+        output = super()._handle_response(resp)
         if self.response.document_id is not None:
             for _id in self.response.document_id:
                 self.source_id.add(_id)
-        return resp
+        return output
 
 calling_search_school_data_agent = CallingSearchSchoolDataAgent()
 
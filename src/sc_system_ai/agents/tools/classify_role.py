@@ -6,6 +6,7 @@ from langchain_openai import AzureChatOpenAI
 from pydantic import BaseModel, Field
 
 from sc_system_ai.template.ai_settings import llm
+from sc_system_ai.template.structured_output_cache import invoke_structured_output
 
 logger = logging.getLogger(__name__)
 
@@ -39,8 +40,7 @@ def keyword_similarity(
     リスト:
     [{",".join(keywords)}]
     """
-    model = llm.with_structured_output(Output)
-    result = model.invoke(requiremments_prompt)
+    result = invoke_structured_output(llm, Output, requiremments_prompt, call_site="keyword_similarity")
 
     if isinstance(result, Output):
         logger.info(f"類似度スコア: {result.similarity_score}")
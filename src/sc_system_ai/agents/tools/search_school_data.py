@@ -1,5 +1,10 @@
+import asyncio
 import logging
 import os
+import time
+from collections.abc import Awaitable, Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Literal, TypeVar
 
 from dotenv import load_dotenv
 from langchain_community.retrievers import AzureAISearchRetriever
@@ -8,7 +13,12 @@ from langchain_core.tools import BaseTool
 from pydantic import BaseModel, Field
 
 from sc_system_ai.template.ai_settings import llm
-from sc_system_ai.template.azure_cosmos import CosmosDBManager
+from sc_system_ai.template.azure_cosmos import get_cosmos_manager
+from sc_system_ai.template.hybrid_search import document_key, get_hybrid_searcher, reciprocal_rank_fusion
+from sc_system_ai.template.local_vector_index import get_local_index
+from sc_system_ai.template.mmr import MMRPolicy
+from sc_system_ai.template.multi_query_search import amulti_query_search, multi_query_search
+from sc_system_ai.template.structured_output_cache import ainvoke_structured_output, invoke_structured_output
 
 load_dotenv()
 
@@ -16,13 +26,20 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# vector: ベクトル検索のみ、hybrid: 文字n-gramのBM25とベクトル検索をRRFで統合する
+# multi: 検索ワードの語ごとに並行してベクトル検索し、RRFで統合する
+SearchStrategy = Literal["vector", "hybrid", "multi"]
+
+T = TypeVar("T")
+
+# 同期版の投機的検索で、検索ワードの生成と並行して検索するためのスレッドプール
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="speculative-search")
+
 
 class Output(BaseModel):
     word: str = Field(description="検索ワード")
 
-def genarate_search_word(message: str) -> str:
-    """メッセージから検索ワードを生成する関数"""
-    prompt = """# Task
+search_word_prompt = """# Task
 条件に従い以下に与えるメッセージから検索ワードを生成してください。
 
 ## 条件
@@ -31,8 +48,21 @@ def genarate_search_word(message: str) -> str:
 - 複数を半角スペースで区切っても構いません
 
 ## メッセージ"""
-    model = llm.with_structured_output(Output)
-    result = model.invoke(prompt + "\n" + message)
+
+def genarate_search_word(message: str) -> str:
+    """メッセージから検索ワードを生成する関数"""
+    result = invoke_structured_output(llm, Output, search_word_prompt + "\n" + message, call_site="search_word")
+    return _search_word_from_output(result, message)
+
+async def agenarate_search_word(message: str) -> str:
+    """メッセージから検索ワードを非同期で生成する関数"""
+    result = await ainvoke_structured_output(
+        llm, Output, search_word_prompt + "\n" + message, call_site="search_word"
+    )
+    return _search_word_from_output(result, message)
+
+def _search_word_from_output(result: object, message: str) -> str:
+    """構造化出力から検索ワードを取り出す関数"""
     if isinstance(result, Output):
         logger.info(f"検索ワードの生成に成功しました: {result.word}")
         return result.word
@@ -53,10 +83,264 @@ def search_school_database_aisearch(search_word: str) -> list[Document]:
 
 def search_school_database_cosmos(search_word: str, top_k: int = 2) -> list[Document]:
     """学校に関する情報を検索する関数(現在のデータベースを参照)"""
-    cosmos_manager = CosmosDBManager()
+    local_index = get_local_index()
+    if local_index is not None:
+        return local_index.similarity_search(search_word, k=top_k)
+    cosmos_manager = get_cosmos_manager()
     docs = cosmos_manager.similarity_search(search_word, k=top_k)
     return docs
 
+async def asearch_school_database_cosmos(search_word: str, top_k: int = 2) -> list[Document]:
+    """学校に関する情報を非同期で検索する関数(現在のデータベースを参照)"""
+    local_index = get_local_index()
+    if local_index is not None:
+        return await local_index.asimilarity_search(search_word, k=top_k)
+    cosmos_manager = get_cosmos_manager()
+    docs = await cosmos_manager.asimilarity_search(search_word, k=top_k)
+    return docs
+
+def search_school_database_hybrid(search_word: str, top_k: int = 2) -> list[Document]:
+    """学校に関する情報をBM25とベクトル検索で検索する関数(現在のデータベースを参照)"""
+    return get_hybrid_searcher().search(search_word, k=top_k)
+
+async def asearch_school_database_hybrid(search_word: str, top_k: int = 2) -> list[Document]:
+    """学校に関する情報をBM25とベクトル検索で非同期に検索する関数(現在のデータベースを参照)"""
+    return await get_hybrid_searcher().asearch(search_word, k=top_k)
+
+def search_school_database(search_word: str, top_k: int = 2, strategy: SearchStrategy = "vector") -> list[Document]:
+    """検索方法を指定して学校に関する情報を検索する関数"""
+    if strategy == "hybrid":
+        return search_school_database_hybrid(search_word, top_k)
+    if strategy == "multi":
+        return multi_query_search(search_word, top_k, max_results=top_k).documents
+    return search_school_database_cosmos(search_word, top_k)
+
+async def asearch_school_database(
+    search_word: str,
+    top_k: int = 2,
+    strategy: SearchStrategy = "vector",
+) -> list[Document]:
+    """検索方法を指定して学校に関する情報を非同期で検索する関数"""
+    if strategy == "hybrid":
+        return await asearch_school_database_hybrid(search_word, top_k)
+    if strategy == "multi":
+        return (await amulti_query_search(search_word, top_k, max_results=top_k)).documents
+    return await asearch_school_database_cosmos(search_word, top_k)
+
+def _vector_search_with_score(
+    query: str,
+    top_k: int,
+    mmr: MMRPolicy | None = None,
+) -> list[tuple[Document, float]]:
+    """
+    スコア付きのベクトル検索を行う関数。ローカルのインデックスが有効な場合はそちらを使用する
+
+    mmrを指定した場合は、上位`mmr.fetch_k`件の候補からMMRで内容の重複が少ないtop_k件を選びます。
+    """
+    local_index = get_local_index()
+    if mmr is not None:
+        store = local_index if local_index is not None else get_cosmos_manager()
+        return store.max_marginal_relevance_search_with_score(
+            query, k=top_k, fetch_k=mmr.fetch_k, lambda_mult=mmr.lambda_mult
+        )
+    if local_index is not None:
+        return local_index.similarity_search_with_score(query, k=top_k)
+    return get_cosmos_manager().similarity_search_with_score(query, k=top_k)
+
+async def _avector_search_with_score(
+    query: str,
+    top_k: int,
+    mmr: MMRPolicy | None = None,
+) -> list[tuple[Document, float]]:
+    """スコア付きのベクトル検索を非同期で行う関数"""
+    local_index = get_local_index()
+    if mmr is not None:
+        store = local_index if local_index is not None else get_cosmos_manager()
+        return await store.amax_marginal_relevance_search_with_score(
+            query, k=top_k, fetch_k=mmr.fetch_k, lambda_mult=mmr.lambda_mult
+        )
+    if local_index is not None:
+        return await local_index.asimilarity_search_with_score(query, k=top_k)
+    return await get_cosmos_manager().asimilarity_search_with_score(query, k=top_k)
+
+def search_school_database_with_score(
+    search_word: str,
+    top_k: int = 2,
+    strategy: SearchStrategy = "vector",
+    mmr: MMRPolicy | None = None,
+) -> list[tuple[Document, float | None]]:
+    """
+    検索方法を指定して学校に関する情報をスコア付きで検索する関数。スコアのない検索方法の場合はNoneを返す
+
+    mmrはベクトル検索(strategy="vector")の場合のみ使用します。
+    """
+    if strategy == "vector":
+        return list(_vector_search_with_score(search_word, top_k, mmr))
+    return [(doc, None) for doc in search_school_database(search_word, top_k, strategy)]
+
+async def asearch_school_database_with_score(
+    search_word: str,
+    top_k: int = 2,
+    strategy: SearchStrategy = "vector",
+    mmr: MMRPolicy | None = None,
+) -> list[tuple[Document, float | None]]:
+    """検索方法を指定して学校に関する情報をスコア付きで非同期に検索する関数"""
+    if strategy == "vector":
+        return list(await _avector_search_with_score(search_word, top_k, mmr))
+    return [(doc, None) for doc in await asearch_school_database(search_word, top_k, strategy)]
+
+def _merge_by_score(
+    results: list[list[tuple[Document, float]]],
+    top_k: int,
+) -> list[tuple[Document, float]]:
+    """スコア付きの検索結果を統合する関数。同じdocumentはスコアの高い方を残す"""
+    best: dict[str, tuple[Document, float]] = {}
+    for result in results:
+        for doc, score in result:
+            key = document_key(doc)
+            if key not in best or score > best[key][1]:
+                best[key] = (doc, score)
+    ranked = sorted(best.values(), key=lambda pair: pair[1], reverse=True)
+    return ranked[:top_k]
+
+
+class SpeculativeSearchResult(BaseModel):
+    """投機的検索の結果と段階ごとの時間"""
+    documents: list[Document] = Field(default_factory=list, description="検索結果")
+    scores: list[float | None] = Field(default_factory=list, description="検索結果のスコア. RRFで統合した場合はNone")
+    search_word: str | None = Field(default=None, description="生成した検索ワード. 生成を打ち切った場合はNone")
+    timings: dict[str, float] = Field(
+        default_factory=dict,
+        description="段階ごとの時間(秒). search_word, raw_search, word_search, total, saved",
+    )
+
+
+def _speculative_result(
+    raw: list[tuple[Document, float]],
+    word: str | None,
+    top_k: int,
+    timings: dict[str, float],
+    start: float,
+    scored: list[tuple[Document, float]] | None = None,
+    ranked: list[Document] | None = None,
+) -> SpeculativeSearchResult:
+    """
+    検索結果を統合し、段階ごとの時間を記録する関数
+
+    検索ワードによるスコア付きの結果(scored)はスコアで、スコアのない結果(ranked)はRRFでメッセージによる結果と統合します。
+    timingsには完了した段階のみを記録し、打ち切った段階は含めません。
+    """
+    # 打ち切った段階が後から記録されないよう、この時点の値を複製する
+    timings = dict(timings)
+    results: list[tuple[Document, float | None]]
+    if scored is not None:
+        results = list(_merge_by_score([raw, scored], top_k))
+    elif ranked is not None:
+        # 検索ワードによる結果を優先する
+        fused = reciprocal_rank_fusion([ranked, [doc for doc, _ in raw]], top_n=top_k)
+        results = [(doc, None) for doc, _ in fused]
+    else:
+        results = list(raw[:top_k])
+    timings["total"] = time.perf_counter() - start
+    # 全ての段階を順番に行った場合との差
+    stages = ("search_word", "raw_search", "word_search")
+    timings["saved"] = sum(timings.get(stage, 0.0) for stage in stages) - timings["total"]
+    logger.info(
+        "投機的検索が完了しました: " + ", ".join(f"{name}={seconds * 1e3:.1f}ms" for name, seconds in timings.items())
+    )
+    return SpeculativeSearchResult(
+        documents=[doc for doc, _ in results],
+        scores=[score for _, score in results],
+        search_word=word,
+        timings=timings,
+    )
+
+
+def speculative_search(
+    message: str,
+    top_k: int = 2,
+    strategy: SearchStrategy = "vector",
+    accept_score: float | None = None,
+    mmr: MMRPolicy | None = None,
+) -> SpeculativeSearchResult:
+    """
+    検索ワードの生成と並行して、メッセージそのもので検索する関数
+
+    Args:
+        message (str): ユーザーのメッセージ
+        top_k (int, optional): 取得する件数. Defaults to 2.
+        strategy (SearchStrategy, optional): 検索ワードによる検索の方法. Defaults to "vector".
+        accept_score (float | None, optional): メッセージによる検索の最上位のスコアがこの値以上の場合は、
+            検索ワードの生成を待たずにその結果を返す. Noneの場合は常に両方の結果を統合する. Defaults to None.
+        mmr (MMRPolicy | None, optional): ベクトル検索の結果をMMRで選ぶ設定. Defaults to None.
+    """
+    start = time.perf_counter()
+    timings: dict[str, float] = {}
+
+    def timed(name: str, func: Callable[[], T]) -> T:
+        began = time.perf_counter()
+        result = func()
+        timings[name] = time.perf_counter() - began
+        return result
+
+    raw_future = _executor.submit(timed, "raw_search", lambda: _vector_search_with_score(message, top_k, mmr))
+    word_future = _executor.submit(timed, "search_word", lambda: genarate_search_word(message))
+    if accept_score is not None:
+        futures: list[Future[Any]] = [raw_future, word_future]
+        wait(futures, return_when=FIRST_COMPLETED)
+        raw = raw_future.result() if raw_future.done() else []
+        if not word_future.done() and raw and raw[0][1] >= accept_score:
+            # 開始前の生成は取り消す。同期の呼び出しは途中で止められないため、開始済みの場合は結果を使用しない
+            word_future.cancel()
+            return _speculative_result(raw, None, top_k, timings, start)
+
+    word = word_future.result()
+    if strategy == "vector":
+        scored = timed("word_search", lambda: _vector_search_with_score(word, top_k, mmr))
+        return _speculative_result(raw_future.result(), word, top_k, timings, start, scored=scored)
+    ranked = timed("word_search", lambda: search_school_database(word, top_k, strategy))
+    return _speculative_result(raw_future.result(), word, top_k, timings, start, ranked=ranked)
+
+
+async def aspeculative_search(
+    message: str,
+    top_k: int = 2,
+    strategy: SearchStrategy = "vector",
+    accept_score: float | None = None,
+    mmr: MMRPolicy | None = None,
+) -> SpeculativeSearchResult:
+    """検索ワードの生成と並行して、メッセージそのもので非同期に検索する関数"""
+    start = time.perf_counter()
+    timings: dict[str, float] = {}
+
+    async def timed(name: str, awaitable: Awaitable[T]) -> T:
+        began = time.perf_counter()
+        result = await awaitable
+        timings[name] = time.perf_counter() - began
+        return result
+
+    raw_task = asyncio.create_task(timed("raw_search", _avector_search_with_score(message, top_k, mmr)))
+    word_task = asyncio.create_task(timed("search_word", agenarate_search_word(message)))
+    try:
+        if accept_score is not None:
+            await asyncio.wait({raw_task, word_task}, return_when=asyncio.FIRST_COMPLETED)
+            raw = raw_task.result() if raw_task.done() else []
+            if not word_task.done() and raw and raw[0][1] >= accept_score:
+                # スコアが十分高いため、検索ワードの生成を打ち切る
+                word_task.cancel()
+                return _speculative_result(raw, None, top_k, timings, start)
+
+        word = await word_task
+        if strategy == "vector":
+            scored = await timed("word_search", _avector_search_with_score(word, top_k, mmr))
+            return _speculative_result(await raw_task, word, top_k, timings, start, scored=scored)
+        ranked = await timed("word_search", asearch_school_database(word, top_k, strategy))
+        return _speculative_result(await raw_task, word, top_k, timings, start, ranked=ranked)
+    finally:
+        for task in (raw_task, word_task):
+            if not task.done():
+                task.cancel()
+
 
 class SearchSchoolDataInput(BaseModel):
     search_word: str = Field(description="学校に関する情報を検索するためのキーワード")
@@ -66,6 +350,7 @@ class SearchSchoolDataTool(BaseTool):
     name: str = "search_school_data_tool"
     description: str = "学校に関する情報を検索するためのツール"
     args_schema: type[BaseModel] = SearchSchoolDataInput
+    strategy: SearchStrategy = "vector"
 
     def _run(
             self,
@@ -73,7 +358,7 @@ class SearchSchoolDataTool(BaseTool):
     ) -> list[str]:
         """use the tool."""
         logger.info(f"Search School Data Toolが次の値で呼び出されました: {search_word}")
-        result = search_school_database_cosmos(search_word)
+        result = search_school_database(search_word, strategy=self.strategy)
         search_result = []
         for i, doc in enumerate(result):
             if hasattr(doc, 'page_content'):
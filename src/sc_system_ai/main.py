@@ -58,18 +58,61 @@ agent = ClassifyAgent(user_info=user)
 """
 
 import logging
-from collections.abc import AsyncIterator
-from importlib import import_module
-from typing import Literal, TypedDict
-
-from sc_system_ai.template.agent import Agent
+import os
+from collections.abc import AsyncGenerator, Iterator
+from contextlib import aclosing, contextmanager
+from types import TracebackType
+from typing import Literal, TypedDict, get_args
+
+from sc_system_ai.template.agent import Agent, AgentResponse
+from sc_system_ai.template.agent_pool import AgentPool, AgentRegistry, PoolStats
 from sc_system_ai.template.ai_settings import llm
-from sc_system_ai.template.user_prompts import User
+from sc_system_ai.template.azure_cosmos import query_embeddings
+from sc_system_ai.template.embedding_cache import EmbeddingCacheStats
+from sc_system_ai.template.flush_policy import FlushPolicy
+from sc_system_ai.template.structured_output_cache import CacheStats, get_structured_output_cache
+from sc_system_ai.template.user_prompts import HistoryPolicy, User
 
 logger = logging.getLogger(__name__)
 
 AGENT = Literal["classify", "dummy", "search_school_data", "small_talk"]
 
+# 起動時にエージェントを読み込み、エージェントのインスタンスはプールで再利用する
+agent_registry = AgentRegistry()
+agent_registry.load(get_args(AGENT))
+agent_pool = AgentPool(agent_registry, llm=llm)
+# 起動時にコマンドごとに作成するエージェントの数. 0の場合は最初の呼び出し時に作成する
+AGENT_POOL_WARM_UP_SIZE = int(os.environ.get("AGENT_POOL_WARM_UP_SIZE", "0"))
+
+
+def warm_up_agents(size: int | None = None) -> None:
+    """
+    全てのコマンドのエージェントを事前に作成しプールに追加する関数
+
+    環境変数`AGENT_POOL_WARM_UP_SIZE`を指定した場合は起動時に呼び出されます。
+    指定しない場合は、最初のリクエストの前にサーバーの起動処理などから呼び出してください。
+    """
+    for command in get_args(AGENT):
+        agent_pool.warm_up(command, size)
+
+
+if AGENT_POOL_WARM_UP_SIZE > 0:
+    warm_up_agents(AGENT_POOL_WARM_UP_SIZE)
+
+
+def get_agent_pool_stats() -> dict[str, PoolStats]:
+    """エージェントプールのヒット数とミス数を取得する関数"""
+    return agent_pool.stats()
+
+def get_structured_output_cache_stats() -> dict[str, CacheStats]:
+    """構造化出力のキャッシュの呼び出し元ごとのヒット率を取得する関数。キャッシュが無効な場合は空の辞書を返す"""
+    cache = get_structured_output_cache()
+    return cache.stats() if cache is not None else {}
+
+def get_query_embedding_cache_stats() -> EmbeddingCacheStats:
+    """検索クエリの埋め込みのキャッシュのヒット率を取得する関数"""
+    return query_embeddings.stats()
+
 class Response(TypedDict):
     output: str | None
     error: str | None
@@ -90,6 +133,7 @@ class Chat:
         conversation (list[tuple[str, str]], optional): 会話履歴
         is_streaming (bool, optional): ストリーミングモードの有無
         return_length (int, optional): ストリーミングモード時の返答数
+        history_policy (HistoryPolicy, optional): プロンプトに含める会話履歴の範囲. 指定しない場合は全ての履歴を含める
 
     Examples:
         ```python
@@ -111,21 +155,28 @@ class Chat:
         is_streaming = True
         for r in chat.invoke(message=message, command="dummy"):
             print(r)
-        chat.agent.get_response()
+        chat.get_response()
         ```
+
+        エージェントは呼び出しごとにプールから取得し、呼び出しの終了時にプールへ返却します。
+        呼び出し中のみ`chat.agent`で参照でき、終了後の実行結果は`get_response()`で取得できます。
     """
     def __init__(
         self,
         user_name: str,
         user_major: str,
         conversation: list[tuple[str, str]] | None = None,
+        history_policy: HistoryPolicy | None = None,
     ) -> None:
         self.user = User(name=user_name, major=user_major)
         if conversation is None:
             conversation = []
+        if history_policy is not None:
+            self.user.conversations.policy = history_policy
 
         self.user.conversations.add_conversations_list(conversation)
         self._agent: Agent | None = None
+        self._response: AgentResponse | None = None
 
     @property
     def agent(self) -> Agent:
@@ -164,8 +215,35 @@ class Chat:
         - classify: 分類エージェント
         - dummy: ダミーエージェント
         """
-        self._call_agent(command)
-        resp = self.agent.invoke(message)
+        with self._use_agent(command) as agent:
+            resp = agent.invoke(message)
+        return {
+            "output": resp.output,
+            "error": resp.error,
+            "document_id": resp.document_id
+        }
+
+    async def ainvoke(
+        self,
+        message: str,
+        command: AGENT = "classify"
+    ) -> Response:
+        """エージェントを非同期で呼び出し、チャットを行う関数
+
+        Args:
+            message (str): メッセージ
+            command (AGENT, optional): 呼び出すエージェント。デフォルトでは分類エージェントを呼び出します。
+
+        Returns:
+            Response: エージェントからの返答
+
+        ASGIサーバーなどのイベントループ上から呼び出す場合に使用します。
+        ```python
+        resp = await chat.ainvoke(message="私の名前と専攻は何ですか？")
+        ```
+        """
+        with self._use_agent(command) as agent:
+            resp = await agent.ainvoke(message)
         return {
             "output": resp.output,
             "error": resp.error,
@@ -176,14 +254,17 @@ class Chat:
         self,
         message: str,
         return_length: int = 5,
-        command: AGENT = "classify"
-    ) -> AsyncIterator[StreamResponse]:
+        command: AGENT = "classify",
+        flush_policy: FlushPolicy | None = None,
+    ) -> AsyncGenerator[StreamResponse, None]:
         """エージェントを呼び出し、ストリーミングチャットを行う関数
 
         Args:
             message (str): メッセージ
             return_length (int, optional): ストリーミングモード時の返答数. デフォルトは5
             command (AGENT, optional): 呼び出すエージェント。デフォルトでは分類エージェントを呼び出します。
+            flush_policy (FlushPolicy | None, optional): チャンクの送出ポリシー。
+                指定した場合は`return_length`の代わりに使用します。
 
         Returns:
             Iterator[str]: エージェントからの返答
@@ -194,32 +275,64 @@ class Chat:
             print(resp)
         ```
 
+        文の区切りか、最初のトークンから200ms経過した時点で返答を送出する場合。
+        ```python
+        from sc_system_ai.template.flush_policy import create_flush_policy
+
+        policy = create_flush_policy(return_length=None, max_wait_ms=200, sentence_boundary=True)
+        async for resp in chat.stream(message="京都テックについて教えて", flush_policy=policy):
+            print(resp)
+        ```
+
         呼び出し可能なエージェント:
         - classify: 分類エージェント
         - dummy: ダミーエージェント
         """
-        self._call_agent(command)
-        async for resp in self.agent.stream(message, return_length):
-            yield {
-                "output": resp.output,
-                "error": resp.error,
-                "status": resp.status
-            }
-
-    def _call_agent(self, command: AGENT) -> None:
+        # クライアントが切断しジェネレータが閉じられた場合、エージェントの実行もキャンセルし、プールに返却する
+        with self._use_agent(command) as agent:
+            async with aclosing(agent.stream(message, return_length, flush_policy)) as stream:
+                async for resp in stream:
+                    yield {
+                        "output": resp.output,
+                        "error": resp.error,
+                        "status": resp.status
+                    }
+
+    def get_response(self) -> AgentResponse:
+        """直前の呼び出しのエージェントのレスポンスを取得する関数"""
+        if self._agent is not None:
+            return self._agent.get_response()
+        if self._response is None:
+            return AgentResponse(error="エージェントの実行結果がありません。")
+        return self._response
+
+    @contextmanager
+    def _use_agent(self, command: AGENT) -> Iterator[Agent]:
+        """プールからエージェントを取得し、呼び出しの終了時に返却するコンテキストマネージャ"""
+        self.close()
+        self.agent = agent_pool.acquire(command, self.user)
         try:
-            module_name = f"sc_system_ai.agents.{command}_agent"
-            class_name = "".join([cn.capitalize() for cn in command.split("_")]) + "Agent"
-            module = import_module(module_name)
-            agent_class = getattr(module, class_name)
+            yield self.agent
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """保持しているエージェントの実行結果を保存し、エージェントをプールに返却する関数"""
+        if self._agent is not None:
+            self._response = self._agent.get_response()
+            agent_pool.release(self._agent)
+            self._agent = None
+
+    def __enter__(self) -> "Chat":
+        return self
 
-            self.agent = agent_class(
-                llm=llm,
-                user_info=self.user,
-            )
-        except (ModuleNotFoundError, AttributeError, ValueError):
-            logger.error(f"エージェントが見つかりません: {command}")
-            raise ValueError(f"エージェントが見つかりません: {command}") from None
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
 
 
 def static_chat() -> None:
@@ -287,7 +400,7 @@ if __name__ == "__main__":
     message = "AI・IT・ロボットワールドにある専攻について教えて"
 
     # try:
-    #     resp = chat.agent.get_response()
+    #     resp = chat.get_response()
     # except Exception:
     #     pass
 
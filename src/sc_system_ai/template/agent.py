@@ -6,21 +6,24 @@ Agentの基底クラスを作成します。このクラスは、エージェン
 詳しい使用方法は `docs/make-agent.md` を参照してください。
 
 """
+import asyncio
+import contextlib
 import logging
-from collections.abc import AsyncIterator
-from queue import Queue
-from threading import Thread
+from collections.abc import AsyncGenerator
 from typing import Any, Literal
 
 from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.tools import BaseTool
 from langchain_community.tools import DuckDuckGoSearchRun
 from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables import RunnableConfig
 from langchain_openai import AzureChatOpenAI
 from pydantic import BaseModel
 
 from sc_system_ai.agents.tools import magic_function, search_duckduckgo
 from sc_system_ai.template.ai_settings import llm
+from sc_system_ai.template.flush_policy import CharacterCountFlushPolicy, ChunkBuffer, FlushPolicy
 from sc_system_ai.template.streaming_handler import StreamingAgentHandler, StreamingToolHandler
 from sc_system_ai.template.system_prompt import PromptTemplate
 from sc_system_ai.template.user_prompts import User
@@ -36,28 +39,38 @@ class ToolManager:
     Args:
         tools (list[Type[BaseTool]], optional): ツールのリスト. Defaults to [].
         is_streaming (bool, optional): ストリーミングの有無. Defaults to True.
-        queue (Queue, optional): キュー. Defaults to None.
+        queue (asyncio.Queue, optional): キュー. Defaults to None.
     """
     def __init__(
             self,
-            queue: Queue,
+            queue: asyncio.Queue,
             tools: list | None = None,
     ):
         self.tools: list[BaseTool] = []
         self.queue = queue
         self.handler = StreamingToolHandler(self.queue)
+        self.is_streaming = False
         if tools is not None:
             self.set_tools(tools)
 
-    def setup_streaming(self) -> None:
-        """ストリーミングのセットアップを行う関数"""
-        for tool in self.tools:
-            tool.callbacks = [self.handler]
+    def setup_streaming(self, queue: asyncio.Queue) -> None:
+        """ストリーミングのセットアップを行う関数。キューは実行ごとに受け取る"""
+        self.queue = queue
+        self.handler.queue = queue
+        self.is_streaming = True
 
     def cancel_streaming(self) -> None:
         """ストリーミングのセットアップを解除する関数"""
-        for tool in self.tools:
-            tool.callbacks = None
+        self.is_streaming = False
+
+    def get_callbacks(self) -> list[BaseCallbackHandler]:
+        """
+        ツールのコールバックを取得する関数
+
+        ツールは複数のエージェントで共有されるため、ツール自体にはコールバックを設定せず、
+        実行時のRunnableConfigから渡します。
+        """
+        return [self.handler] if self.is_streaming else []
 
     def set_tools(self, tools: list) -> None:
         """ツールを追加する関数"""
@@ -129,7 +142,9 @@ class Agent:
         self.user_info = user_info if user_info is not None else User()
 
         self.result: AgentResponse
-        self.queue: Queue = Queue()
+        self.is_streaming = False
+        # asyncio.Queueは最初に待ち受けたイベントループに結び付くため、ストリーミングの実行ごとに作り直す
+        self.queue: asyncio.Queue[str | None] = asyncio.Queue()
         self.handler = StreamingAgentHandler(self.queue)
 
         # assistant_infoとtoolsは各エージェントで設定する
@@ -138,34 +153,125 @@ class Agent:
 
         self.prompt_template = PromptTemplate(assistant_info=self.assistant_info, user_info=self.user_info)
 
+        # コンパイル済みのAgentExecutorのキャッシュ
+        self._executor_cache: dict[tuple[Any, ...], AgentExecutor] = {}
+        # ストリーミング用のLLMのコピー(コピー元のLLM, コピー)
+        self._streaming_llm: tuple[AzureChatOpenAI, AzureChatOpenAI] | None = None
+
         self.get_agent_info()
 
-    def setup_streaming(self) -> None:
-        """ストリーミング時のセットアップを行う関数"""
-        self.clear_queue()
-        self.llm.streaming = True
-        self.llm.callbacks = [self.handler]
-        self.tool.setup_streaming()
+    def setup_streaming(self, queue: asyncio.Queue[str | None]) -> None:
+        """
+        ストリーミング時のセットアップを行う関数
+
+        共有のLLMは変更せず、ストリーミングの設定とコールバックは実行ごとに渡します。
+        キューも実行ごとに作成し、ハンドラとツールに渡します。
+
+        Args:
+            queue (asyncio.Queue): この実行で生成されたトークンを送るキュー
+        """
+        self.queue = queue
+        self.handler.queue = queue
+        self.handler.loop = asyncio.get_running_loop()
+        self.is_streaming = True
+        self.tool.setup_streaming(queue)
 
     def cancel_streaming(self) -> None:
         """ストリーミング時のセットアップを解除する関数"""
-        self.llm.streaming = False
-        self.llm.callbacks = None
+        self.is_streaming = False
         self.tool.cancel_streaming()
 
+    def _get_llm(self, streaming: bool) -> AzureChatOpenAI:
+        """
+        実行時に使用するLLMを取得する関数
+
+        ストリーミング時は、ストリーミングを有効にしたLLMのコピーを返します。
+        コピーはHTTPクライアントを共有するため、接続は再利用されます。
+        """
+        if not streaming:
+            return self.llm
+        if self._streaming_llm is None or self._streaming_llm[0] is not self.llm:
+            self._streaming_llm = (self.llm, self.llm.model_copy(update={"streaming": True}))
+        return self._streaming_llm[1]
+
+    def _get_config(self, streaming: bool) -> RunnableConfig | None:
+        """実行時のRunnableConfigを作成する関数"""
+        if not streaming:
+            return None
+        return {"callbacks": [self.handler, *self.tool.get_callbacks()]}
+
     def clear_queue(self) -> None:
         """キューをクリアする関数"""
         while not self.queue.empty():
-            self.queue.get()
+            self.queue.get_nowait()
 
     def set_assistant_info(self, assistant_info: str) -> None:
         """アシスタント情報を設定する関数"""
         self.assistant_info = assistant_info
         self.prompt_template.create_prompt(assistant_info=self.assistant_info)
+        self.clear_executor_cache()
+
+    def set_user_info(self, user_info: User) -> None:
+        """
+        ユーザー情報を設定する関数
+
+        エージェントを別のユーザーで再利用する際に使用します。前回の実行結果は破棄されます。
+        """
+        self.user_info = user_info
+        self.prompt_template.create_prompt(user_info=self.user_info)
+        self.clear_executor_cache()
+        if hasattr(self, "result"):
+            del self.result
 
     def set_tools(self, tools: list) -> None:
         """ツールを設定する関数"""
         self.tool.set_tools(tools)
+        self.clear_executor_cache()
+
+    def reset(self) -> None:
+        """
+        実行ごとの状態を初期化する関数
+
+        エージェントをプールに返却する際に呼び出し、ユーザー情報、実行結果、ストリーミングの設定を破棄します。
+        """
+        self.cancel_streaming()
+        self.queue = asyncio.Queue()
+        self.handler.queue = self.queue
+        self.handler.loop = None
+        self.set_user_info(User())
+
+    def clear_executor_cache(self) -> None:
+        """コンパイル済みのAgentExecutorのキャッシュを破棄する関数"""
+        self._executor_cache.clear()
+
+    def _get_executor(self, streaming: bool = False) -> AgentExecutor:
+        """
+        AgentExecutorを取得する関数
+
+        エージェントのクラス、ツール、プロンプト、LLMが同一であればキャッシュ済みのAgentExecutorを返します。
+        キャッシュされたAgentExecutorがキーの各オブジェクトを参照し続けるため、idが再利用されることはありません。
+        """
+        llm = self._get_llm(streaming)
+        key = (
+            type(self),
+            tuple(id(tool) for tool in self.tool.tools),
+            id(self.prompt_template.full_prompt),
+            id(llm),
+        )
+        agent_executor = self._executor_cache.get(key)
+        if agent_executor is None:
+            logger.debug("AgentExecutorを作成します。")
+            agent = create_tool_calling_agent(
+                llm=llm,
+                tools=self.tool.tools,
+                prompt=self.prompt_template.full_prompt
+            )
+            agent_executor = AgentExecutor(
+                agent=agent,
+                tools=self.tool.tools,
+            )
+            self._executor_cache[key] = agent_executor
+        return agent_executor
 
     def invoke(self, message: str) -> AgentResponse:
         """
@@ -189,102 +295,171 @@ class Agent:
         self._invoke(message, False)
         return self.get_response()
 
+    async def ainvoke(self, message: str) -> AgentResponse:
+        """
+        エージェントを非同期で実行する関数
+
+        Args:
+            message (str): ユーザーからのメッセージ
+
+        ```python
+        resp = await agent.ainvoke("user message")
+        ```
+        """
+        self.cancel_streaming()
+        await self._ainvoke(message, False)
+        return self.get_response()
+
     async def stream(
         self,
         message: str,
-        return_length: int = 5
-    ) -> AsyncIterator[StreamingAgentResponse]:
+        return_length: int = 5,
+        flush_policy: FlushPolicy | None = None,
+    ) -> AsyncGenerator[StreamingAgentResponse, None]:
         """
         エージェントをストリーミングで実行する関数
 
         Args:
             message (str): ユーザーからのメッセージ
+            return_length (int, optional): 1チャンクあたりの文字数. Defaults to 5.
+            flush_policy (FlushPolicy | None, optional): チャンクの送出ポリシー。
+                指定しない場合は`return_length`文字ごとに送出します.
 
         ```python
-        for output in agent.stream("user message"):
+        async for output in agent.stream("user message"):
             print(output)
         ```
+
+        エージェントはイベントループ上のタスクとして実行され、生成されたトークンをasyncio.Queueで受け取ります。
+        キューは呼び出しごとに作成するため、同じエージェントを別のイベントループで実行できます。
+        ストリームの終了はタスクの完了時に送るNoneのみで判定します。
+        ジェネレータが閉じられた場合やキャンセルされた場合は、実行中のタスクをキャンセルします。
+        キャンセルはAgentExecutor、ツールから呼び出されたエージェント、モデルへのリクエストまで伝播します。
         """
-        self.setup_streaming()
-        phrase = ""
-        thread = Thread(target=self._invoke, args=(message, True,))
-        thread.start()
+        queue: asyncio.Queue[str | None] = asyncio.Queue()
+        self.setup_streaming(queue)
+        buffer = ChunkBuffer(flush_policy or CharacterCountFlushPolicy(return_length))
+        task = asyncio.create_task(self._ainvoke(message, True))
+        # エージェントの実行が終了したことを、タスクの完了時に1度だけ知らせる
+        task.add_done_callback(lambda _: queue.put_nowait(None))
         try:
             while True:
-                if self.queue.empty():
+                timeout = buffer.timeout()
+                try:
+                    if timeout is None:
+                        token = await queue.get()
+                    else:
+                        token = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    # 最大待ち時間を過ぎたため、溜まっているトークンを送出する
+                    yield StreamingAgentResponse(output=buffer.flush(), error=None, status="processing")
                     continue
-
-                token = self.handler.queue.get()
                 if token is None:
                     logger.debug("エージェントの実行が終了しました。")
                     break
-                phrase += token
-                if len(phrase) >= return_length:
-                    yield StreamingAgentResponse(
-                        output=phrase, error=None, status="processing"
-                    )
-                    phrase = ""
+                if buffer.append(token):
+                    yield StreamingAgentResponse(output=buffer.flush(), error=None, status="processing")
+            await task
         except Exception as e:
             logger.error(f"エラーが発生しました:{e}")
             yield StreamingAgentResponse(
                 output=None, error=f"エラーが発生しました:{e}", status="error"
             )
+        finally:
+            # 呼び出し元がストリームを閉じた、またはキャンセルされた場合は実行中のエージェントを停止する
+            if not task.done():
+                logger.info("ストリーミングが中断されたため、エージェントの実行をキャンセルします。")
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
 
-        if thread and thread.is_alive():
-            thread.join()
-        yield StreamingAgentResponse(output=phrase, error=None, status="completed")
+        yield StreamingAgentResponse(output=buffer.flush(), error=None, status="completed")
+
+    async def replay_stream(
+        self,
+        output: str,
+        return_length: int = 5,
+        flush_policy: FlushPolicy | None = None,
+        document_id: list[int] | None = None,
+    ) -> AsyncGenerator[StreamingAgentResponse, None]:
+        """
+        生成済みの回答をストリーミングと同じ形式のチャンクで返す関数
+
+        キャッシュした回答などを、エージェントを実行せずに`stream`と同じ形式で返します。
+        """
+        self.result = AgentResponse(output=output, document_id=document_id)
+        buffer = ChunkBuffer(flush_policy or CharacterCountFlushPolicy(return_length))
+        for char in output:
+            if buffer.append(char):
+                yield StreamingAgentResponse(output=buffer.flush(), error=None, status="processing")
+        yield StreamingAgentResponse(output=buffer.flush(), error=None, status="completed")
+
+    def _agent_input(self, message: str) -> dict[str, Any]:
+        """AgentExecutorへの入力を作成する関数"""
+        return {
+            "chat_history": self.user_info.conversations.format_conversation(),
+            "messages": message,
+        }
+
+    async def _aagent_input(self, message: str) -> dict[str, Any]:
+        """AgentExecutorへの入力を作成する関数。会話履歴の要約はイベントループを塞がないよう別スレッドで行う"""
+        if self.user_info.conversations.policy.summarizer is None:
+            return self._agent_input(message)
+        return await asyncio.to_thread(self._agent_input, message)
+
+    def _set_result(self, resp: dict[str, Any]) -> None:
+        """AgentExecutorの実行結果をAgentResponseに変換する関数"""
+        if "output" in resp:
+            self.result = AgentResponse(
+                chat_history=resp.get("chat_history"),
+                messages=resp.get("messages"),
+                output=resp.get("output"),
+            )
+        else:
+            logger.error("エージェントの実行結果取得に失敗しました。")
+            logger.debug(f"エージェントの実行結果: {resp}")
+            raise RuntimeError("エージェントの実行結果取得に失敗しました。")
 
     def _invoke(self, message: str, streaming: bool) -> None:
-        agent = create_tool_calling_agent(
-            llm=self.llm,
-            tools=self.tool.tools,
-            prompt=self.prompt_template.full_prompt
-        )
-        agent_executor = AgentExecutor(
-            agent=agent,
-            tools=self.tool.tools,
-            callbacks= [self.handler] if streaming else None
-        )
+        agent_executor = self._get_executor(streaming)
         try: # エージェントの実行
             logger.info("エージェントの実行を開始します。\n-------------------\n")
             logger.debug(f"最終的なプロンプト: {self.prompt_template.full_prompt.messages}")
-            resp = agent_executor.invoke({
-                "chat_history": self.user_info.conversations.format_conversation(),
-                "messages": message,
-            })
-
-            if "output" in resp:
-                self.result = AgentResponse(
-                    chat_history=resp.get("chat_history"),
-                    messages=resp.get("messages"),
-                    output=resp.get("output"),
-                )
-            else:
-                logger.error("エージェントの実行結果取得に失敗しました。")
-                logger.debug(f"エージェントの実行結果: {resp}")
-                raise RuntimeError("エージェントの実行結果取得に失敗しました。")
+            resp = agent_executor.invoke(
+                self._agent_input(message),
+                config=self._get_config(streaming),
+            )
+            self._set_result(resp)
+        except Exception as e:
+            logger.error(f"エージェントの実行に失敗しました。エラー内容: {e}")
+            self.result = AgentResponse(error=f"エージェントの実行に失敗しました。エラー内容: {e}")
+
+    async def _ainvoke(self, message: str, streaming: bool) -> None:
+        agent_executor = self._get_executor(streaming)
+        try: # エージェントの実行
+            logger.info("エージェントの実行を開始します。\n-------------------\n")
+            logger.debug(f"最終的なプロンプト: {self.prompt_template.full_prompt.messages}")
+            resp = await agent_executor.ainvoke(
+                await self._aagent_input(message),
+                config=self._get_config(streaming),
+            )
+            self._set_result(resp)
         except Exception as e:
             logger.error(f"エージェントの実行に失敗しました。エラー内容: {e}")
             self.result = AgentResponse(error=f"エージェントの実行に失敗しました。エラー内容: {e}")
 
     async def stream_on_tool(self, message: str) -> None:
-        """ツール上でストリーミングでエージェントを実行する関数"""
-        self.handler.queue = self.queue
-        self.setup_streaming()
-        agent = create_tool_calling_agent(
-            llm=self.llm,
-            tools=self.tool.tools,
-            prompt=self.prompt_template.full_prompt
-        )
-        agent_executor = AgentExecutor(
-            agent=agent,
-            tools=self.tool.tools,
-            callbacks= [self.handler],
+        """
+        ツール上でストリーミングでエージェントを実行する関数
+
+        トークンは呼び出し元のエージェントが`queue`に設定したキューに送ります。
+        """
+        self.setup_streaming(self.queue)
+        agent_executor = self._get_executor(streaming=True)
+        resp = await agent_executor.ainvoke(
+            await self._aagent_input(message),
+            config=self._get_config(streaming=True),
         )
-        resp = await agent_executor.ainvoke({
-            "chat_history": self.user_info.conversations.format_conversation(),
-            "messages": message,
-        })
         self.result = AgentResponse(
             chat_history=resp.get("chat_history"),
             messages=resp.get("messages"),
@@ -0,0 +1,182 @@
+"""
+### エージェントのレジストリとウォームプールを定義するモジュール
+
+class:
+    - AgentRegistry(コマンド名とエージェントクラスの対応を保持するクラス)
+    - AgentPool(エージェントのインスタンスを再利用するためのプール)
+
+使用例：
+```python
+registry = AgentRegistry()
+registry.load(["classify", "dummy"])
+
+pool = AgentPool(registry, max_size=8)
+agent = pool.acquire("classify", user_info=user)
+resp = agent.invoke("こんにちは")
+pool.release(agent)
+
+print(pool.stats())
+```
+"""
+import logging
+import threading
+import weakref
+from collections import deque
+from collections.abc import Iterable
+from importlib import import_module
+from typing import TypedDict
+
+from langchain_openai import AzureChatOpenAI
+
+from sc_system_ai.template.agent import Agent
+from sc_system_ai.template.ai_settings import llm
+from sc_system_ai.template.user_prompts import User
+
+logger = logging.getLogger(__name__)
+
+
+class AgentRegistry:
+    """
+    コマンド名とエージェントクラスの対応を保持するクラス
+
+    エージェントのモジュールは`load`の呼び出し時に一度だけ読み込まれます。
+    """
+    def __init__(self) -> None:
+        self._agents: dict[str, type[Agent]] = {}
+
+    def register(self, command: str, agent_class: type[Agent]) -> None:
+        """エージェントクラスを登録する関数"""
+        if not issubclass(agent_class, Agent):
+            raise ValueError("agent_classにはAgentクラス、またはそのサブクラスを指定してください")
+        self._agents[command] = agent_class
+
+    def load(self, commands: Iterable[str]) -> None:
+        """
+        コマンド名からエージェントクラスを読み込み登録する関数
+
+        `classify`の場合は`sc_system_ai.agents.classify_agent.ClassifyAgent`を登録します。
+        """
+        for command in commands:
+            module_name = f"sc_system_ai.agents.{command}_agent"
+            class_name = "".join([cn.capitalize() for cn in command.split("_")]) + "Agent"
+            try:
+                module = import_module(module_name)
+                self.register(command, getattr(module, class_name))
+            except (ModuleNotFoundError, AttributeError, ValueError):
+                logger.error(f"エージェントが見つかりません: {command}")
+                raise ValueError(f"エージェントが見つかりません: {command}") from None
+
+    def get(self, command: str) -> type[Agent]:
+        """コマンド名からエージェントクラスを取得する関数"""
+        try:
+            return self._agents[command]
+        except KeyError:
+            logger.error(f"エージェントが見つかりません: {command}")
+            raise ValueError(f"エージェントが見つかりません: {command}") from None
+
+    def __contains__(self, command: object) -> bool:
+        return command in self._agents
+
+
+class PoolStats(TypedDict):
+    hits: int
+    misses: int
+    idle: int
+
+
+class AgentPool:
+    """
+    エージェントのインスタンスを再利用するためのプール
+
+    Args:
+        registry (AgentRegistry): エージェントのレジストリ
+        llm (AzureChatOpenAI, optional): エージェントに渡すモデル. Defaults to llm.
+        max_size (int, optional): コマンドごとに保持するエージェントの最大数. Defaults to 8.
+
+    プールから取得したエージェントは、`set_user_info`で呼び出し元のユーザーに再設定されます。
+    使用後は`release`でプールに返却してください。返却されなかったエージェントは破棄されます。
+    ストリーミングのキューは実行ごとに作成されるため、返却したエージェントは別のイベントループでも使用できます。
+    """
+    def __init__(
+        self,
+        registry: AgentRegistry,
+        llm: AzureChatOpenAI = llm,
+        max_size: int = 8,
+    ) -> None:
+        self.registry = registry
+        self.llm = llm
+        self.max_size = max_size
+        self._idle: dict[str, deque[Agent]] = {}
+        # プールから払い出したエージェントとコマンド名の対応
+        self._commands: weakref.WeakKeyDictionary[Agent, str] = weakref.WeakKeyDictionary()
+        self._hits: dict[str, int] = {}
+        self._misses: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, command: str, user_info: User) -> Agent:
+        """プールからエージェントを取得する関数"""
+        agent_class = self.registry.get(command)
+        with self._lock:
+            idle = self._idle.get(command)
+            agent = idle.pop() if idle else None
+            counter = self._hits if agent is not None else self._misses
+            counter[command] = counter.get(command, 0) + 1
+
+        if agent is not None:
+            logger.debug(f"プールのエージェントを再利用します: {command}")
+            agent.set_user_info(user_info)
+        else:
+            logger.debug(f"エージェントを作成します: {command}")
+            agent = agent_class(llm=self.llm, user_info=user_info)
+            with self._lock:
+                self._commands[agent] = command
+        return agent
+
+    def release(self, agent: Agent) -> None:
+        """
+        エージェントをプールに返却する関数
+
+        返却時に`reset`でユーザー情報や検索結果などの実行ごとの状態を破棄し、次の利用者に引き継ぎません。
+        """
+        with self._lock:
+            command = self._commands.get(agent)
+            if command is None:
+                logger.warning("プールから取得していないエージェントは返却できません")
+                return
+            if any(a is agent for a in self._idle.get(command, ())):
+                return
+        agent.reset()
+        with self._lock:
+            idle = self._idle.setdefault(command, deque())
+            if any(a is agent for a in idle):
+                return
+            if len(idle) < self.max_size:
+                idle.append(agent)
+            else:
+                del self._commands[agent]
+
+    def warm_up(self, command: str, size: int | None = None) -> None:
+        """エージェントを事前に作成しプールに追加する関数"""
+        agent_class = self.registry.get(command)
+        n = self.max_size if size is None else min(size, self.max_size)
+        agents = [agent_class(llm=self.llm) for _ in range(n)]
+        with self._lock:
+            idle = self._idle.setdefault(command, deque())
+            for agent in agents:
+                if len(idle) >= self.max_size:
+                    break
+                self._commands[agent] = command
+                idle.append(agent)
+
+    def stats(self) -> dict[str, PoolStats]:
+        """コマンドごとのヒット数、ミス数、待機中のエージェント数を取得する関数"""
+        with self._lock:
+            commands = set(self._hits) | set(self._misses) | set(self._idle)
+            return {
+                command: {
+                    "hits": self._hits.get(command, 0),
+                    "misses": self._misses.get(command, 0),
+                    "idle": len(self._idle.get(command, ())),
+                }
+                for command in sorted(commands)
+            }
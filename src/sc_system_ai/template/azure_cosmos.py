@@ -1,24 +1,47 @@
+import asyncio
 import logging
 import os
+import threading
+import time
+import weakref
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Literal, cast
+from typing import Any, Generic, Literal, NamedTuple, TypeVar, cast
+from uuid import uuid4
 
-from azure.cosmos import CosmosClient, PartitionKey
+from azure.core.paging import PageIterator
+from azure.cosmos import CosmosClient, PartitionKey, http_constants
+from azure.cosmos.aio import ContainerProxy as AsyncContainerProxy
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+from azure.cosmos.exceptions import CosmosHttpResponseError
 from dotenv import load_dotenv
 from langchain_community.vectorstores.azure_cosmos_db_no_sql import (
     AzureCosmosDBNoSqlVectorSearch,
+    CosmosDBQueryType,
 )
 from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
+from pydantic import BaseModel, Field
 
 from sc_system_ai.template.ai_settings import embeddings
 from sc_system_ai.template.document_formatter import md_formatter, text_formatter
+from sc_system_ai.template.embedding_cache import (
+    ContentAddressedEmbeddings,
+    SQLiteEmbeddingStore,
+    content_key,
+    create_query_embeddings,
+)
+from sc_system_ai.template.mmr import DEFAULT_FETCH_K, DEFAULT_LAMBDA_MULT, maximal_marginal_relevance
 
 load_dotenv()
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 # policyの設定
 indexing_policy = {
@@ -43,22 +66,298 @@ vector_embedding_policy = {
 # cosmosDBの設定
 HOST = os.environ["AZURE_COSMOS_DB_ENDPOINT"]
 KEY = os.environ["AZURE_COSMOS_DB_KEY"]
-cosmos_client = CosmosClient(HOST, KEY)
 database_name = os.environ["AZURE_COSMOS_DB_DATABASE"]
 container_name = os.environ["AZURE_COSMOS_DB_CONTAINER"]
 partition_key = PartitionKey(path="/id")
 cosmos_container_properties = {"partition_key": partition_key}
 cosmos_database_properties = {"id": database_name}
 
+# 埋め込みのキャッシュのキーに含める名前空間
+embedding_namespace = os.environ["AZURE_EMBEDDINGS_DEPLOYMENT_NAME"]
+# 検索クエリの埋め込みを再利用するEmbeddings
+query_embeddings = create_query_embeddings(embeddings, namespace=embedding_namespace)
+
+# chunkの本文のハッシュを保存するmetadataのキー。textの更新時に変更のないchunkの判定に使用する
+CONTENT_HASH_KEY = "content_hash"
+# Cosmos DBの1回のパッチ操作に含められる操作の上限
+PATCH_OPERATIONS_LIMIT = 10
+# 同時に実行するパッチ操作の上限
+PATCH_CONCURRENCY = int(os.environ.get("COSMOS_PATCH_CONCURRENCY", "16"))
+# スロットリング(429)の場合に再試行する回数
+THROTTLE_RETRIES = 5
+HTTP_TOO_MANY_REQUESTS = 429
+
+# 一括登録の設定
+# Azure OpenAIの埋め込みの1回のリクエストに含められる入力の上限
+EMBEDDING_BATCH_SIZE = int(os.environ.get("COSMOS_BULK_EMBEDDING_BATCH_SIZE", "2048"))
+# 同時に実行するupsertの上限
+BULK_UPSERT_CONCURRENCY = int(os.environ.get("COSMOS_BULK_UPSERT_CONCURRENCY", "16"))
+# ページごとの読み込みで1回のクエリが返すitemの上限
+READ_PAGE_SIZE = int(os.environ.get("COSMOS_READ_PAGE_SIZE", "1000"))
+
+
+class DocumentChange(BaseModel):
+    """documentの変更内容を保持するクラス"""
+    action: Literal["create", "update", "delete"] = Field(description="変更の種類")
+    source_id: int | None = Field(default=None, description="変更されたdocumentのsource_id")
+    ids: list[str] = Field(default_factory=list, description="作成、更新されたdocumentのid")
+
+
+DocumentChangeListener = Callable[[DocumentChange], None]
+# 登録された関数を取得する参照。インスタンスのメソッドは弱参照で保持し、インスタンスが破棄されると解除される
+_document_change_listeners: list[Callable[[], DocumentChangeListener | None]] = []
+_document_change_listeners_lock = threading.Lock()
+
+
+def _live_listeners() -> list[DocumentChangeListener]:
+    """登録中の関数を取得する関数。破棄されたインスタンスのメソッドは登録から取り除く。ロックを取得した状態で呼び出す"""
+    refs = [(ref, ref()) for ref in _document_change_listeners]
+    _document_change_listeners[:] = [ref for ref, listener in refs if listener is not None]
+    return [listener for _, listener in refs if listener is not None]
+
+
+def add_document_change_listener(listener: DocumentChangeListener) -> None:
+    """
+    documentの作成、更新、削除時に呼び出される関数を登録する関数
+
+    インスタンスのメソッドは弱参照で保持するため、登録してもインスタンスは破棄されます。
+    """
+    with _document_change_listeners_lock:
+        if listener in _live_listeners():
+            return
+        if hasattr(listener, "__self__") and hasattr(listener, "__func__"):
+            _document_change_listeners.append(weakref.WeakMethod(listener))
+        else:
+            _document_change_listeners.append(lambda: listener)
+
+
+def remove_document_change_listener(listener: DocumentChangeListener) -> None:
+    """登録した関数を解除する関数。破棄されたインスタンスのメソッドも登録から取り除く"""
+    with _document_change_listeners_lock:
+        _document_change_listeners[:] = [
+            ref for ref in _document_change_listeners if (registered := ref()) is not None and registered != listener
+        ]
+
+
+def _notify_document_change(change: DocumentChange) -> None:
+    """登録された関数にdocumentの変更を通知する関数"""
+    with _document_change_listeners_lock:
+        listeners = _live_listeners()
+    for listener in listeners:
+        try:
+            listener(change)
+        except Exception as e:
+            logger.error(f"documentの変更の通知に失敗しました: {e}")
+
+
+class BulkDocument(NamedTuple):
+    """一括登録するdocument。`create_document`の引数と同じ"""
+    text: str
+    text_type: Literal["markdown", "plain"] = "markdown"
+    title: str | None = None
+    source_id: int | None = None
+    metadata: dict[str, Any] | None = None
+
+
+class BulkIngestResult(BaseModel):
+    """一括登録の結果と処理速度"""
+    ids: list[list[str]] = Field(default_factory=list, description="入力の順に、各documentのchunkのid")
+    documents: int = Field(default=0, description="登録したdocumentの数")
+    chunks: int = Field(default=0, description="登録したchunkの数")
+    seconds: float = Field(default=0.0, description="全体の時間(秒)")
+    embedding_seconds: float = Field(default=0.0, description="埋め込みの作成にかかった時間の合計(秒)")
+    waiting_seconds: float = Field(default=0.0, description="upsertの完了を待った時間の合計(秒)")
+
+    @property
+    def documents_per_second(self) -> float:
+        return self.documents / self.seconds if self.seconds else 0.0
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.chunks / self.seconds if self.seconds else 0.0
+
+
+class ItemPage(NamedTuple):
+    """ページごとの読み込みの結果。continuation_tokenを渡すと次のページから読み込みを再開できる"""
+    items: list[dict[str, Any]]
+    continuation_token: str | None
+
+
+class DocumentPage(NamedTuple):
+    """ページごとに読み込んだdocument。continuation_tokenを渡すと次のページから読み込みを再開できる"""
+    documents: list[Document]
+    continuation_token: str | None
+
+
+def _format_document(document: BulkDocument) -> list[Document]:
+    """documentをchunkに分割する関数。プロセスプールで実行するためモジュールの関数とする"""
+    metadata = dict(document.metadata) if document.metadata is not None else {}
+    if document.source_id is not None:
+        metadata.setdefault("source_id", document.source_id)
+    if document.text_type == "markdown":
+        docs = md_formatter(document.text, document.title, metadata)
+    else:
+        docs = text_formatter(document.text, title=document.title, metadata=metadata)
+    for doc in docs:
+        doc.metadata[CONTENT_HASH_KEY] = content_key(doc.page_content)
+    return docs
+
+
+def _iter_formatted(
+    documents: Iterable[BulkDocument],
+    processes: int | None,
+) -> Iterator[tuple[BulkDocument, list[Document]]]:
+    """
+    documentを入力の順にchunkに分割する関数
+
+    processesが0の場合は同じプロセスで分割します。
+    プロセスプールでは実行中の数を制限し、入力を全て読み込まずに順に結果を返します。
+    """
+    if processes == 0:
+        for document in documents:
+            yield document, _format_document(document)
+        return
+    workers = processes if processes is not None else os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        window = workers * 4
+        pending: deque[tuple[BulkDocument, Future[list[Document]]]] = deque()
+        for document in documents:
+            pending.append((document, pool.submit(_format_document, document)))
+            if len(pending) >= window:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
+
+
+class _BulkUpserter:
+    """
+    一括登録のupsertを並行して実行するクラス
+
+    実行中のupsertはmax_concurrency件までとし、documentごとに書き込みが完了していないchunkの数を数えます。
+    upsertで発生した例外は保持し、`raise_if_failed`で送出します。
+    """
+    def __init__(self, upsert_item: Callable[[dict[str, Any]], Any], max_concurrency: int):
+        self._upsert_item = upsert_item
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="cosmos-bulk-upsert")
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._remaining: list[int] = []
+        self._errors: list[Exception] = []
+
+    def __enter__(self) -> "_BulkUpserter":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        # 中断した場合も、実行中のupsertの完了を待つ
+        self._executor.shutdown(wait=True)
+
+    def add_document(self, chunks: int) -> None:
+        """書き込むdocumentのchunkの数を追加する関数"""
+        with self._lock:
+            self._remaining.append(chunks)
+
+    def submit(self, index: int, item: dict[str, Any]) -> float:
+        """upsertを開始する関数。実行中のupsertが上限に達している場合は待ち、待った時間(秒)を返す"""
+        began = time.perf_counter()
+        self._slots.acquire()
+        waited = time.perf_counter() - began
+        try:
+            self.raise_if_failed()
+        except Exception:
+            self._slots.release()
+            raise
+        self._executor.submit(self._upsert, index, item)
+        return waited
+
+    def _upsert(self, index: int, item: dict[str, Any]) -> None:
+        try:
+            self._upsert_item(item)
+        except Exception as e:
+            with self._lock:
+                self._errors.append(e)
+        else:
+            with self._lock:
+                self._remaining[index] -= 1
+        finally:
+            self._slots.release()
+
+    def raise_if_failed(self) -> None:
+        """upsertに失敗していた場合は、最初の例外を送出する関数"""
+        with self._lock:
+            if self._errors:
+                raise self._errors[0]
+
+    def completed(self, index: int) -> bool:
+        """documentの全てのchunkの書き込みが完了したかどうか"""
+        with self._lock:
+            return self._remaining[index] == 0
+
+
+# パッチ操作を並行して実行するスレッドプール
+_patch_executor = ThreadPoolExecutor(max_workers=PATCH_CONCURRENCY, thread_name_prefix="cosmos-patch")
+
+
+def _retry_after(error: CosmosHttpResponseError, attempt: int) -> float:
+    """スロットリングの応答から再試行までの時間(秒)を取得する関数。指定がない場合は指数的に延ばす"""
+    retry_after = error.headers.get(http_constants.HttpHeaders.RetryAfterInMilliseconds) if error.headers else None
+    if retry_after is not None:
+        return float(retry_after) / 1000
+    return float(0.1 * 2 ** attempt)
+
+
+class _Lazy(Generic[T]):
+    """初回の呼び出し時に一度だけ値を作成し、以降は同じ値を返すクラス"""
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._value: T | None = None
+        self._lock = threading.Lock()
+
+    def get(self) -> T:
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+        return self._value
+
+    def reset(self) -> None:
+        with self._lock:
+            self._value = None
+
+
+_cosmos_client: _Lazy[CosmosClient] = _Lazy(lambda: CosmosClient(HOST, KEY))
+
+
+def get_cosmos_client() -> CosmosClient:
+    """
+    プロセス全体で共有するCosmosClientを取得する関数
+
+    最初の呼び出し時に接続し、以降は同じクライアントを再利用します。
+    """
+    return _cosmos_client.get()
+
+
+def __getattr__(name: str) -> Any:
+    # 以前のモジュール変数`cosmos_client`との互換性のため、参照時に接続する
+    if name == "cosmos_client":
+        return get_cosmos_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 class CosmosDBManager(AzureCosmosDBNoSqlVectorSearch):
-    """AzureCosmosDBNoSqlVectorSearchの設定を継承しcosmosDBの操作を行うための関数を追加したクラス"""
+    """
+    AzureCosmosDBNoSqlVectorSearchの設定を継承しcosmosDBの操作を行うための関数を追加したクラス
+
+    `set_document_embedding_store`でストアを設定した場合のみ、documentの作成と更新ではchunkの本文のハッシュで
+    保存済みの埋め込みを再利用します。既定では設定せず、毎回埋め込みを作成します。
+    """
 
     def __init__(
         self,
         *,
-        cosmos_client: CosmosClient = cosmos_client,
-        embedding: Embeddings = embeddings,
+        cosmos_client: CosmosClient | None = None,
+        embedding: Embeddings = query_embeddings,
         vector_embedding_policy: dict[str, Any] = vector_embedding_policy,
         indexing_policy: dict[str, Any] = indexing_policy,
         cosmos_container_properties: dict[str,
@@ -70,7 +369,7 @@ class CosmosDBManager(AzureCosmosDBNoSqlVectorSearch):
         create_container: bool = False,
     ):
         super().__init__(
-            cosmos_client=cosmos_client,
+            cosmos_client=cosmos_client if cosmos_client is not None else get_cosmos_client(),
             embedding=embedding,
             vector_embedding_policy=vector_embedding_policy,
             indexing_policy=indexing_policy,
@@ -80,6 +379,125 @@ class CosmosDBManager(AzureCosmosDBNoSqlVectorSearch):
             container_name=container_name,
             create_container=create_container,
         )
+        # documentのchunkの埋め込みに使用するEmbeddings
+        self._document_embedding: Embeddings = embedding
+
+    def set_document_embedding_store(
+        self,
+        store: SQLiteEmbeddingStore | None,
+        namespace: str = embedding_namespace,
+    ) -> None:
+        """
+        documentのchunkの埋め込みを保存するストアを設定する関数
+
+        Args:
+            store (SQLiteEmbeddingStore | None): 埋め込みを保存するストア. Noneの場合は毎回埋め込みを作成する
+            namespace (str, optional): ストアのキーに含める名前空間. Defaults to 埋め込みのデプロイ名.
+        """
+        self._document_embedding = (
+            self._embedding if store is None else ContentAddressedEmbeddings(self._embedding, store, namespace)
+        )
+
+    async def asimilarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        **kwargs: Any,
+    ) -> list[Document]:
+        """非同期クライアントでベクトル検索を行う関数"""
+        docs_and_scores = await self.asimilarity_search_with_score(query, k=k, **kwargs)
+        return [doc for doc, _ in docs_and_scores]
+
+    async def asimilarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        with_embedding: bool = False,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        """非同期クライアントでスコア付きのベクトル検索を行う関数
+
+        埋め込みの生成とCosmos DBへのクエリをどちらも非同期で行います。
+        """
+        embeddings = await self._embedding.aembed_query(query)
+        return await self.asimilarity_search_by_vector_with_score(embeddings, k=k, with_embedding=with_embedding)
+
+    def similarity_search_by_vector_with_score(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        with_embedding: bool = False,
+    ) -> list[tuple[Document, float]]:
+        """埋め込みベクトルを指定してスコア付きのベクトル検索を行う関数"""
+        return self._similarity_search_with_score(
+            query_type=CosmosDBQueryType.VECTOR, embeddings=embedding, k=k, with_embedding=with_embedding
+        )
+
+    async def asimilarity_search_by_vector_with_score(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        with_embedding: bool = False,
+    ) -> list[tuple[Document, float]]:
+        """埋め込みベクトルを指定して非同期クライアントでスコア付きのベクトル検索を行う関数"""
+        query_text, parameters = self._construct_query(
+            k=k, query_type=CosmosDBQueryType.VECTOR, embeddings=embedding
+        )
+        container = await self._aget_container()
+        items = [item async for item in container.query_items(query=query_text, parameters=parameters)]
+        return [self._item_to_document(item, with_embedding) for item in items]
+
+    def max_marginal_relevance_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = DEFAULT_FETCH_K,
+        lambda_mult: float = DEFAULT_LAMBDA_MULT,
+    ) -> list[tuple[Document, float]]:
+        """上位fetch_k件の候補を埋め込み付きで取得し、MMRでk件を選ぶ関数。スコアは検索ワードとの類似度"""
+        embedding = self._embedding.embed_query(query)
+        candidates = self.similarity_search_by_vector_with_score(
+            embedding, k=max(fetch_k, k), with_embedding=True
+        )
+        return self._select_by_mmr(embedding, candidates, k, lambda_mult)
+
+    async def amax_marginal_relevance_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = DEFAULT_FETCH_K,
+        lambda_mult: float = DEFAULT_LAMBDA_MULT,
+    ) -> list[tuple[Document, float]]:
+        """上位fetch_k件の候補を非同期クライアントで取得し、MMRでk件を選ぶ関数"""
+        embedding = await self._embedding.aembed_query(query)
+        candidates = await self.asimilarity_search_by_vector_with_score(
+            embedding, k=max(fetch_k, k), with_embedding=True
+        )
+        return self._select_by_mmr(embedding, candidates, k, lambda_mult)
+
+    def _select_by_mmr(
+        self,
+        embedding: list[float],
+        candidates: list[tuple[Document, float]],
+        k: int,
+        lambda_mult: float,
+    ) -> list[tuple[Document, float]]:
+        """埋め込み付きの候補からMMRでk件を選び、metadataから埋め込みを取り除く関数"""
+        vectors = [doc.metadata.pop(self._embedding_key) for doc, _ in candidates]
+        return [candidates[i] for i in maximal_marginal_relevance(embedding, vectors, k, lambda_mult)]
+
+    async def _aget_container(self) -> AsyncContainerProxy:
+        """実行中のイベントループで共有する非同期のコンテナクライアントを取得する関数"""
+        client = await aget_cosmos_client()
+        return client.get_database_client(self._database_name).get_container_client(self._container_name)
+
+    def _item_to_document(self, item: dict[str, Any], with_embedding: bool = False) -> tuple[Document, float]:
+        """ベクトル検索の結果をDocumentとスコアに変換する関数"""
+        metadata = item.pop(self._metadata_key, {})
+        metadata["id"] = item["id"]
+        if with_embedding:
+            metadata[self._embedding_key] = item[self._embedding_key]
+        return Document(page_content=item[self._text_key], metadata=metadata), item["SimilarityScore"]
 
     def read_item(
         self,
@@ -88,7 +506,64 @@ class CosmosDBManager(AzureCosmosDBNoSqlVectorSearch):
     ) -> list[dict[str, Any]]:
         """条件を指定してdocumentを読み込む関数"""
         logger.info("documentを読み込みます")
+        query, parameters = self._build_query(values, condition)
+        item = list(self._container.query_items(
+            query=query,
+            parameters=parameters if parameters else None,
+            enable_cross_partition_query=True
+        ))
+
+        if not item:
+            logger.error(f"{id=}のdocumentが見つかりませんでした")
+            raise ValueError("documentが見つかりませんでした")
+        return item
 
+    def iter_item_pages(
+        self,
+        values: list[str] | None = None,
+        condition: dict[str, Any] | None = None,
+        page_size: int = READ_PAGE_SIZE,
+        continuation_token: str | None = None,
+    ) -> Iterator[ItemPage]:
+        """
+        条件に一致するdocumentをページごとに読み込むジェネレータ
+
+        Args:
+            values (list[str] | None, optional): 読み込む項目. Defaults to None(全ての項目).
+            condition (dict[str, Any] | None, optional): 読み込む条件. Defaults to None.
+            page_size (int, optional): 1ページのitemの上限. Defaults to READ_PAGE_SIZE.
+            continuation_token (str | None, optional): 前回の読み込みで返された継続トークン.
+                指定した場合はそのページの次から読み込む. Defaults to None.
+        """
+        query, parameters = self._build_query(values, condition)
+        # by_pageの戻り値の型はIteratorだが、実体は継続トークンを保持するPageIterator
+        pager = cast(PageIterator[dict[str, Any]], self._container.query_items(
+            query=query,
+            parameters=parameters if parameters else None,
+            enable_cross_partition_query=True,
+            max_item_count=page_size,
+        ).by_page(continuation_token))
+        for page in pager:
+            items = list(page)
+            if items:
+                yield ItemPage(items, pager.continuation_token)
+
+    def iter_items(
+        self,
+        values: list[str] | None = None,
+        condition: dict[str, Any] | None = None,
+        page_size: int = READ_PAGE_SIZE,
+    ) -> Iterator[dict[str, Any]]:
+        """条件に一致するdocumentを1件ずつ読み込むジェネレータ。ページごとに問い合わせる"""
+        for page in self.iter_item_pages(values, condition, page_size):
+            yield from page.items
+
+    def _build_query(
+        self,
+        values: list[str] | None,
+        condition: dict[str, Any] | None,
+    ) -> tuple[str, list[dict[str, Any]]]:
+        """読み込む項目と条件からクエリとパラメータを作成する関数"""
         query = "SELECT "
         if values is not None:
             query += ", ".join(["c." + value for value in values]) + " "
@@ -105,17 +580,7 @@ class CosmosDBManager(AzureCosmosDBNoSqlVectorSearch):
                 parameters.append({"name": f"@{name}", "value": value})
                 query += " AND"
             query = query[:-4]
-
-        item = list(self._container.query_items(
-            query=query,
-            parameters=parameters if parameters else None,
-            enable_cross_partition_query=True
-        ))
-
-        if not item:
-            logger.error(f"{id=}のdocumentが見つかりませんでした")
-            raise ValueError("documentが見つかりませんでした")
-        return item
+        return query, parameters
 
     def create_document(
         self,
@@ -127,14 +592,104 @@ class CosmosDBManager(AzureCosmosDBNoSqlVectorSearch):
     ) -> list[str]:
         """データベースに新しいdocumentを作成する関数"""
         logger.info("新しいdocumentを作成します")
-        m = metadata if metadata is not None else {}
-        if source_id is not None:
-            m.setdefault("source_id", source_id)
         texts, metadatas = self._division_document(
-            md_formatter(text, title, m) if text_type == "markdown"
-            else text_formatter(text, title=title, metadata=m)
+            _format_document(BulkDocument(text, text_type, title, source_id, metadata))
         )
         ids = self._insert_texts(texts, metadatas)
+        _notify_document_change(DocumentChange(action="create", source_id=source_id, ids=ids))
+        return ids
+
+    def create_documents_bulk(
+        self,
+        documents: Iterable[BulkDocument | tuple[Any, ...]],
+        embedding_batch_size: int = EMBEDDING_BATCH_SIZE,
+        max_concurrency: int = BULK_UPSERT_CONCURRENCY,
+        processes: int | None = None,
+    ) -> BulkIngestResult:
+        """
+        複数のdocumentをまとめてデータベースに作成する関数
+
+        Args:
+            documents (Iterable[BulkDocument | tuple]): 作成するdocument.
+                (text, text_type, title, source_id, metadata)のタプルでもよい
+            embedding_batch_size (int, optional): 1回の埋め込みのリクエストに含めるchunkの上限.
+                Defaults to EMBEDDING_BATCH_SIZE.
+            max_concurrency (int, optional): 同時に実行するupsertの上限. Defaults to BULK_UPSERT_CONCURRENCY.
+            processes (int | None, optional): chunkへの分割に使用するプロセス数.
+                Noneの場合はCPUの数、0の場合は同じプロセスで分割する. Defaults to None.
+
+        分割はプロセスプールで、埋め込みはembedding_batch_size件ずつまとめて行い、upsertは別のスレッドで並行して行います。
+        実行中のupsertが上限に達している場合は、次の埋め込みの作成を待ちます。
+        upsertに失敗した場合は次の埋め込みを作成せずに中断し、全てのchunkを書き込めたdocumentのみを通知してから例外を送出します。
+        """
+        logger.info("documentを一括で作成します")
+        start = time.perf_counter()
+        result = BulkIngestResult()
+        source_ids: list[int | None] = []
+        batch: list[tuple[int, Document]] = []
+
+        def flush(upserter: _BulkUpserter) -> None:
+            # 先に失敗したupsertがあれば、次の埋め込みを作成せずに中断する
+            upserter.raise_if_failed()
+            began = time.perf_counter()
+            vectors = self._document_embedding.embed_documents([doc.page_content for _, doc in batch])
+            result.embedding_seconds += time.perf_counter() - began
+            for (index, doc), vector in zip(batch, vectors, strict=True):
+                _id = str(uuid4())
+                item = {
+                    "id": _id,
+                    self._text_key: doc.page_content,
+                    self._embedding_key: vector,
+                    self._metadata_key: doc.metadata,
+                }
+                result.ids[index].append(_id)
+                result.waiting_seconds += upserter.submit(index, item)
+            result.chunks += len(batch)
+            batch.clear()
+
+        upserter = _BulkUpserter(self._container.upsert_item, max_concurrency)
+        try:
+            with upserter:
+                for index, (document, chunks) in enumerate(
+                    _iter_formatted((BulkDocument(*document) for document in documents), processes)
+                ):
+                    result.ids.append([])
+                    source_ids.append(document.source_id)
+                    upserter.add_document(len(chunks))
+                    for chunk in chunks:
+                        batch.append((index, chunk))
+                        if len(batch) >= embedding_batch_size:
+                            flush(upserter)
+                if batch:
+                    flush(upserter)
+        finally:
+            # 中断した場合も、全てのchunkを書き込めたdocumentは変更を通知する
+            for index, (source_id, ids) in enumerate(zip(source_ids, result.ids, strict=True)):
+                if upserter.completed(index):
+                    _notify_document_change(DocumentChange(action="create", source_id=source_id, ids=ids))
+        upserter.raise_if_failed()
+        result.documents = len(result.ids)
+        result.seconds = time.perf_counter() - start
+        logger.info(
+            f"documentを一括で作成しました: {result.documents}件 {result.chunks}chunk ({result.seconds:.1f}s, "
+            f"{result.documents_per_second:.1f}docs/s, {result.chunks_per_second:.1f}chunks/s)"
+        )
+        return result
+
+    def _insert_texts(self, texts: list[str], metadatas: list[dict[str, Any]]) -> list[str]:
+        """chunkの埋め込みを作成してデータベースに追加する関数。保存済みの埋め込みがある場合は再利用する"""
+        if not texts:
+            raise ValueError("登録するテキストがありません")
+        vectors = self._document_embedding.embed_documents(texts)
+        ids: list[str] = []
+        for text, metadata, vector in zip(texts, metadatas, vectors, strict=True):
+            created = self._container.create_item({
+                "id": str(uuid4()),
+                self._text_key: text,
+                self._embedding_key: vector,
+                self._metadata_key: metadata,
+            })
+            ids.append(cast(str, created["id"]))
         return ids
 
     def _division_document(
@@ -158,7 +713,15 @@ class CosmosDBManager(AzureCosmosDBNoSqlVectorSearch):
         del_metadata: list[str] | None = None,
         is_patch: bool = False,
     ) -> list[str]:
-        """データベースのdocumentを更新する関数"""
+        """
+        データベースのdocumentを更新する関数
+
+        titleとmetadataの変更、updated_atの更新はchunkごとに1回のパッチ操作にまとめ、並行して実行します。
+        textを更新する場合、titleとmetadataは新しいtextを分割したchunkに含めます。
+        chunkのmetadataは新しいmetadataに置き換わるため、del_metadataとis_patchは指定できません。
+        """
+        if text is not None and (del_metadata or is_patch):
+            raise ValueError("textを更新する際はdel_metadataとis_patchを指定できません。metadataは置き換えられます。")
         logger.info("documentを更新します")
         # source_idを指定してdocumentを取得
         update_docs = self.read_item(values=["id", "metadata"], condition={"metadata.source_id": source_id})
@@ -168,76 +731,85 @@ class CosmosDBManager(AzureCosmosDBNoSqlVectorSearch):
             if doc["id"] not in result:
                 result.append(cast(str, doc["id"]))
         item = update_docs[0]
-
-        if title is not None:
-            self._title_updater(_id, title, item["metadata"].get("group_id", None))
-
-        if metadata is not None:
-            self._metadata_updater(
-                _id, metadata, del_metadata, None if is_patch else item["metadata"].get("group_id", None)
-            )
+        group_id = item["metadata"].get("group_id", None)
 
         if text is not None:
             if text_type is None:
                 raise TypeError("textを更新する際はtext_typeを指定してください。")
-            result = self._text_updater(
-                _id, text, text_type, source_id, metadata, item["metadata"].get("group_id", None)
+            result = self._text_updater(_id, text, text_type, source_id, metadata, group_id, title)
+        elif any([title, metadata, del_metadata]):
+            self._patch_items(
+                self._update_patches(update_docs, result, title, metadata, del_metadata, is_patch)
             )
 
-        if any([title, metadata, del_metadata]):
-            date = datetime.now().strftime("%Y-%m-%d")
-            patch = [{
-                "op": "replace",
-                "path": "/metadata/updated_at",
-                "value": date
-            }]
-            for doc_id in result:
-                self._container.patch_item(
-                    item=doc_id, partition_key=doc_id, patch_operations=patch
-                )
-
+        _notify_document_change(DocumentChange(action="update", source_id=source_id, ids=result))
         return result
 
-    def _title_updater(self, id: str, title: str, group_id: str | None = None) -> None:
-        """titleを更新する関数"""
-        if group_id is None:
-            ids = [id]
-        else:
-            data = self.read_item(values=["id"], condition={"metadata.group_id": group_id})
-            ids = [cast(str, d["id"]) for d in data]
-
-        patch = [{
-            "op": "replace",
-            "path": "/metadata/title",
-            "value": title
-        }]
-        for _id in ids:
-            self._container.patch_item(
-                item=_id, partition_key=_id, patch_operations=patch
-            )
-
-    def _metadata_updater(
+    def _update_patches(
         self,
-        id: str,
-        metadata: dict[str, Any],
+        items: list[dict[str, Any]],
+        ids: list[str],
+        title: str | None = None,
+        metadata: dict[str, Any] | None = None,
         del_metadata: list[str] | None = None,
-        group_id: str | None = None,
-    ) -> None:
-        """metadataを更新する関数"""
-        if group_id is None:
-            data = self.read_item(values=["metadata"], condition={"id": id})[0]
-            prev_metadatas = [cast(dict[str, Any], data["metadata"])]
-            ids = [id]
-        else:
-            datas = self.read_item(values=["id", "metadata"], condition={"metadata.group_id": group_id})
-            prev_metadatas = [cast(dict[str, Any], d["metadata"]) for d in datas]
-            ids = [cast(str, d["id"]) for d in datas]
-
-        for _id, pm in zip(ids, prev_metadatas, strict=True):
-            patch = self._create_patch(pm, metadata, [] if del_metadata is None else del_metadata)
-            self._container.patch_item(
-                item=_id, partition_key=_id, patch_operations=patch
-            )
+        is_patch: bool = False,
+    ) -> dict[str, list[dict[str, Any]]]:
+        """
+        titleの変更、metadataの差分、updated_atの更新をchunkごとのパッチ操作にまとめる関数
+
+        titleは同じgroup_idの全てのchunkに、metadataはis_patchの場合は最初のchunkのみ、
+        それ以外は同じgroup_idの全てのchunkに、updated_atはidsの全てのchunkに適用します。
+        """
+        first = items[0]
+        group_id = first["metadata"].get("group_id", None)
+        group = [first] if group_id is None else [
+            item for item in items if item["metadata"].get("group_id") == group_id
+        ]
+        patches: dict[str, list[dict[str, Any]]] = {_id: [] for _id in ids}
+
+        if title is not None:
+            for item in group:
+                patches[item["id"]].append({"op": "replace", "path": "/metadata/title", "value": title})
+
+        if metadata is not None:
+            for item in [first] if is_patch else group:
+                patches[item["id"]].extend(
+                    self._create_patch(item["metadata"], metadata, [] if del_metadata is None else del_metadata)
+                )
+
+        date = datetime.now().strftime("%Y-%m-%d")
+        for _id in ids:
+            patches[_id].append({"op": "replace", "path": "/metadata/updated_at", "value": date})
+        return patches
+
+    def _patch_items(self, patches: dict[str, list[dict[str, Any]]]) -> None:
+        """複数のitemにパッチ操作を並行して行う関数。同時に実行する数はPATCH_CONCURRENCYまで"""
+        targets = [(_id, operations) for _id, operations in patches.items() if operations]
+        if len(targets) == 1:
+            self._patch_item(*targets[0])
+            return
+        futures = [_patch_executor.submit(self._patch_item, _id, operations) for _id, operations in targets]
+        for future in futures:
+            future.result()
+
+    def _patch_item(self, id: str, operations: list[dict[str, Any]]) -> None:
+        """
+        1件のitemにパッチ操作を行う関数
+
+        1回に含められる操作の上限を超える場合は分割し、スロットリング(429)の場合は待ってから再試行します。
+        """
+        for start in range(0, len(operations), PATCH_OPERATIONS_LIMIT):
+            batch = operations[start:start + PATCH_OPERATIONS_LIMIT]
+            for attempt in range(THROTTLE_RETRIES + 1):
+                try:
+                    self._container.patch_item(item=id, partition_key=id, patch_operations=batch)
+                    break
+                except CosmosHttpResponseError as e:
+                    if e.status_code != HTTP_TOO_MANY_REQUESTS or attempt == THROTTLE_RETRIES:
+                        raise
+                    wait = _retry_after(e, attempt)
+                    logger.warning(f"{id=}のパッチ操作がスロットリングされたため、{wait:.2f}秒後に再試行します")
+                    time.sleep(wait)
 
     def _create_patch(
         self,
@@ -279,43 +851,124 @@ class CosmosDBManager(AzureCosmosDBNoSqlVectorSearch):
         source_id: int | None = None,
         metadata: dict[str, Any] | None = None,
         group_id: str | None = None,
+        title: str | None = None,
     ) -> list[str]:
-        """textを更新する関数"""
-        created_at = self.read_item(values=["metadata.created_at"], condition={"id": id})[0]["created_at"]
-        if group_id is None:
-            self.delete_document_by_id(id)
-        else:
-            data = self.read_item(values=["id"], condition={"metadata.group_id": group_id})
-            for d in data:
-                self.delete_document_by_id(d["id"])
-
-        ids = self.create_document(text, text_type, metadata=metadata, source_id=source_id)
-        patch = [{
-            "op": "replace",
-            "path": "/metadata/created_at",
-            "value": created_at
-        }]
-        for _id in ids:
-            self._container.patch_item(
-                item=_id, partition_key=_id, patch_operations=patch
-            )
+        """
+        textを更新する関数
+
+        新しいtextを分割したchunkと保存済みのchunkを本文のハッシュで比較し、
+        本文が変わらないchunkはidと埋め込みをそのまま使用してmetadataのみを更新します。
+        本文が変わったchunkのみ埋め込みを作成して書き込み、不要になったchunkは削除します。
+        """
+        condition = {"id": id} if group_id is None else {"metadata.group_id": group_id}
+        old_items = self.read_item(values=["id", "text", "metadata"], condition=condition)
+        created_at = next(
+            (item["metadata"].get("created_at") for item in old_items if item["id"] == id),
+            old_items[0]["metadata"].get("created_at"),
+        )
+
+        new_docs = _format_document(BulkDocument(text, text_type, title, source_id, metadata))
+        for doc in new_docs:
+            if group_id is not None and "group_id" in doc.metadata:
+                doc.metadata["group_id"] = group_id
+            if created_at is not None:
+                doc.metadata["created_at"] = created_at
+
+        # 本文のハッシュごとの保存済みのchunk。ハッシュのない以前のchunkは本文から計算する
+        reusable: dict[str, list[dict[str, Any]]] = {}
+        for item in old_items:
+            key = item["metadata"].get(CONTENT_HASH_KEY) or content_key(item["text"])
+            reusable.setdefault(key, []).append(item)
+
+        ids: list[str] = []
+        added: list[tuple[int, Document]] = []
+        patches: dict[str, list[dict[str, Any]]] = {}
+        for index, doc in enumerate(new_docs):
+            candidates = reusable.get(doc.metadata[CONTENT_HASH_KEY])
+            if not candidates:
+                ids.append("")
+                added.append((index, doc))
+                continue
+            item = candidates.pop(0)
+            ids.append(item["id"])
+            removed = [key for key in item["metadata"] if key not in doc.metadata]
+            patches[item["id"]] = self._create_patch(item["metadata"], doc.metadata, removed)
+        self._patch_items(patches)
+
+        if added:
+            vectors = self._document_embedding.embed_documents([doc.page_content for _, doc in added])
+            for (index, doc), vector in zip(added, vectors, strict=True):
+                ids[index] = str(uuid4())
+                self._container.upsert_item({
+                    "id": ids[index],
+                    self._text_key: doc.page_content,
+                    self._embedding_key: vector,
+                    self._metadata_key: doc.metadata,
+                })
+
+        deleted = [item["id"] for candidates in reusable.values() for item in candidates]
+        for _id in deleted:
+            self.delete_document_by_id(_id)
+        logger.info(
+            f"textを更新しました: 変更なし{len(new_docs) - len(added)}件, 追加{len(added)}件, 削除{len(deleted)}件"
+        )
         return ids
 
-    def read_all_documents(self) -> list[Document]:
-        """全てのdocumentsとIDを読み込む関数"""
+    def read_all_documents(self, with_metadata: bool = False, with_embedding: bool = False) -> list[Document]:
+        """
+        全てのdocumentsとIDを読み込む関数
+
+        Args:
+            with_metadata (bool, optional): metadataも読み込むか. Defaults to False.
+            with_embedding (bool, optional): 埋め込みも読み込み、metadataの`embedding`に格納するか. Defaults to False.
+        """
         logger.info("全てのdocumentsを読み込みます")
-        query = "SELECT c.id, c.text FROM c"
-        items = list(self._container.query_items(
-            query=query, enable_cross_partition_query=True)
-        )
-        docs: list[Document] = []
-        for item in items:
-            text = item["text"]
-            _id = item["id"]
-            docs.append(
-                Document(page_content=text, metadata={"id": _id})
-            )
-        return docs
+        return list(self.iter_all_documents(with_metadata, with_embedding))
+
+    def iter_document_pages(
+        self,
+        with_metadata: bool = False,
+        with_embedding: bool = False,
+        page_size: int = READ_PAGE_SIZE,
+        continuation_token: str | None = None,
+    ) -> Iterator[DocumentPage]:
+        """
+        全てのdocumentsとIDをページごとに読み込むジェネレータ
+
+        各ページの継続トークンを保存しておくと、中断した読み込みをそのページの次から再開できます。
+
+        Args:
+            with_metadata (bool, optional): metadataも読み込むか. Defaults to False.
+            with_embedding (bool, optional): 埋め込みも読み込み、metadataの`embedding`に格納するか. Defaults to False.
+            page_size (int, optional): 1ページのdocumentの上限. Defaults to READ_PAGE_SIZE.
+            continuation_token (str | None, optional): 前回の読み込みで返された継続トークン. Defaults to None.
+        """
+        values = ["id", self._text_key]
+        if with_metadata:
+            values.append(self._metadata_key)
+        if with_embedding:
+            values.append(self._embedding_key)
+        for page in self.iter_item_pages(values, page_size=page_size, continuation_token=continuation_token):
+            documents = [self._item_to_chunk(item, with_metadata, with_embedding) for item in page.items]
+            yield DocumentPage(documents, page.continuation_token)
+
+    def iter_all_documents(
+        self,
+        with_metadata: bool = False,
+        with_embedding: bool = False,
+        page_size: int = READ_PAGE_SIZE,
+    ) -> Iterator[Document]:
+        """全てのdocumentsとIDを1件ずつ読み込むジェネレータ。ページごとに問い合わせる"""
+        for page in self.iter_document_pages(with_metadata, with_embedding, page_size):
+            yield from page.documents
+
+    def _item_to_chunk(self, item: dict[str, Any], with_metadata: bool, with_embedding: bool) -> Document:
+        """読み込んだitemをDocumentに変換する関数。idと埋め込みはmetadataに格納する"""
+        metadata = dict(item.get(self._metadata_key) or {}) if with_metadata else {}
+        metadata["id"] = item["id"]
+        if with_embedding:
+            metadata[self._embedding_key] = item[self._embedding_key]
+        return Document(page_content=item[self._text_key], metadata=metadata)
 
     def get_source_by_id(self, id: str) -> str:
         """idを指定してsourceを取得する関数"""
@@ -333,12 +986,56 @@ class CosmosDBManager(AzureCosmosDBNoSqlVectorSearch):
         data = self.read_item(values=["id"], condition={"metadata.source_id": source_id})
         for d in data:
             self.delete_document_by_id(d["id"])
+        _notify_document_change(DocumentChange(action="delete", source_id=source_id))
+
+_cosmos_manager: _Lazy[CosmosDBManager] = _Lazy(CosmosDBManager)
+# イベントループごとの非同期クライアント
+_async_cosmos_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncCosmosClient] = (
+    weakref.WeakKeyDictionary()
+)
+_async_cosmos_lock = threading.Lock()
+
+
+def get_cosmos_manager() -> CosmosDBManager:
+    """
+    プロセス全体で共有するCosmosDBManagerを取得する関数
+
+    データベースとコンテナの確認は最初の呼び出し時に一度だけ行い、以降は同じインスタンスを再利用します。
+    """
+    return _cosmos_manager.get()
+
+
+async def aget_cosmos_client() -> AsyncCosmosClient:
+    """
+    実行中のイベントループで共有する非同期のCosmosClientを取得する関数
+
+    非同期クライアントの接続はイベントループに紐づくため、イベントループごとに一度だけ作成します。
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_cosmos_clients.get(loop)
+    if client is None:
+        new_client = AsyncCosmosClient(HOST, KEY)
+        await new_client.__aenter__()
+        with _async_cosmos_lock:
+            client = _async_cosmos_clients.setdefault(loop, new_client)
+        if client is not new_client:
+            await new_client.close()
+    return client
+
+
+async def aclose_cosmos_client() -> None:
+    """実行中のイベントループの非同期のCosmosClientを閉じる関数"""
+    with _async_cosmos_lock:
+        client = _async_cosmos_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
 
 if __name__ == "__main__":
     from sc_system_ai.logging_config import setup_logging
     setup_logging()
 
-    cosmos_manager = CosmosDBManager()
+    cosmos_manager = get_cosmos_manager()
     query = "京都テック"
     # results = cosmos_manager.read_all_documents()
     # results = cosmos_manager.similarity_search(query, k=1)
@@ -1,7 +1,6 @@
 import asyncio
 import logging
-from queue import Queue
-from typing import cast
+from typing import Any, cast
 
 from langchain_core.tools import BaseTool
 from pydantic import BaseModel, ConfigDict, Field
@@ -39,6 +38,11 @@ class CallingAgent(BaseTool):
         User(name="hogehoge", major="fugafuga専攻")
 )
     ```
+
+    - 複数のユーザーで使用する場合は、spawnメソッドでセッションごとのインスタンスを作成
+    ```python
+    tool = calling_dummy_agent.spawn(User(name="hogehoge", major="fugafuga専攻"))
+    ```
     """
 
     model_config = ConfigDict(
@@ -50,25 +54,20 @@ class CallingAgent(BaseTool):
     args_schema: type[BaseModel] = CallingAgentInput
     return_direct: bool = True
 
-    user_info: User = Field(description="ユーザー情報", default=User())
+    user_info: User = Field(description="ユーザー情報", default_factory=User)
     agent: type[Agent] = Agent
     # AgentResponseを保持する変数
-    response: AgentResponse = AgentResponse()
+    response: AgentResponse = Field(default_factory=AgentResponse)
 
     # ストリーミングのセットアップ
-    queue: Queue = Queue()
+    queue: asyncio.Queue = Field(default_factory=asyncio.Queue)
     is_streaming: bool = False
 
     def __init__(self) -> None:
         super().__init__()
 
-    def _run(
-            self,
-            user_input: str,
-        ) -> str:
-        logger.info(f"Calling Agent Toolが次の値で呼び出されました: {user_input}")
-
-        # エージェントの呼び出し
+    def _create_agent(self) -> Agent:
+        """呼び出すエージェントを作成する関数"""
         try:
             agent = self.agent(user_info=self.user_info)
             agent.queue = self.queue
@@ -77,16 +76,39 @@ class CallingAgent(BaseTool):
             raise e
         else:
             logger.debug(f"エージェントの呼び出しに成功しました: {self.agent}")
+        return agent
 
+    def _run(
+            self,
+            user_input: str,
+        ) -> str:
+        logger.info(f"Calling Agent Toolが次の値で呼び出されました: {user_input}")
+
+        # ストリーミング時は_arunから呼び出されるため、ここでは通常の呼び出しのみ行う
+        agent = self._create_agent()
+        resp = agent.invoke(user_input)
+        return self._handle_response(resp)
+
+    async def _arun(
+            self,
+            user_input: str,
+        ) -> str:
+        logger.info(f"Calling Agent Toolが次の値で呼び出されました: {user_input}")
+
+        # 呼び出し元と同じイベントループ上でエージェントを実行する
+        agent = self._create_agent()
         if self.is_streaming:
-            asyncio.run(agent.stream_on_tool(user_input))
+            await agent.stream_on_tool(user_input)
             resp = agent.get_response()
-            self.response = resp
         else:
-            resp = agent.invoke(user_input)
-            self.response = resp
-            if resp.error is not None:
-                return resp.error
+            resp = await agent.ainvoke(user_input)
+        return self._handle_response(resp)
+
+    def _handle_response(self, resp: AgentResponse) -> str:
+        """エージェントのレスポンスを保持し、ツールの出力を返す関数"""
+        self.response = resp
+        if not self.is_streaming and resp.error is not None:
+            return resp.error
         return cast(str, resp.output)
 
 
@@ -96,11 +118,28 @@ class CallingAgent(BaseTool):
         Args:
             user_info (User): ユーザー情報、Userクラスのインスタンス
         """
-        self.user_info.update_user(
-            name=user_info.name,
-            major=user_info.major,
-            conversations=user_info.conversations
-        )
+        self.user_info = user_info
+
+    def spawn(self, user_info: User) -> "CallingAgent":
+        """
+        セッションごとのツールを作成する関数
+
+        ツール情報を共有したまま、セッションごとの状態を初期化した複製を返します。
+        pydanticのバリデーションや__init__を再実行しないため、ツールの作成は軽量です。
+
+        Args:
+            user_info (User): セッションのユーザー情報
+        """
+        return self.model_copy(update=self._session_state(user_info))
+
+    def _session_state(self, user_info: User) -> dict[str, Any]:
+        """セッションごとに初期化する状態を返す関数"""
+        return {
+            "user_info": user_info,
+            "response": AgentResponse(),
+            "queue": asyncio.Queue(),
+            "is_streaming": False,
+        }
 
     def set_tool_info(
             self,
@@ -119,7 +158,7 @@ class CallingAgent(BaseTool):
         self.description = description
         self.agent = agent
 
-    def setup_streaming(self, queue: Queue) -> None:
+    def setup_streaming(self, queue: asyncio.Queue) -> None:
         """ストリーミングのセットアップ"""
         self.is_streaming = True
         self.queue = queue
@@ -127,7 +166,20 @@ class CallingAgent(BaseTool):
     def cancel_streaming(self) -> None:
         """ストリーミングのキャンセル"""
         self.is_streaming = False
-        self.queue = Queue()
+        self.queue = asyncio.Queue()
+
+
+def create_session_tools(tools: list, user_info: User) -> list:
+    """
+    セッションごとのツールのリストを作成する関数
+
+    CallingAgentはプロトタイプからセッションごとのインスタンスを作成し、
+    状態を持たないその他のツールはそのまま共有します。
+    """
+    return [
+        tool.spawn(user_info) if isinstance(tool, CallingAgent) else tool
+        for tool in tools
+    ]
 
 
 calling_agent = CallingAgent()
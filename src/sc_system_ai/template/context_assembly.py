@@ -0,0 +1,238 @@
+"""
+### 検索結果からプロンプトに含める学校の情報を組み立てるモジュール
+
+スコア付きの検索結果から、以下の手順でプロンプトに含める情報を作成します。
+1. スコアがしきい値未満の結果を除く
+2. 同じdocument(同じid、または同じ`group_id`と`section_number`)の重複を除く
+3. 同じ`group_id`で`section_number`が連続するchunkを1つにまとめ、分割時に重複した部分を取り除く
+4. スコアの高い順に、トークン数の上限に収まるだけ含める
+
+class:
+    - ContextPolicy(組み立ての設定)
+    - AssembledContext(組み立てた情報と集計)
+
+function:
+    - assemble_context(検索結果からプロンプトに含める情報を組み立てる関数)
+
+使用例：
+```python
+results = get_cosmos_manager().similarity_search_with_score("公欠届", k=6)
+context = assemble_context(results, ContextPolicy(min_score=0.3, max_tokens=1500))
+print(context.text, context.used_tokens)
+```
+"""
+import logging
+from collections.abc import Callable, Sequence
+from functools import cache
+
+import tiktoken
+from langchain_core.documents import Document
+from pydantic import BaseModel, Field
+
+from sc_system_ai.template.document_formatter import CHUNK_OVERLAP
+from sc_system_ai.template.hybrid_search import document_key
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_SCORE = 0.3
+DEFAULT_MAX_TOKENS = 1500
+DEFAULT_FETCH_K = 6
+
+
+@cache
+def _get_encoding(name: str) -> tiktoken.Encoding | None:
+    """tiktokenのエンコーディングを取得する関数。取得できない場合はNoneを返す"""
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logger.warning(f"tiktokenのエンコーディングを取得できないため、文字数をトークン数とみなします: {e}")
+        return None
+
+
+class ContextPolicy(BaseModel):
+    """
+    検索結果からプロンプトに含める情報を組み立てる設定
+
+    Args:
+        fetch_k (int): 検索で取得する件数. Defaults to 6.
+        min_score (float | None): 含める結果の最小のスコア. Noneの場合は除かない. Defaults to 0.3.
+        max_tokens (int | None): 含める情報のトークン数の上限. Noneの場合は制限しない. Defaults to 1500.
+        encoding (str): トークン数の計測に使用するtiktokenのエンコーディング
+        token_counter (Callable | None): tiktokenの代わりにトークン数を計測する関数
+
+    スコアのない検索結果(ハイブリッド検索など)はしきい値で除かず、検索結果の順に扱います。
+    """
+    fetch_k: int = Field(default=DEFAULT_FETCH_K, description="検索で取得する件数")
+    min_score: float | None = Field(default=DEFAULT_MIN_SCORE, description="含める結果の最小のスコア")
+    max_tokens: int | None = Field(default=DEFAULT_MAX_TOKENS, description="含める情報のトークン数の上限")
+    encoding: str = Field(default="o200k_base", description="トークン数の計測に使用するtiktokenのエンコーディング")
+    token_counter: Callable[[str], int] | None = Field(
+        default=None, exclude=True, description="tiktokenの代わりにトークン数を計測する関数"
+    )
+
+    def count_tokens(self, text: str) -> int:
+        """テキストのトークン数を計測する関数"""
+        if self.token_counter is not None:
+            return self.token_counter(text)
+        encoding = _get_encoding(self.encoding)
+        return len(text) if encoding is None else len(encoding.encode(text))
+
+
+class AssembledContext(BaseModel):
+    """組み立てた学校の情報と集計"""
+    text: str = Field(default="", description="プロンプトに含める情報")
+    source_ids: list[int] = Field(default_factory=list, description="含めたdocumentのsource_id")
+    sections: int = Field(default=0, description="含めたまとまりの数")
+    used_tokens: int = Field(default=0, description="含めた情報のトークン数")
+    dropped_by_score: int = Field(default=0, description="スコアがしきい値未満のため除いた結果の数")
+    duplicates: int = Field(default=0, description="重複のため除いた結果の数")
+    merged: int = Field(default=0, description="隣接するchunkとまとめた結果の数")
+    dropped_by_budget: int = Field(default=0, description="トークン数の上限を超えるため除いた結果の数")
+
+
+class _Section:
+    """連続するchunkをまとめたもの"""
+    def __init__(self, document: Document, score: float | None, rank: int) -> None:
+        self.documents = [document]
+        self.score = score
+        self.rank = rank
+
+    @property
+    def title(self) -> str:
+        return str(self.documents[0].metadata.get("title", ""))
+
+    @property
+    def text(self) -> str:
+        text = self.documents[0].page_content
+        for document in self.documents[1:]:
+            text = _join_overlapping(text, document.page_content)
+        return text
+
+    def format(self) -> str:
+        return f"### {self.title}\n{self.text}\n"
+
+    def sort_key(self) -> tuple[bool, float, int]:
+        # スコアのある結果を先に、スコアの高い順、同じ場合は検索結果の順
+        return (self.score is None, -(self.score or 0.0), self.rank)
+
+
+def _join_overlapping(head: str, tail: str) -> str:
+    """分割時に重複した部分を取り除いて2つのchunkを結合する関数"""
+    for size in range(min(len(head), len(tail), CHUNK_OVERLAP), 0, -1):
+        if head.endswith(tail[:size]):
+            return head + tail[size:]
+    return head + "\n" + tail
+
+
+def _section_number(document: Document) -> int | None:
+    number = document.metadata.get("section_number")
+    return number if isinstance(number, int) else None
+
+
+def _deduplicate(
+    results: Sequence[tuple[Document, float | None]],
+) -> tuple[list[tuple[Document, float | None, int]], int]:
+    """同じdocumentの重複を除く関数。スコアの高い方、同じ場合は先に現れた方を残す"""
+    best: dict[tuple[object, ...], tuple[Document, float | None, int]] = {}
+    for rank, (document, score) in enumerate(results):
+        group_id = document.metadata.get("group_id")
+        number = _section_number(document)
+        key: tuple[object, ...] = (group_id, number) if group_id is not None and number is not None else (
+            document_key(document),
+        )
+        current = best.get(key)
+        if current is None or (score is not None and (current[1] is None or score > current[1])):
+            best[key] = (document, score, current[2] if current is not None else rank)
+    return list(best.values()), len(results) - len(best)
+
+
+def _merge_adjacent(results: list[tuple[Document, float | None, int]]) -> tuple[list[_Section], int]:
+    """同じgroup_idで連続するchunkをまとめる関数"""
+    sections: list[_Section] = []
+    groups: dict[str, list[tuple[Document, float | None, int]]] = {}
+    for document, score, rank in results:
+        group_id = document.metadata.get("group_id")
+        if group_id is None or _section_number(document) is None:
+            sections.append(_Section(document, score, rank))
+        else:
+            groups.setdefault(str(group_id), []).append((document, score, rank))
+
+    merged = 0
+    for chunks in groups.values():
+        chunks.sort(key=lambda chunk: _section_number(chunk[0]) or 0)
+        current: _Section | None = None
+        previous = 0
+        for document, score, rank in chunks:
+            number = _section_number(document) or 0
+            if current is not None and number == previous + 1:
+                current.documents.append(document)
+                if score is not None and (current.score is None or score > current.score):
+                    current.score = score
+                current.rank = min(current.rank, rank)
+                merged += 1
+            else:
+                current = _Section(document, score, rank)
+                sections.append(current)
+            previous = number
+    return sections, merged
+
+
+def assemble_context(
+    results: Sequence[tuple[Document, float | None]],
+    policy: ContextPolicy | None = None,
+) -> AssembledContext:
+    """
+    スコア付きの検索結果からプロンプトに含める情報を組み立てる関数
+
+    Args:
+        results (Sequence[tuple[Document, float | None]]): 検索結果とスコア. スコアがない場合はNone
+        policy (ContextPolicy | None, optional): 組み立ての設定. Defaults to ContextPolicy().
+    """
+    policy = policy if policy is not None else ContextPolicy()
+    kept = [
+        (document, score) for document, score in results
+        if policy.min_score is None or score is None or score >= policy.min_score
+    ]
+    deduplicated, duplicates = _deduplicate(kept)
+    sections, merged = _merge_adjacent(deduplicated)
+    sections.sort(key=_Section.sort_key)
+
+    parts: list[str] = []
+    source_ids: list[int] = []
+    used_tokens = 0
+    dropped_by_budget = 0
+    # まとめたchunkが上限を超える場合は、chunkごとに収まるものを含める
+    candidates = list(sections)
+    while candidates:
+        section = candidates.pop(0)
+        text = section.format()
+        tokens = policy.count_tokens(text)
+        if policy.max_tokens is not None and used_tokens + tokens > policy.max_tokens:
+            if len(section.documents) > 1:
+                candidates[0:0] = [_Section(doc, section.score, section.rank) for doc in section.documents]
+            else:
+                dropped_by_budget += 1
+            continue
+        parts.append(text)
+        used_tokens += tokens
+        for document in section.documents:
+            source_id = document.metadata.get("source_id")
+            if isinstance(source_id, int) and source_id not in source_ids:
+                source_ids.append(source_id)
+
+    context = AssembledContext(
+        text="".join(parts),
+        source_ids=source_ids,
+        sections=len(parts),
+        used_tokens=used_tokens,
+        dropped_by_score=len(results) - len(kept),
+        duplicates=duplicates,
+        merged=merged,
+        dropped_by_budget=dropped_by_budget,
+    )
+    logger.info(
+        f"学校の情報を組み立てました: {context.sections}件 {context.used_tokens}トークン "
+        f"(スコア不足: {context.dropped_by_score}, 重複: {context.duplicates}, "
+        f"結合: {context.merged}, 上限超過: {context.dropped_by_budget})"
+    )
+    return context
@@ -0,0 +1,44 @@
+from os import linesep
+
+from sc_system_ai.template.ai_settings import llm
+
+summary_prompt = """
+# タスク
+以下に与える「これまでの要約」と「新しい会話」をまとめ、会話の要約を作成してください。
+要約は次の会話でアシスタントが参照するため、以下の基準に従ってください。
+
+## 基準
+1. ユーザーの目的や質問、アシスタントが回答した内容を残してください。
+2. 名前や日付、手続き名などの固有の情報は省略しないでください。
+3. 300文字以内の日本語で簡潔にまとめてください。
+
+## これまでの要約
+{summary}
+
+## 新しい会話
+"""
+
+def create_prompt(summary: str, conversation: list[tuple[str, str]]) -> str:
+    prompt = summary_prompt.format(summary=summary or "なし")
+    for role, message in conversation:
+        prompt += f"{role}: {message}{linesep}"
+    return prompt
+
+def summarize_conversation(summary: str, conversation: list[tuple[str, str]]) -> str:
+    """これまでの要約に新しい会話を追加した要約を作成する関数"""
+    prompt = create_prompt(summary, conversation)
+    result = llm.invoke(prompt)
+
+    if isinstance(result.content, str):
+        return result.content
+    else:
+        raise RuntimeError("会話の要約に失敗しました")
+
+
+if __name__ == "__main__":
+    con = [
+        ("human", "公欠届を提出したいです。"),
+        ("ai", "承知しました。公欠届の提出についてお手伝いします。まずは名前を教えてください。"),
+    ]
+
+    print(summarize_conversation("", con))
@@ -0,0 +1,385 @@
+"""
+### 埋め込みベクトルのキャッシュを定義するモジュール
+
+class:
+    - SQLiteEmbeddingStore(テキストのハッシュをキーに埋め込みをSQLiteに保存するストア)
+    - CachedEmbeddings(LRUとストアで埋め込みを再利用するEmbeddings)
+    - ContentAddressedEmbeddings(chunkの本文のハッシュで埋め込みを再利用するEmbeddings)
+
+環境変数:
+    - QUERY_EMBEDDING_CACHE_SIZE: 検索ワードの埋め込みをメモリ上に保持する件数. Defaults to 1024
+    - QUERY_EMBEDDING_STORE_PATH: 検索ワードの埋め込みを保存するファイルのパス. 指定しない場合はファイルに保存しない
+
+使用例：
+```python
+store = SQLiteEmbeddingStore("cache/query_embeddings.sqlite3")
+cached = CachedEmbeddings(embeddings, max_size=1024, store=store, namespace="text-embedding-3-small")
+
+vector = cached.embed_query("京都テック 専攻")  # 埋め込みモデルを呼び出す
+vector = cached.embed_query("京都テック 専攻")  # キャッシュから取得する
+print(cached.stats())
+
+documents = ContentAddressedEmbeddings(embeddings, SQLiteEmbeddingStore("cache/document_embeddings.sqlite3"))
+vectors = documents.embed_documents(["お問い合わせは事務局まで", "公欠届について"])  # 保存済みの本文は呼び出さない
+```
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+from pathlib import Path
+from typing import TypedDict, cast
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(text: str, namespace: str = "") -> str:
+    """テキストと名前空間(モデル名など)からストアのキーを作成する関数"""
+    return hashlib.sha256(f"{namespace}\x00{text}".encode()).hexdigest()
+
+
+class SQLiteEmbeddingStore:
+    """
+    キーと埋め込みの対応をSQLiteに保存するストア
+
+    Args:
+        path (str | Path): 保存先のデータベースファイルのパス
+
+    キーとfloat32のベクトルを同じ行に保存し、`put_many`は1回のトランザクションで書き込みます。
+    複数のプロセスが同じファイルに同時に書き込んだり、書き込みが中断されたりしても、キーとベクトルの対応は崩れません。
+    """
+    # 1回のクエリで指定するキーの最大数(SQLiteの変数の上限より小さくする)
+    _QUERY_CHUNK = 500
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        # 読み込みと書き込みが互いを待たないようにする
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, dim INTEGER NOT NULL, vector BLOB NOT NULL)"
+            )
+        row = self._conn.execute("SELECT dim FROM embeddings LIMIT 1").fetchone()
+        self._dim: int | None = row[0] if row else None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return cast(int, self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0])
+
+    def __contains__(self, key: object) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM embeddings WHERE key = ?", (key,)).fetchone() is not None
+
+    def close(self) -> None:
+        """データベースへの接続を閉じる関数"""
+        with self._lock:
+            self._conn.close()
+
+    def _decode(self, key: str, dim: int, blob: bytes) -> np.ndarray | None:
+        """行をベクトルに変換する関数。次元数とバイト数が一致しない行は無視する"""
+        if dim != self._dim or len(blob) != 4 * dim:
+            logger.warning(f"埋め込みのストアの壊れた行を無視します: {key}")
+            return None
+        return np.frombuffer(blob, dtype=np.float32).copy()
+
+    def get(self, key: str) -> np.ndarray | None:
+        """キーに対応するベクトルを取得する関数"""
+        return self.get_many([key])[0]
+
+    def get_many(self, keys: list[str]) -> list[np.ndarray | None]:
+        """複数のキーに対応するベクトルをまとめて取得する関数"""
+        found: dict[str, np.ndarray | None] = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            for i in range(0, len(unique), self._QUERY_CHUNK):
+                chunk = unique[i:i + self._QUERY_CHUNK]
+                rows = self._conn.execute(
+                    f"SELECT key, dim, vector FROM embeddings WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                if rows and self._dim is None:
+                    # 他のプロセスが最初のベクトルを保存した場合
+                    self._dim = rows[0][1]
+                found.update((key, self._decode(key, dim, blob)) for key, dim, blob in rows)
+        return [found.get(key) for key in keys]
+
+    def put(self, key: str, vector: list[float] | np.ndarray) -> None:
+        """ベクトルを保存する関数"""
+        self.put_many([key], [vector])
+
+    def put_many(self, keys: list[str], vectors: Sequence[list[float] | np.ndarray]) -> None:
+        """複数のベクトルをまとめて保存する関数。保存済みのキーは無視する"""
+        new: dict[str, np.ndarray] = {}
+        for key, vector in zip(keys, vectors, strict=True):
+            new.setdefault(key, np.asarray(vector, dtype=np.float32))
+        if not new:
+            return
+        with self._lock:
+            if self._dim is None:
+                # 他のプロセスが先に保存したベクトルの次元数に合わせる
+                row = self._conn.execute("SELECT dim FROM embeddings LIMIT 1").fetchone()
+                self._dim = row[0] if row else next(iter(new.values())).shape[0]
+            for vector in new.values():
+                if vector.shape[0] != self._dim:
+                    raise ValueError(f"ベクトルの次元数が一致しません: {vector.shape[0]} != {self._dim}")
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, dim, vector) VALUES (?, ?, ?)",
+                    [(key, self._dim, vector.tobytes()) for key, vector in new.items()],
+                )
+
+
+class EmbeddingCacheStats(TypedDict):
+    hits: int
+    store_hits: int
+    misses: int
+    hit_rate: float
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    検索クエリの埋め込みを再利用するEmbeddings
+
+    Args:
+        embedding (Embeddings): 埋め込みモデル
+        max_size (int, optional): メモリ上に保持する件数. Defaults to 1024.
+        store (SQLiteEmbeddingStore | None, optional): 埋め込みを保存するストア. Defaults to None.
+        namespace (str, optional): ストアのキーに含める名前空間. モデルごとに変更してください. Defaults to "".
+
+    `embed_query`の結果をLRUで保持し、ストアを指定した場合はファイルにも保存します。
+    `embed_documents`はそのまま埋め込みモデルを呼び出します。
+    """
+    def __init__(
+        self,
+        embedding: Embeddings,
+        max_size: int = 1024,
+        store: SQLiteEmbeddingStore | None = None,
+        namespace: str = "",
+    ) -> None:
+        self.embedding = embedding
+        self.max_size = max_size
+        self.store = store
+        self.namespace = namespace
+        self._lru: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def _from_memory(self, text: str) -> list[float] | None:
+        """メモリ上のLRUから埋め込みを取得する関数"""
+        with self._lock:
+            vector = self._lru.get(text)
+            if vector is not None:
+                self._lru.move_to_end(text)
+                self.hits += 1
+            return vector
+
+    def _from_store(self, texts: list[str]) -> list[list[float] | None]:
+        """ストアから埋め込みを取得する関数。見つからないテキストはミスとして数える"""
+        vectors: list[list[float] | None] = [None] * len(texts)
+        if self.store is not None:
+            stored = self.store.get_many([content_key(text, self.namespace) for text in texts])
+            vectors = [None if vector is None else cast(list[float], vector.tolist()) for vector in stored]
+        found = [(text, vector) for text, vector in zip(texts, vectors, strict=True) if vector is not None]
+        for text, vector in found:
+            self._remember(text, vector, persist=False)
+        with self._lock:
+            self.store_hits += len(found)
+            self.misses += len(texts) - len(found)
+        return vectors
+
+    def _cached(self, texts: list[str]) -> list[list[float] | None]:
+        """メモリ上、またはストアから埋め込みを取得する関数"""
+        vectors = [self._from_memory(text) for text in texts]
+        pending = [i for i, vector in enumerate(vectors) if vector is None]
+        if pending:
+            for i, vector in zip(pending, self._from_store([texts[i] for i in pending]), strict=True):
+                vectors[i] = vector
+        return vectors
+
+    async def _acached(self, texts: list[str]) -> list[list[float] | None]:
+        """メモリ上のLRUはそのまま参照し、ストアはイベントループを止めないよう別スレッドで参照する関数"""
+        vectors = [self._from_memory(text) for text in texts]
+        pending = [i for i, vector in enumerate(vectors) if vector is None]
+        if pending:
+            missing = [texts[i] for i in pending]
+            stored = (
+                await asyncio.to_thread(self._from_store, missing) if self.store is not None
+                else self._from_store(missing)
+            )
+            for i, vector in zip(pending, stored, strict=True):
+                vectors[i] = vector
+        return vectors
+
+    def _remember(self, text: str, vector: list[float], persist: bool = True) -> None:
+        """埋め込みをメモリ上とストアに保存する関数"""
+        with self._lock:
+            self._lru[text] = vector
+            self._lru.move_to_end(text)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+        if persist and self.store is not None:
+            self.store.put(content_key(text, self.namespace), vector)
+
+    def embed_query(self, text: str) -> list[float]:
+        vector = self._cached([text])[0]
+        if vector is None:
+            vector = self.embedding.embed_query(text)
+            self._remember(text, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        vector = (await self._acached([text]))[0]
+        if vector is None:
+            vector = await self.embedding.aembed_query(text)
+            await self._aremember_many([text], [vector])
+        return vector
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """複数の検索クエリの埋め込みを取得する関数。キャッシュにないクエリは1回の呼び出しでまとめて埋め込む"""
+        vectors = self._cached(texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors, strict=True) if vector is None))
+        embedded = self._remember_many(missing, self.embedding.embed_documents(missing)) if missing else {}
+        return [vector if vector is not None else embedded[text] for text, vector in zip(texts, vectors, strict=True)]
+
+    async def aembed_queries(self, texts: list[str]) -> list[list[float]]:
+        """複数の検索クエリの埋め込みを非同期で取得する関数"""
+        vectors = await self._acached(texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors, strict=True) if vector is None))
+        embedded: dict[str, list[float]] = {}
+        if missing:
+            embedded = await self._aremember_many(missing, await self.embedding.aembed_documents(missing))
+        return [vector if vector is not None else embedded[text] for text, vector in zip(texts, vectors, strict=True)]
+
+    def _remember_many(self, texts: list[str], vectors: list[list[float]]) -> dict[str, list[float]]:
+        """複数の埋め込みをメモリ上とストアに保存し、テキストと埋め込みの対応を返す関数"""
+        for text, vector in zip(texts, vectors, strict=True):
+            self._remember(text, vector, persist=False)
+        if self.store is not None:
+            self.store.put_many([content_key(text, self.namespace) for text in texts], vectors)
+        return dict(zip(texts, vectors, strict=True))
+
+    async def _aremember_many(self, texts: list[str], vectors: list[list[float]]) -> dict[str, list[float]]:
+        """複数の埋め込みをメモリ上に保存し、ストアへの書き込みは別スレッドで行う関数"""
+        for text, vector in zip(texts, vectors, strict=True):
+            self._remember(text, vector, persist=False)
+        if self.store is not None:
+            keys = [content_key(text, self.namespace) for text in texts]
+            await asyncio.to_thread(self.store.put_many, keys, vectors)
+        return dict(zip(texts, vectors, strict=True))
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embedding.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.embedding.aembed_documents(texts)
+
+    def stats(self) -> EmbeddingCacheStats:
+        """メモリ上のヒット数、ストアのヒット数、ミス数、ヒット率を取得する関数"""
+        with self._lock:
+            total = self.hits + self.store_hits + self.misses
+            return {
+                "hits": self.hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.store_hits) / total if total else 0.0,
+            }
+
+
+class ContentAddressedEmbeddings(Embeddings):
+    """
+    documentのchunkの埋め込みを本文のハッシュで再利用するEmbeddings
+
+    Args:
+        embedding (Embeddings): 埋め込みモデル
+        store (SQLiteEmbeddingStore): 埋め込みを保存するストア
+        namespace (str, optional): ストアのキーに含める名前空間. 埋め込みのデプロイ名を指定してください. Defaults to "".
+
+    `embed_documents`はストアに保存済みの本文を除き、残りを1回の呼び出しでまとめて埋め込みます。
+    ヘッダーや注意書きのように多くのdocumentに現れる同じ本文や、再登録するdocumentは埋め込みモデルを呼び出しません。
+    """
+    def __init__(self, embedding: Embeddings, store: SQLiteEmbeddingStore, namespace: str = "") -> None:
+        self.embedding = embedding
+        self.store = store
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _split(self, texts: list[str]) -> tuple[list[list[float] | None], list[str], list[str]]:
+        """保存済みの埋め込みと、埋め込みが必要な本文とそのキーを取得する関数"""
+        keys = [content_key(text, self.namespace) for text in texts]
+        vectors: list[list[float] | None] = [
+            None if stored is None else cast(list[float], stored.tolist()) for stored in self.store.get_many(keys)
+        ]
+        missing = {key: text for key, text, vector in zip(keys, texts, vectors, strict=True) if vector is None}
+        with self._lock:
+            self.hits += len(texts) - sum(vector is None for vector in vectors)
+            self.misses += len(missing)
+        return vectors, list(missing.values()), list(missing)
+
+    @staticmethod
+    def _join(
+        texts: list[str],
+        vectors: list[list[float] | None],
+        embedded: dict[str, list[float]],
+    ) -> list[list[float]]:
+        return [vector if vector is not None else embedded[text] for text, vector in zip(texts, vectors, strict=True)]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors, missing, keys = self._split(texts)
+        embedded: dict[str, list[float]] = {}
+        if missing:
+            new = self.embedding.embed_documents(missing)
+            self.store.put_many(keys, new)
+            embedded = dict(zip(missing, new, strict=True))
+        return self._join(texts, vectors, embedded)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        # ストアの読み書きはイベントループを止めないよう別スレッドで行う
+        vectors, missing, keys = await asyncio.to_thread(self._split, texts)
+        embedded: dict[str, list[float]] = {}
+        if missing:
+            new = await self.embedding.aembed_documents(missing)
+            await asyncio.to_thread(self.store.put_many, keys, new)
+            embedded = dict(zip(missing, new, strict=True))
+        return self._join(texts, vectors, embedded)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embedding.embed_query(text)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await self.embedding.aembed_query(text)
+
+    def stats(self) -> EmbeddingCacheStats:
+        """ストアのヒット数、ミス数、ヒット率を取得する関数"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": 0,
+                "store_hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+def create_query_embeddings(embedding: Embeddings, namespace: str = "") -> CachedEmbeddings:
+    """環境変数の設定から検索クエリ用のCachedEmbeddingsを作成する関数"""
+    store_path = os.environ.get("QUERY_EMBEDDING_STORE_PATH")
+    return CachedEmbeddings(
+        embedding,
+        max_size=int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", "1024")),
+        store=SQLiteEmbeddingStore(store_path) if store_path else None,
+        namespace=namespace,
+    )
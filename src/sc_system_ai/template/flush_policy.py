@@ -0,0 +1,176 @@
+"""
+### ストリーミング時のチャンク送出ポリシーを定義するモジュール
+
+class:
+    - FlushPolicy(送出ポリシーの基底クラス)
+    - CharacterCountFlushPolicy(文字数で送出するポリシー)
+    - MaxWaitFlushPolicy(最大待ち時間で送出するポリシー)
+    - SentenceBoundaryFlushPolicy(文の区切りで送出するポリシー)
+    - AnyFlushPolicy(いずれかのポリシーを満たした時点で送出するポリシー)
+    - ChunkBuffer(トークンを溜めてポリシーに従い送出するバッファ)
+
+使用例：
+```python
+# 20文字溜まるか、文の区切りか、最初のトークンから200ms経過した時点で送出する
+policy = create_flush_policy(return_length=20, max_wait_ms=200, sentence_boundary=True)
+
+async for resp in chat.stream(message, flush_policy=policy):
+    print(resp)
+```
+"""
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Iterable
+
+# 日本語の文の区切り
+SENTENCE_BOUNDARIES = ("。", "！", "？", "!", "?", "\n")
+
+
+class FlushPolicy(ABC):
+    """
+    チャンクを送出するタイミングを決める基底クラス
+
+    `should_flush`はトークンを追加するたびに呼び出され、Trueを返すとバッファの内容を送出します。
+    `timeout`が秒数を返す場合、その時間内に次のトークンが届かなければバッファの内容を送出します。
+    """
+    @abstractmethod
+    def should_flush(self, token: str, length: int, elapsed: float) -> bool:
+        """
+        チャンクを送出するか判定する関数
+
+        Args:
+            token (str): 最後に追加されたトークン
+            length (int): バッファの文字数
+            elapsed (float): バッファに最初のトークンが追加されてからの経過時間(秒)
+        """
+
+    def timeout(self, elapsed: float) -> float | None:
+        """次のトークンを待つ最大時間(秒)を返す関数。Noneの場合は無制限に待つ"""
+        return None
+
+
+class CharacterCountFlushPolicy(FlushPolicy):
+    """
+    指定した文字数以上溜まった時点で送出するポリシー
+
+    Args:
+        return_length (int): 送出する文字数. Defaults to 5.
+    """
+    def __init__(self, return_length: int = 5):
+        self.return_length = return_length
+
+    def should_flush(self, token: str, length: int, elapsed: float) -> bool:
+        return length >= self.return_length
+
+
+class MaxWaitFlushPolicy(FlushPolicy):
+    """
+    最初のトークンから指定した時間が経過した時点で送出するポリシー
+
+    Args:
+        max_wait_ms (float): 最大待ち時間(ミリ秒)
+    """
+    def __init__(self, max_wait_ms: float):
+        self.max_wait = max_wait_ms / 1000
+
+    def should_flush(self, token: str, length: int, elapsed: float) -> bool:
+        return elapsed >= self.max_wait
+
+    def timeout(self, elapsed: float) -> float | None:
+        return max(self.max_wait - elapsed, 0.0)
+
+
+class SentenceBoundaryFlushPolicy(FlushPolicy):
+    """
+    文の区切り(。！？と改行)が現れた時点で送出するポリシー
+
+    Args:
+        boundaries (Iterable[str], optional): 区切り文字. Defaults to SENTENCE_BOUNDARIES.
+        min_length (int, optional): 送出する最小の文字数. Defaults to 1.
+    """
+    def __init__(self, boundaries: Iterable[str] = SENTENCE_BOUNDARIES, min_length: int = 1):
+        self.boundaries = tuple(boundaries)
+        self.min_length = min_length
+
+    def should_flush(self, token: str, length: int, elapsed: float) -> bool:
+        return length >= self.min_length and any(b in token for b in self.boundaries)
+
+
+class AnyFlushPolicy(FlushPolicy):
+    """いずれかのポリシーを満たした時点で送出するポリシー"""
+    def __init__(self, *policies: FlushPolicy):
+        self.policies = policies
+
+    def should_flush(self, token: str, length: int, elapsed: float) -> bool:
+        return any(p.should_flush(token, length, elapsed) for p in self.policies)
+
+    def timeout(self, elapsed: float) -> float | None:
+        timeouts = [t for p in self.policies if (t := p.timeout(elapsed)) is not None]
+        return min(timeouts) if timeouts else None
+
+
+def create_flush_policy(
+    return_length: int | None = 5,
+    max_wait_ms: float | None = None,
+    sentence_boundary: bool = False,
+) -> FlushPolicy:
+    """
+    設定値から送出ポリシーを作成する関数
+
+    Args:
+        return_length (int | None, optional): 送出する文字数. Defaults to 5.
+        max_wait_ms (float | None, optional): 最大待ち時間(ミリ秒). Defaults to None.
+        sentence_boundary (bool, optional): 文の区切りで送出するか. Defaults to False.
+    """
+    policies: list[FlushPolicy] = []
+    if return_length is not None:
+        policies.append(CharacterCountFlushPolicy(return_length))
+    if max_wait_ms is not None:
+        policies.append(MaxWaitFlushPolicy(max_wait_ms))
+    if sentence_boundary:
+        policies.append(SentenceBoundaryFlushPolicy())
+    if not policies:
+        raise ValueError("送出ポリシーを1つ以上指定してください")
+    return policies[0] if len(policies) == 1 else AnyFlushPolicy(*policies)
+
+
+class ChunkBuffer:
+    """
+    トークンを溜め、送出ポリシーに従ってチャンクにまとめるバッファ
+
+    Args:
+        policy (FlushPolicy): 送出ポリシー
+    """
+    def __init__(self, policy: FlushPolicy):
+        self.policy = policy
+        self._tokens: list[str] = []
+        self._length = 0
+        self._started: float | None = None
+
+    def __bool__(self) -> bool:
+        return bool(self._tokens)
+
+    def _elapsed(self) -> float:
+        return 0.0 if self._started is None else time.monotonic() - self._started
+
+    def append(self, token: str) -> bool:
+        """トークンを追加し、送出するべきかを返す関数"""
+        if self._started is None:
+            self._started = time.monotonic()
+        self._tokens.append(token)
+        self._length += len(token)
+        return self.policy.should_flush(token, self._length, self._elapsed())
+
+    def timeout(self) -> float | None:
+        """次のトークンを待つ最大時間(秒)を返す関数"""
+        if not self._tokens:
+            return None
+        return self.policy.timeout(self._elapsed())
+
+    def flush(self) -> str:
+        """バッファの内容を結合して返し、バッファを空にする関数"""
+        chunk = "".join(self._tokens)
+        self._tokens.clear()
+        self._length = 0
+        self._started = None
+        return chunk
@@ -0,0 +1,411 @@
+"""
+### 文字n-gramのBM25とベクトル検索を組み合わせたハイブリッド検索を定義するモジュール
+
+ベクトル検索は「公欠届」や専攻名、科目名などの語句が完全に一致するdocumentを取りこぼすことがあります。
+`document_formatter`で分割したchunkのタイトルと本文を文字bigram、trigramに分割してBM25で検索し、
+ベクトル検索の結果とReciprocal Rank Fusion(RRF)で統合します。
+日本語は単語の区切りがないため、形態素解析を使わず文字n-gramで索引を作成します。
+
+class:
+    - BM25Index(文字n-gramの転置インデックスによるBM25検索)
+    - HybridSearcher(BM25とベクトル検索を統合する検索)
+
+function:
+    - char_ngrams(テキストを文字n-gramに分割する関数)
+    - reciprocal_rank_fusion(複数の検索結果をRRFで統合する関数)
+    - get_hybrid_searcher(既定のHybridSearcherを取得する関数)
+
+使用例：
+```python
+index = BM25Index()
+index.add_documents(md_formatter(text, title="公欠届について", metadata={"source_id": 1}))
+print(index.search("公欠届 提出", k=3))
+
+searcher = get_hybrid_searcher()
+docs = searcher.search("公欠届の提出期限", k=2)
+```
+"""
+import asyncio
+import logging
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+from collections.abc import Iterable, Sequence
+from functools import cache
+from typing import Any, Protocol, cast
+
+import numpy as np
+from langchain_core.documents import Document
+
+from sc_system_ai.template.azure_cosmos import DocumentChange, add_document_change_listener, get_cosmos_manager
+from sc_system_ai.template.local_vector_index import DEFAULT_REFRESH_INTERVAL, get_local_index
+
+logger = logging.getLogger(__name__)
+
+NGRAM_SIZES = (2, 3)
+RRF_K = 60
+DEFAULT_FETCH_K = 10
+
+# 空白と記号(「」、。など)で区切る
+_SEPARATOR = re.compile(r"[\W_]+")
+
+
+def char_ngrams(text: str, sizes: Sequence[int] = NGRAM_SIZES) -> list[str]:
+    """
+    テキストを文字n-gramに分割する関数
+
+    NFKCで正規化し(全角英数字を半角に揃える)、空白と記号で区切った各部分をn-gramに分割します。
+    最小のnより短い部分はそのまま1つの語として扱います。
+    """
+    terms: list[str] = []
+    min_size = min(sizes)
+    for segment in _SEPARATOR.split(unicodedata.normalize("NFKC", text).lower()):
+        if not segment:
+            continue
+        if len(segment) < min_size:
+            terms.append(segment)
+            continue
+        for n in sizes:
+            terms.extend(segment[i:i + n] for i in range(len(segment) - n + 1))
+    return terms
+
+
+def document_key(document: Document) -> str:
+    """検索結果の重複を判定するキーを取得する関数"""
+    return str(document.metadata.get("id", document.page_content))
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[Document]],
+    k: int = RRF_K,
+    top_n: int | None = None,
+) -> list[tuple[Document, float]]:
+    """
+    複数の検索結果をReciprocal Rank Fusionで統合する関数
+
+    各検索結果でr位のdocumentに1 / (k + r)を加算し、合計の高い順に返します。
+    同じidのdocumentは1つにまとめ、最初に現れたものを返します。
+    """
+    scores: dict[str, float] = {}
+    documents: dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = document_key(document)
+            documents.setdefault(key, document)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    fused = sorted(scores, key=scores.__getitem__, reverse=True)
+    return [(documents[key], scores[key]) for key in fused[:top_n]]
+
+
+class BM25Index:
+    """
+    文字n-gramの転置インデックスによるBM25検索
+
+    Args:
+        ngram_sizes (Sequence[int], optional): 索引に使用するn. Defaults to (2, 3).
+        k1 (float, optional): 語の出現回数の飽和を調整するパラメータ. Defaults to 1.2.
+        b (float, optional): 文書長による正規化の強さ. Defaults to 0.75.
+
+    documentのタイトル(metadataの`title`)と本文を索引に登録します。
+    """
+    def __init__(self, ngram_sizes: Sequence[int] = NGRAM_SIZES, k1: float = 1.2, b: float = 0.75) -> None:
+        self.ngram_sizes = tuple(ngram_sizes)
+        self.k1 = k1
+        self.b = b
+        self._documents: list[Document | None] = []
+        self._terms: list[Counter[str]] = []
+        self._lengths: list[int] = []
+        self._length_array: np.ndarray | None = None
+        self._postings: dict[str, dict[int, int]] = {}
+        # 検索時に使用するpostingsの配列。更新された語のみ作り直す
+        self._arrays: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        self._slots: dict[str, int] = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def add_documents(self, documents: Iterable[Document]) -> None:
+        """documentを索引に登録する関数。同じidのdocumentは置き換える"""
+        with self._lock:
+            for document in documents:
+                self._remove(document_key(document))
+                self._add(document)
+
+    def remove(self, keys: Sequence[str]) -> None:
+        """idを指定してdocumentを索引から削除する関数"""
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def remove_source(self, source_id: int) -> None:
+        """source_idを指定してdocumentを索引から削除する関数"""
+        with self._lock:
+            keys = [
+                document_key(document) for document in self._documents
+                if document is not None and document.metadata.get("source_id") == source_id
+            ]
+            for key in keys:
+                self._remove(key)
+
+    def search(self, query: str, k: int = 4) -> list[tuple[Document, float]]:
+        """BM25のスコアが高い順にk件のdocumentを取得する関数"""
+        terms = set(char_ngrams(query, self.ngram_sizes))
+        with self._lock:
+            count = len(self._slots)
+            if not count or not terms or k <= 0:
+                return []
+            average = self._total_length / count
+            norms = self.k1 * (1 - self.b + self.b * self._lengths_as_array() / average)
+            scores = np.zeros(len(self._documents), dtype=np.float32)
+            for term in terms:
+                postings = self._term_arrays(term)
+                if postings is None:
+                    continue
+                slots, frequencies = postings
+                idf = math.log(1 + (count - len(slots) + 0.5) / (len(slots) + 0.5))
+                scores[slots] += idf * frequencies * (self.k1 + 1) / (frequencies + norms[slots])
+            matched = np.flatnonzero(scores)
+            top = matched[np.argsort(-scores[matched], kind="stable")[:k]]
+            return [(cast(Document, self._documents[i]).model_copy(deep=True), float(scores[i])) for i in top]
+
+    def _add(self, document: Document) -> None:
+        """documentを登録する関数。ロックを取得した状態で呼び出す"""
+        title = document.metadata.get("title") or ""
+        terms = Counter(char_ngrams(f"{title}\n{document.page_content}", self.ngram_sizes))
+        slot = len(self._documents)
+        self._documents.append(document)
+        self._terms.append(terms)
+        self._lengths.append(sum(terms.values()))
+        self._length_array = None
+        self._slots[document_key(document)] = slot
+        self._total_length += self._lengths[slot]
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[slot] = frequency
+            self._arrays.pop(term, None)
+
+    def _remove(self, key: str) -> None:
+        """documentを削除する関数。ロックを取得した状態で呼び出す"""
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            return
+        for term in self._terms[slot]:
+            postings = self._postings[term]
+            del postings[slot]
+            if not postings:
+                del self._postings[term]
+            self._arrays.pop(term, None)
+        self._total_length -= self._lengths[slot]
+        self._lengths[slot] = 0
+        self._length_array = None
+        self._documents[slot] = None
+        self._terms[slot] = Counter()
+
+    def _lengths_as_array(self) -> np.ndarray:
+        """文書長の配列を取得する関数。ロックを取得した状態で呼び出す"""
+        if self._length_array is None:
+            self._length_array = np.asarray(self._lengths, dtype=np.float32)
+        return self._length_array
+
+    def _term_arrays(self, term: str) -> tuple[np.ndarray, np.ndarray] | None:
+        """語のpostingsをslotと出現回数の配列で取得する関数。ロックを取得した状態で呼び出す"""
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            postings = self._postings.get(term)
+            if postings is None:
+                return None
+            arrays = (
+                np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                np.fromiter(postings.values(), dtype=np.float32, count=len(postings)),
+            )
+            self._arrays[term] = arrays
+        return arrays
+
+
+class VectorStore(Protocol):
+    """ベクトル検索の検索先。CosmosDBManagerとLocalVectorIndexが満たす"""
+    def similarity_search(self, query: str, k: int = 4) -> list[Document]: ...
+
+    async def asimilarity_search(self, query: str, k: int = 4) -> list[Document]: ...
+
+
+class TextSource(Protocol):
+    """BM25の索引の読み込み元。CosmosDBManagerが満たす"""
+    def iter_all_documents(self, with_metadata: bool = False) -> Iterable[Document]: ...
+
+    def read_item(
+        self,
+        values: list[str] | None = None,
+        condition: dict[str, Any] | None = None,
+    ) -> list[dict[str, Any]]: ...
+
+
+class HybridSearcher:
+    """
+    BM25とベクトル検索の結果をRRFで統合する検索
+
+    Args:
+        source (TextSource | None, optional): BM25の索引の読み込み元. Defaults to 共有のCosmosDBManager.
+        vector_store (VectorStore | None, optional): ベクトル検索の検索先.
+            Defaults to ローカルのインデックスが有効な場合はそのインデックス、それ以外は共有のCosmosDBManager.
+        fetch_k (int, optional): 統合の前にそれぞれの検索で取得する件数. Defaults to 10.
+        rrf_k (int, optional): RRFの定数. Defaults to 60.
+        refresh_interval (float | None, optional): BM25の索引を全て読み込み直す間隔(秒). Defaults to 600.
+
+    BM25の索引はdocumentの変更の通知で更新します。
+    索引の作り直しの間に通知された変更は記録し、新しい索引に反映してから置き換えます。
+    非同期の検索では、最初の索引の作成をイベントループを止めないよう別スレッドで行います。
+    """
+    def __init__(
+        self,
+        source: TextSource | None = None,
+        vector_store: VectorStore | None = None,
+        fetch_k: int = DEFAULT_FETCH_K,
+        rrf_k: int = RRF_K,
+        refresh_interval: float | None = DEFAULT_REFRESH_INTERVAL,
+    ) -> None:
+        self._source = source
+        self._vector_store = vector_store
+        self.fetch_k = fetch_k
+        self.rrf_k = rrf_k
+        self.refresh_interval = refresh_interval
+        self.index = BM25Index()
+        self._loaded_at: float | None = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        # 作り直し中の索引ごとに、その間に通知された変更を記録する
+        self._pending_changes: list[list[DocumentChange]] = []
+        self._changes_lock = threading.Lock()
+        add_document_change_listener(self.on_document_change)
+
+    @property
+    def source(self) -> TextSource:
+        return self._source if self._source is not None else get_cosmos_manager()
+
+    @property
+    def vector_store(self) -> VectorStore:
+        if self._vector_store is not None:
+            return self._vector_store
+        local_index = get_local_index()
+        return local_index if local_index is not None else get_cosmos_manager()
+
+    def refresh(self) -> None:
+        """全てのdocumentを読み込み、BM25の索引を作り直す関数"""
+        start = time.perf_counter()
+        pending: list[DocumentChange] = []
+        with self._changes_lock:
+            self._pending_changes.append(pending)
+        try:
+            index = BM25Index(self.index.ngram_sizes, self.index.k1, self.index.b)
+            index.add_documents(self.source.iter_all_documents(with_metadata=True))
+            while True:
+                with self._changes_lock:
+                    changes = pending[:]
+                    pending.clear()
+                    if not changes:
+                        self.index = index
+                        self._loaded_at = time.monotonic()
+                        break
+                for change in changes:
+                    self._apply_change(index, change)
+        finally:
+            with self._changes_lock:
+                self._pending_changes.remove(pending)
+        logger.info(f"BM25の索引を作成しました: {len(index)}件 ({(time.perf_counter() - start) * 1e3:.1f}ms)")
+
+    def load(self) -> None:
+        """未読み込みの場合のみ索引を作成する関数。同時に呼び出された場合も作成は1回のみ行う"""
+        if self._loaded_at is None:
+            with self._lock:
+                if self._loaded_at is None:
+                    self.refresh()
+
+    async def aload(self) -> None:
+        """未読み込みの場合のみ、イベントループを止めないよう別スレッドで索引を作成する関数。起動時の事前読み込みにも使用する"""
+        if self._loaded_at is None:
+            await asyncio.to_thread(self.load)
+
+    def on_document_change(self, change: DocumentChange) -> None:
+        """documentの変更を通知されたとき、変更されたdocumentのみを索引に反映する関数"""
+        with self._changes_lock:
+            for pending in self._pending_changes:
+                pending.append(change)
+        if self._loaded_at is not None:
+            self._apply_change(self.index, change)
+
+    def _apply_change(self, index: BM25Index, change: DocumentChange) -> None:
+        """documentの変更を索引に反映する関数"""
+        if change.source_id is not None:
+            index.remove_source(change.source_id)
+            condition: dict[str, Any] = {"metadata.source_id": change.source_id}
+            conditions = [condition] if change.action != "delete" else []
+        else:
+            index.remove(change.ids)
+            conditions = [{"id": _id} for _id in change.ids]
+        for condition in conditions:
+            try:
+                items = self.source.read_item(values=["id", "text", "metadata"], condition=condition)
+            except ValueError:
+                continue
+            index.add_documents([
+                Document(page_content=item["text"], metadata={**item.get("metadata", {}), "id": item["id"]})
+                for item in items
+            ])
+
+    def lexical_search(self, query: str, k: int) -> list[Document]:
+        """BM25で検索する関数"""
+        self._ensure_loaded()
+        return [doc for doc, _ in self.index.search(query, k)]
+
+    def search(self, query: str, k: int = 4) -> list[Document]:
+        """BM25とベクトル検索の結果を統合しk件のdocumentを取得する関数"""
+        vector = self.vector_store.similarity_search(query, k=self.fetch_k)
+        return self._fuse(vector, self.lexical_search(query, self.fetch_k), k)
+
+    async def asearch(self, query: str, k: int = 4) -> list[Document]:
+        """BM25とベクトル検索の結果を統合しk件のdocumentを非同期で取得する関数"""
+        vector, _ = await asyncio.gather(self.vector_store.asimilarity_search(query, k=self.fetch_k), self.aload())
+        return self._fuse(vector, self.lexical_search(query, self.fetch_k), k)
+
+    def _fuse(self, vector: list[Document], lexical: list[Document], k: int) -> list[Document]:
+        fused = reciprocal_rank_fusion([vector, lexical], k=self.rrf_k, top_n=k)
+        return [doc for doc, _ in fused]
+
+    def _ensure_loaded(self) -> None:
+        """未読み込みの場合は読み込み、古い場合は裏で読み込み直す関数"""
+        if self._loaded_at is None:
+            self.load()
+        elif self.refresh_interval is not None and time.monotonic() - self._loaded_at > self.refresh_interval:
+            with self._lock:
+                if self._refreshing:
+                    return
+                self._refreshing = True
+            threading.Thread(target=self._refresh_in_background, name="bm25-refresh", daemon=True).start()
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"BM25の索引の読み込みに失敗しました: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+@cache
+def get_hybrid_searcher() -> HybridSearcher:
+    """プロセス全体で共有するHybridSearcherを取得する関数"""
+    return HybridSearcher()
+
+
+if __name__ == "__main__":
+    from sc_system_ai.logging_config import setup_logging
+    setup_logging()
+
+    searcher = get_hybrid_searcher()
+    for doc in searcher.search("公欠届の提出期限", k=2):
+        print(doc.metadata["id"], doc.page_content[:40])
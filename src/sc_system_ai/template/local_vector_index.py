@@ -0,0 +1,424 @@
+"""
+### Cosmos DBのコンテナを複製したローカルのベクトルインデックスを定義するモジュール
+
+`CosmosDBManager.iter_document_pages`でページごとに読み込んだdocumentと保存済みの埋め込みをNumPyの行列で保持し、
+コサイン類似度の上位k件をプロセス内で計算します。Cosmos DBは正のデータとして扱い、
+`create_document`、`update_document`、`delete_document_by_source_id`による変更の通知と
+一定間隔の再読み込みでインデックスを同期します。
+非同期の検索では、最初の読み込みをイベントループを止めないよう別スレッドで行います。
+
+class:
+    - LocalVectorIndex(ローカルのベクトルインデックス)
+
+function:
+    - get_local_index(既定のインデックスを取得する関数)
+
+環境変数:
+    - LOCAL_VECTOR_INDEX_ENABLED: `true`の場合は検索にローカルのインデックスを使用する. Defaults to false
+    - LOCAL_VECTOR_INDEX_QUANTIZE: `true`の場合はベクトルをint8に量子化して保持する. Defaults to false
+    - LOCAL_VECTOR_INDEX_REFRESH_INTERVAL: 全てのdocumentを読み込み直す間隔(秒). Defaults to 600
+
+使用例：
+```python
+index = LocalVectorIndex(get_cosmos_manager(), quantize=True)
+index.refresh()  # 非同期のアプリケーションでは`await index.aload()`で事前に読み込む
+
+for doc, score in index.similarity_search_with_score("京都テック 専攻", k=2):
+    print(score, doc.page_content)
+
+# 上位20件の候補から、内容の重複が少ない4件を選ぶ
+docs = index.max_marginal_relevance_search_with_score("京都テック 専攻", k=4, fetch_k=20)
+```
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections.abc import Iterator
+from functools import cache
+from typing import Any, NamedTuple, Protocol, cast
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from sc_system_ai.template.azure_cosmos import (
+    READ_PAGE_SIZE,
+    DocumentChange,
+    DocumentPage,
+    add_document_change_listener,
+    get_cosmos_manager,
+)
+from sc_system_ai.template.mmr import DEFAULT_FETCH_K, DEFAULT_LAMBDA_MULT, maximal_marginal_relevance
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_INTERVAL = 600.0
+# source_idを持たないdocumentの値
+NO_SOURCE_ID = -1
+INT8_MAX = 127
+QUANTIZED_BLOCK_ROWS = 256
+
+
+class DocumentSource(Protocol):
+    """インデックスの読み込み元。CosmosDBManagerが満たす"""
+    _embedding: Embeddings
+    _embedding_key: str
+
+    def iter_document_pages(
+        self,
+        with_metadata: bool = False,
+        with_embedding: bool = False,
+        page_size: int = READ_PAGE_SIZE,
+        continuation_token: str | None = None,
+    ) -> Iterator[DocumentPage]: ...
+
+    def read_item(
+        self,
+        values: list[str] | None = None,
+        condition: dict[str, Any] | None = None,
+    ) -> list[dict[str, Any]]: ...
+
+
+class _Snapshot(NamedTuple):
+    """検索に使用するインデックスの状態。更新時は新しいSnapshotに置き換える"""
+    documents: list[Document]
+    source_ids: np.ndarray
+    vectors: np.ndarray
+    # int8に量子化した場合の行ごとの倍率。量子化しない場合はNone
+    scales: np.ndarray | None
+
+
+class LocalVectorIndex:
+    """
+    Cosmos DBのコンテナを複製したローカルのベクトルインデックス
+
+    Args:
+        source (DocumentSource): 読み込み元. Defaults to 共有のCosmosDBManager.
+        quantize (bool, optional): ベクトルをint8に量子化して保持するか. メモリ使用量が1/4になる. Defaults to False.
+        refresh_interval (float | None, optional): 全てのdocumentを読み込み直す間隔(秒).
+            Noneの場合は変更の通知のみで同期する. Defaults to 600.
+
+    検索は読み込み済みの行列に対して行い、更新中も直前の状態で検索できます。
+    全てのdocumentの読み込み中に通知された変更は記録し、新しい行列に反映してから置き換えます。
+    """
+    def __init__(
+        self,
+        source: DocumentSource | None = None,
+        quantize: bool = False,
+        refresh_interval: float | None = DEFAULT_REFRESH_INTERVAL,
+    ) -> None:
+        self._source = source
+        self.quantize = quantize
+        self.refresh_interval = refresh_interval
+        self._snapshot: _Snapshot | None = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        # 最初の読み込みを1回にまとめるロック
+        self._load_lock = threading.Lock()
+        self._refreshing = False
+        # 読み込み中のrefreshごとに、その間に通知された変更を記録する
+        self._pending_changes: list[list[DocumentChange]] = []
+        add_document_change_listener(self.on_document_change)
+
+    @property
+    def source(self) -> DocumentSource:
+        return self._source if self._source is not None else get_cosmos_manager()
+
+    def __len__(self) -> int:
+        return 0 if self._snapshot is None else len(self._snapshot.documents)
+
+    def refresh(self) -> None:
+        """全てのdocumentと埋め込みを読み込み直す関数"""
+        start = time.perf_counter()
+        pending: list[DocumentChange] = []
+        with self._lock:
+            self._pending_changes.append(pending)
+        try:
+            # ページごとに埋め込みを行列に変換し、全てのdocumentの埋め込みをリストのまま保持しない
+            pages = self.source.iter_document_pages(with_metadata=True, with_embedding=True)
+            snapshot = self._concat([self._build(page.documents) for page in pages])
+            while True:
+                with self._lock:
+                    changes = pending[:]
+                    pending.clear()
+                    if not changes:
+                        self._snapshot = snapshot
+                        self._loaded_at = time.monotonic()
+                        break
+                for change in changes:
+                    snapshot = self._apply_change(snapshot, change, self._read_changed(change))
+        finally:
+            with self._lock:
+                self._pending_changes.remove(pending)
+        logger.info(
+            f"ローカルのインデックスを読み込みました: {len(snapshot.documents)}件 "
+            f"({(time.perf_counter() - start) * 1e3:.1f}ms)"
+        )
+
+    def on_document_change(self, change: DocumentChange) -> None:
+        """documentの変更を通知されたとき、変更されたdocumentのみを読み込み直す関数"""
+        with self._lock:
+            for pending in self._pending_changes:
+                pending.append(change)
+        if self._snapshot is None:
+            return
+        documents = self._read_changed(change)
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                return
+            self._snapshot = self._apply_change(snapshot, change, documents)
+        logger.debug(f"ローカルのインデックスを更新しました: {change.action} {change.source_id=}")
+
+    def _read_changed(self, change: DocumentChange) -> list[Document]:
+        """変更されたdocumentを読み込む関数"""
+        if change.action == "delete":
+            return []
+        if change.source_id is not None:
+            return self._read_documents({"metadata.source_id": change.source_id})
+        return [doc for _id in change.ids for doc in self._read_documents({"id": _id})]
+
+    def _apply_change(self, snapshot: _Snapshot, change: DocumentChange, documents: list[Document]) -> _Snapshot:
+        """変更されたdocumentの行を、読み込み直したdocumentに置き換えたSnapshotを作成する関数"""
+        if change.source_id is not None:
+            keep = snapshot.source_ids != change.source_id
+        else:
+            ids = set(change.ids)
+            keep = np.array([doc.metadata["id"] not in ids for doc in snapshot.documents], dtype=bool)
+        return self._merge(snapshot, keep, self._build(documents))
+
+    def load(self) -> None:
+        """未読み込みの場合のみ全てのdocumentを読み込む関数。同時に呼び出された場合も読み込みは1回のみ行う"""
+        if self._snapshot is None:
+            with self._load_lock:
+                if self._snapshot is None:
+                    self.refresh()
+
+    async def aload(self) -> None:
+        """未読み込みの場合のみ、イベントループを止めないよう別スレッドで読み込む関数。起動時の事前読み込みにも使用する"""
+        if self._snapshot is None:
+            await asyncio.to_thread(self.load)
+
+    def similarity_search_with_score(self, query: str, k: int = 4) -> list[tuple[Document, float]]:
+        """スコア付きのベクトル検索を行う関数"""
+        return self.search_by_vector(self.source._embedding.embed_query(query), k)
+
+    async def asimilarity_search_with_score(self, query: str, k: int = 4) -> list[tuple[Document, float]]:
+        """スコア付きのベクトル検索を非同期で行う関数"""
+        vector = await self.source._embedding.aembed_query(query)
+        await self.aload()
+        return self.search_by_vector(vector, k)
+
+    def similarity_search(self, query: str, k: int = 4) -> list[Document]:
+        """ベクトル検索を行う関数"""
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    async def asimilarity_search(self, query: str, k: int = 4) -> list[Document]:
+        """ベクトル検索を非同期で行う関数"""
+        return [doc for doc, _ in await self.asimilarity_search_with_score(query, k)]
+
+    def search_by_vector(self, vector: list[float] | np.ndarray, k: int = 4) -> list[tuple[Document, float]]:
+        """埋め込みベクトルとのコサイン類似度が高い順にk件のdocumentを取得する関数"""
+        snapshot = self._current()
+        if not snapshot.documents or k <= 0:
+            return []
+        query = _normalize(np.asarray(vector, dtype=np.float32)[np.newaxis, :])[0]
+        scores = _scores(snapshot, query)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(snapshot.documents[i].model_copy(deep=True), float(scores[i])) for i in top]
+
+    def similarity_search_by_vector_with_score(
+        self,
+        embedding: list[float],
+        k: int = 4,
+    ) -> list[tuple[Document, float]]:
+        """埋め込みベクトルを指定してスコア付きのベクトル検索を行う関数"""
+        return self.search_by_vector(embedding, k)
+
+    async def asimilarity_search_by_vector_with_score(
+        self,
+        embedding: list[float],
+        k: int = 4,
+    ) -> list[tuple[Document, float]]:
+        """埋め込みベクトルを指定してスコア付きのベクトル検索を行う関数。読み込み後は行列の計算のみのためそのまま実行する"""
+        await self.aload()
+        return self.search_by_vector(embedding, k)
+
+    def max_marginal_relevance_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = DEFAULT_FETCH_K,
+        lambda_mult: float = DEFAULT_LAMBDA_MULT,
+    ) -> list[tuple[Document, float]]:
+        """上位fetch_k件の候補からMMRでk件を選ぶ関数。スコアは検索ワードとのコサイン類似度"""
+        return self.max_marginal_relevance_search_by_vector(
+            self.source._embedding.embed_query(query), k, fetch_k, lambda_mult
+        )
+
+    async def amax_marginal_relevance_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = DEFAULT_FETCH_K,
+        lambda_mult: float = DEFAULT_LAMBDA_MULT,
+    ) -> list[tuple[Document, float]]:
+        """上位fetch_k件の候補からMMRでk件を非同期で選ぶ関数"""
+        vector = await self.source._embedding.aembed_query(query)
+        await self.aload()
+        return self.max_marginal_relevance_search_by_vector(vector, k, fetch_k, lambda_mult)
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        vector: list[float] | np.ndarray,
+        k: int = 4,
+        fetch_k: int = DEFAULT_FETCH_K,
+        lambda_mult: float = DEFAULT_LAMBDA_MULT,
+    ) -> list[tuple[Document, float]]:
+        """埋め込みベクトルを指定してMMRでk件を選ぶ関数。候補のベクトルは保持している行列から取り出す"""
+        snapshot = self._current()
+        if not snapshot.documents or k <= 0:
+            return []
+        query = _normalize(np.asarray(vector, dtype=np.float32)[np.newaxis, :])[0]
+        scores = _scores(snapshot, query)
+        fetch_k = min(max(fetch_k, k), len(scores))
+        top = np.argpartition(-scores, fetch_k - 1)[:fetch_k]
+        candidates = snapshot.vectors[top].astype(np.float32)
+        if snapshot.scales is not None:
+            candidates *= snapshot.scales[top, np.newaxis]
+        selected = top[maximal_marginal_relevance(query, candidates, k, lambda_mult)]
+        return [(snapshot.documents[i].model_copy(deep=True), float(scores[i])) for i in selected]
+
+    def _current(self) -> _Snapshot:
+        """検索に使用する状態を取得する関数。未読み込みの場合は読み込み、古い場合は裏で読み込み直す"""
+        if self._snapshot is None:
+            self.load()
+        elif self.refresh_interval is not None and time.monotonic() - self._loaded_at > self.refresh_interval:
+            self._refresh_in_background()
+        assert self._snapshot is not None
+        return self._snapshot
+
+    def _refresh_in_background(self) -> None:
+        """別のスレッドで読み込み直す関数。読み込み中の場合は何もしない"""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run() -> None:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"ローカルのインデックスの読み込みに失敗しました: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, name="local-vector-index-refresh", daemon=True).start()
+
+    def _read_documents(self, condition: dict[str, Any]) -> list[Document]:
+        """条件に一致するdocumentを埋め込み付きで読み込む関数"""
+        embedding_key = self.source._embedding_key
+        try:
+            items = self.source.read_item(values=["id", "text", "metadata", embedding_key], condition=condition)
+        except ValueError:
+            return []
+        return [
+            Document(
+                page_content=item["text"],
+                metadata={**item.get("metadata", {}), "id": item["id"], embedding_key: item[embedding_key]},
+            )
+            for item in items
+        ]
+
+    def _build(self, documents: list[Document]) -> _Snapshot:
+        """documentから検索用の状態を作成する関数。埋め込みはmetadataから取り除く"""
+        embedding_key = self.source._embedding_key if documents else ""
+        vectors = [doc.metadata.pop(embedding_key) for doc in documents]
+        source_ids = np.array(
+            [doc.metadata.get("source_id", NO_SOURCE_ID) for doc in documents], dtype=np.int64
+        )
+        matrix = _normalize(np.asarray(vectors, dtype=np.float32)) if vectors else np.empty((0, 0), np.float32)
+        if not self.quantize:
+            return _Snapshot(documents, source_ids, matrix, None)
+        # 行ごとに最大の絶対値が127になるよう量子化し、倍率を保持する
+        peaks = np.abs(matrix).max(axis=1) if len(matrix) else np.empty(0, np.float32)
+        peaks[peaks == 0] = 1.0
+        quantized = np.round(matrix / peaks[:, np.newaxis] * INT8_MAX).astype(np.int8)
+        return _Snapshot(documents, source_ids, quantized, (peaks / INT8_MAX).astype(np.float32))
+
+    def _merge(self, snapshot: _Snapshot, keep: np.ndarray, added: _Snapshot) -> _Snapshot:
+        """既存の状態のうちkeepの行と、追加する状態を結合する関数"""
+        documents = [doc for doc, kept in zip(snapshot.documents, keep, strict=True) if kept] + added.documents
+        if not documents:
+            return self._build([])
+        parts = [part for part in (snapshot.vectors[keep], added.vectors) if part.size]
+        scales = None
+        if snapshot.scales is not None and added.scales is not None:
+            scales = np.concatenate([snapshot.scales[keep], added.scales])
+        return _Snapshot(
+            documents,
+            np.concatenate([snapshot.source_ids[keep], added.source_ids]),
+            np.concatenate(parts),
+            scales,
+        )
+
+    def _concat(self, snapshots: list[_Snapshot]) -> _Snapshot:
+        """ページごとに作成した状態を1つに結合する関数"""
+        snapshots = [snapshot for snapshot in snapshots if snapshot.documents]
+        if len(snapshots) <= 1:
+            return snapshots[0] if snapshots else self._build([])
+        scales = None
+        if self.quantize:
+            scales = np.concatenate([cast(np.ndarray, snapshot.scales) for snapshot in snapshots])
+        return _Snapshot(
+            [doc for snapshot in snapshots for doc in snapshot.documents],
+            np.concatenate([snapshot.source_ids for snapshot in snapshots]),
+            np.concatenate([snapshot.vectors for snapshot in snapshots]),
+            scales,
+        )
+
+
+def _scores(snapshot: _Snapshot, query: np.ndarray) -> np.ndarray:
+    """全ての行と正規化した検索ベクトルのコサイン類似度を計算する関数"""
+    if snapshot.scales is None:
+        return cast(np.ndarray, snapshot.vectors @ query)
+    # int8の行列を一度にfloat32へ変換すると全体のコピーが作られるため、キャッシュに載る大きさに分けて計算する
+    scores = np.empty(len(snapshot.vectors), dtype=np.float32)
+    for start in range(0, len(scores), QUANTIZED_BLOCK_ROWS):
+        block = snapshot.vectors[start:start + QUANTIZED_BLOCK_ROWS]
+        scores[start:start + QUANTIZED_BLOCK_ROWS] = block.astype(np.float32) @ query
+    return cast(np.ndarray, scores * snapshot.scales)
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    """行ごとにL2ノルムを1にする関数"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return cast(np.ndarray, (matrix / norms).astype(np.float32))
+
+
+@cache
+def get_local_index() -> LocalVectorIndex | None:
+    """環境変数の設定から既定のインデックスを作成し取得する関数。無効な場合はNoneを返す"""
+    if os.environ.get("LOCAL_VECTOR_INDEX_ENABLED", "false").lower() != "true":
+        return None
+    interval = float(os.environ.get("LOCAL_VECTOR_INDEX_REFRESH_INTERVAL", str(DEFAULT_REFRESH_INTERVAL)))
+    return LocalVectorIndex(
+        quantize=os.environ.get("LOCAL_VECTOR_INDEX_QUANTIZE", "false").lower() == "true",
+        refresh_interval=interval if interval > 0 else None,
+    )
+
+
+if __name__ == "__main__":
+    from sc_system_ai.logging_config import setup_logging
+    setup_logging()
+
+    index = LocalVectorIndex(quantize=True)
+    for doc, score in index.similarity_search_with_score("京都テック 専攻", k=2):
+        print(f"{score:.3f} {doc.metadata['id']} {doc.page_content[:40]}")
@@ -0,0 +1,95 @@
+"""
+### 検索結果をMMR(Maximal Marginal Relevance)で並べ替えるモジュール
+
+`md_formatter`や`text_formatter`で分割した隣接するchunkは同じ`group_id`を持ち、`CHUNK_OVERLAP`文字ずつ重複するため、
+ベクトル検索の上位k件がほぼ同じ内容になりやすいです。
+上位`fetch_k`件の候補から、検索ワードとの類似度と選択済みの結果との類似度の差が大きいものを順にk件選び、
+プロンプトに含める情報の重複を減らします。
+
+class:
+    - MMRPolicy(MMRの設定)
+
+function:
+    - maximal_marginal_relevance(候補からMMRでk件を選ぶ関数)
+
+使用例：
+```python
+policy = MMRPolicy(lambda_mult=0.5, fetch_k=20)
+results = get_cosmos_manager().max_marginal_relevance_search_with_score(
+    "公欠届", k=4, fetch_k=policy.fetch_k, lambda_mult=policy.lambda_mult
+)
+```
+"""
+import logging
+from collections.abc import Sequence
+from typing import cast
+
+import numpy as np
+from pydantic import BaseModel, Field
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LAMBDA_MULT = 0.5
+DEFAULT_FETCH_K = 20
+
+
+class MMRPolicy(BaseModel):
+    """
+    MMRで検索結果を並べ替える設定
+
+    Args:
+        lambda_mult (float): 検索ワードとの類似度の重み. 1で通常の上位k件、0で多様性のみを重視する. Defaults to 0.5.
+        fetch_k (int): MMRの候補として取得する件数. Defaults to 20.
+    """
+    lambda_mult: float = Field(default=DEFAULT_LAMBDA_MULT, ge=0.0, le=1.0, description="検索ワードとの類似度の重み")
+    fetch_k: int = Field(default=DEFAULT_FETCH_K, ge=1, description="MMRの候補として取得する件数")
+
+
+def maximal_marginal_relevance(
+    query: Sequence[float] | np.ndarray,
+    candidates: Sequence[Sequence[float]] | np.ndarray,
+    k: int = 4,
+    lambda_mult: float = DEFAULT_LAMBDA_MULT,
+) -> list[int]:
+    """
+    候補からMMRでk件を選び、選んだ順に候補の番号を返す関数
+
+    Args:
+        query (Sequence[float] | np.ndarray): 検索ワードの埋め込み
+        candidates (Sequence[Sequence[float]] | np.ndarray): 候補の埋め込み. 1行が1件の候補
+        k (int, optional): 選ぶ件数. Defaults to 4.
+        lambda_mult (float, optional): 検索ワードとの類似度の重み. Defaults to 0.5.
+
+    候補どうしの類似度は最初に行列積で1度だけ計算し、選択済みの結果との最大の類似度を1行ずつ更新します。
+    """
+    matrix = np.asarray(candidates, dtype=np.float32)
+    k = min(k, len(matrix))
+    if k <= 0:
+        return []
+    matrix = _normalize(matrix.reshape(len(matrix), -1))
+    vector = np.asarray(query, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    relevance = matrix @ (vector / norm if norm else vector)
+    similarity = matrix @ matrix.T
+
+    first = int(np.argmax(relevance))
+    selected = [first]
+    # 候補ごとの選択済みの結果との最大の類似度
+    redundancy = similarity[first].copy()
+    chosen = np.zeros(len(matrix), dtype=bool)
+    chosen[first] = True
+    for _ in range(k - 1):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[chosen] = -np.inf
+        index = int(np.argmax(scores))
+        selected.append(index)
+        chosen[index] = True
+        np.maximum(redundancy, similarity[index], out=redundancy)
+    return selected
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    """行ごとにL2ノルムを1にする関数"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return cast(np.ndarray, matrix / norms)
@@ -0,0 +1,210 @@
+"""
+### 複数の検索ワードで並行してベクトル検索を行い、結果を統合するモジュール
+
+`genarate_search_word`は「京都テック 学費 奨学金」のように複数の検索ワードを返すことがあります。
+1つの埋め込みにまとめて検索すると、それぞれの語に関するdocumentを取りこぼしやすいため、
+検索ワードごとのサブクエリに分割して1回の呼び出しでまとめて埋め込み、並行して検索した結果をRRFで統合します。
+
+class:
+    - SubQueryTiming(サブクエリごとの検索時間)
+    - MultiQueryResult(統合した検索結果と計測した時間)
+
+function:
+    - split_search_words(検索ワードをサブクエリに分割する関数)
+    - multi_query_search(サブクエリごとに並行して検索する関数)
+    - amulti_query_search(サブクエリごとに並行して非同期で検索する関数)
+
+使用例：
+```python
+result = multi_query_search("京都テック 学費 奨学金", top_k=2)
+for doc in result.documents:
+    print(doc.page_content)
+for timing in result.timings:
+    print(timing.query, timing.seconds)
+```
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Protocol
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from pydantic import BaseModel, Field
+
+from sc_system_ai.template.azure_cosmos import get_cosmos_manager, query_embeddings
+from sc_system_ai.template.embedding_cache import CachedEmbeddings
+from sc_system_ai.template.hybrid_search import reciprocal_rank_fusion
+from sc_system_ai.template.local_vector_index import get_local_index
+
+logger = logging.getLogger(__name__)
+
+MAX_SUB_QUERIES = 4
+
+# 同期版の検索で共有するスレッドプール
+_executor = ThreadPoolExecutor(max_workers=MAX_SUB_QUERIES, thread_name_prefix="multi-query")
+
+
+class VectorSearchStore(Protocol):
+    """埋め込みベクトルで検索できる検索先。CosmosDBManagerとLocalVectorIndexが満たす"""
+    def similarity_search_by_vector_with_score(
+        self, embedding: list[float], k: int = 4
+    ) -> list[tuple[Document, float]]: ...
+
+    async def asimilarity_search_by_vector_with_score(
+        self, embedding: list[float], k: int = 4
+    ) -> list[tuple[Document, float]]: ...
+
+
+class SubQueryTiming(BaseModel):
+    """サブクエリごとの検索時間"""
+    query: str = Field(description="サブクエリ")
+    seconds: float = Field(description="検索にかかった時間(秒)")
+    hits: int = Field(description="取得したdocumentの数")
+
+
+class MultiQueryResult(BaseModel):
+    """統合した検索結果と計測した時間"""
+    documents: list[Document] = Field(default_factory=list, description="統合した検索結果")
+    sub_queries: list[str] = Field(default_factory=list, description="検索に使用したサブクエリ")
+    embedding_seconds: float = Field(default=0.0, description="全てのサブクエリの埋め込みにかかった時間(秒)")
+    timings: list[SubQueryTiming] = Field(default_factory=list, description="サブクエリごとの検索時間")
+    total_seconds: float = Field(default=0.0, description="全体の時間(秒)")
+
+
+def split_search_words(search_word: str, max_queries: int = MAX_SUB_QUERIES) -> list[str]:
+    """
+    検索ワードをサブクエリに分割する関数
+
+    空白(全角を含む)で区切られた複数の語がある場合は、全体のクエリと各語をサブクエリにします。
+    重複した語は除き、最大でmax_queries件にします。
+    """
+    words = list(dict.fromkeys(search_word.split()))
+    if len(words) <= 1:
+        return [search_word.strip()] if search_word.strip() else []
+    return [" ".join(words), *words][:max_queries]
+
+
+def _embed(embedding: Embeddings, queries: list[str]) -> list[list[float]]:
+    if isinstance(embedding, CachedEmbeddings):
+        return embedding.embed_queries(queries)
+    return embedding.embed_documents(queries)
+
+
+async def _aembed(embedding: Embeddings, queries: list[str]) -> list[list[float]]:
+    if isinstance(embedding, CachedEmbeddings):
+        return await embedding.aembed_queries(queries)
+    return await embedding.aembed_documents(queries)
+
+
+def _default_store() -> VectorSearchStore:
+    local_index = get_local_index()
+    return local_index if local_index is not None else get_cosmos_manager()
+
+
+def _fuse(
+    queries: list[str],
+    rankings: list[list[Document]],
+    timings: list[SubQueryTiming],
+    max_results: int,
+    embedding_seconds: float,
+    start: float,
+) -> MultiQueryResult:
+    fused = reciprocal_rank_fusion(rankings, top_n=max_results)
+    result = MultiQueryResult(
+        documents=[doc for doc, _ in fused],
+        sub_queries=queries,
+        embedding_seconds=embedding_seconds,
+        timings=timings,
+        total_seconds=time.perf_counter() - start,
+    )
+    logger.info(
+        f"{len(queries)}件のサブクエリで検索しました({result.total_seconds * 1e3:.1f}ms): "
+        + ", ".join(f"{t.query}={t.seconds * 1e3:.1f}ms" for t in timings)
+    )
+    return result
+
+
+def multi_query_search(
+    search_word: str,
+    top_k: int = 2,
+    max_results: int | None = None,
+    store: VectorSearchStore | None = None,
+    embedding: Embeddings = query_embeddings,
+) -> MultiQueryResult:
+    """
+    サブクエリごとに並行してベクトル検索を行い、結果を統合する関数
+
+    Args:
+        search_word (str): 検索ワード. 空白で区切られた語ごとにサブクエリを作成する
+        top_k (int, optional): サブクエリごとに取得する件数. Defaults to 2.
+        max_results (int | None, optional): 統合した結果の最大件数. Noneの場合はtop_kと同じ件数. Defaults to None.
+        store (VectorSearchStore | None, optional): 検索先.
+            Defaults to ローカルのインデックスが有効な場合はそのインデックス、それ以外は共有のCosmosDBManager.
+        embedding (Embeddings, optional): サブクエリの埋め込みに使用するモデル. Defaults to query_embeddings.
+    """
+    start = time.perf_counter()
+    store = store if store is not None else _default_store()
+    queries = split_search_words(search_word)
+    if not queries:
+        return MultiQueryResult()
+    vectors = _embed(embedding, queries)
+    embedding_seconds = time.perf_counter() - start
+
+    def search(query: str, vector: list[float]) -> tuple[list[Document], SubQueryTiming]:
+        began = time.perf_counter()
+        docs = [doc for doc, _ in store.similarity_search_by_vector_with_score(vector, k=top_k)]
+        return docs, SubQueryTiming(query=query, seconds=time.perf_counter() - began, hits=len(docs))
+
+    results = list(_executor.map(search, queries, vectors))
+    return _fuse(
+        queries,
+        [docs for docs, _ in results],
+        [t for _, t in results],
+        max_results if max_results is not None else top_k,
+        embedding_seconds,
+        start,
+    )
+
+
+async def amulti_query_search(
+    search_word: str,
+    top_k: int = 2,
+    max_results: int | None = None,
+    store: VectorSearchStore | None = None,
+    embedding: Embeddings = query_embeddings,
+) -> MultiQueryResult:
+    """サブクエリごとに並行して非同期でベクトル検索を行い、結果を統合する関数"""
+    start = time.perf_counter()
+    store = store if store is not None else _default_store()
+    queries = split_search_words(search_word)
+    if not queries:
+        return MultiQueryResult()
+    vectors = await _aembed(embedding, queries)
+    embedding_seconds = time.perf_counter() - start
+
+    async def search(query: str, vector: list[float]) -> tuple[list[Document], SubQueryTiming]:
+        began = time.perf_counter()
+        docs = [doc for doc, _ in await store.asimilarity_search_by_vector_with_score(vector, k=top_k)]
+        return docs, SubQueryTiming(query=query, seconds=time.perf_counter() - began, hits=len(docs))
+
+    results = await asyncio.gather(*(search(query, vector) for query, vector in zip(queries, vectors, strict=True)))
+    return _fuse(
+        queries,
+        [docs for docs, _ in results],
+        [t for _, t in results],
+        max_results if max_results is not None else top_k,
+        embedding_seconds,
+        start,
+    )
+
+
+if __name__ == "__main__":
+    from sc_system_ai.logging_config import setup_logging
+    setup_logging()
+
+    result = multi_query_search("京都テック 学費 奨学金")
+    for doc in result.documents:
+        print(doc.metadata["id"], doc.page_content[:40])
+    print(result.timings)
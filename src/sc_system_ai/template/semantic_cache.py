@@ -0,0 +1,221 @@
+"""
+### 質問の埋め込みをキーに回答を再利用するキャッシュを定義するモジュール
+
+言い換えられた質問(例: 「京都テックの専攻は？」と「京都テックにはどんな専攻がありますか」)に対して、
+埋め込みのコサイン類似度がしきい値以上の過去の回答を返します。
+回答が参照したdocumentが`CosmosDBManager`で更新、削除された場合は、その回答を自動的に破棄します。
+回答はユーザー情報などで個別化されるため、保存時と同じ`scope`で検索した場合のみ再利用します。
+
+class:
+    - CachedAnswer(キャッシュした回答を保持するクラス)
+    - SemanticAnswerCache(質問の埋め込みをキーに回答を保持するキャッシュ)
+
+環境変数:
+    - SEMANTIC_ANSWER_CACHE_ENABLED: `true`の場合は既定のキャッシュを使用する. Defaults to false
+    - SEMANTIC_ANSWER_CACHE_THRESHOLD: 類似度のしきい値. Defaults to 0.95
+
+使用例：
+```python
+cache = SemanticAnswerCache(threshold=0.95)
+cache.store("京都テックの専攻は？", "京都テックには以下の専攻があります。...", [1, 2], scope="hogehoge")
+
+hit = cache.lookup("京都テックにはどんな専攻がありますか", scope="hogehoge")
+if hit is not None:
+    print(hit.answer, hit.document_id)
+```
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import cache
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from pydantic import BaseModel, Field
+
+from sc_system_ai.template.ai_settings import embeddings
+from sc_system_ai.template.azure_cosmos import (
+    DocumentChange,
+    add_document_change_listener,
+    remove_document_change_listener,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 0.95
+
+
+class CachedAnswer(BaseModel):
+    """キャッシュした回答を保持するクラス"""
+    question: str = Field(description="回答した質問")
+    answer: str = Field(description="回答")
+    document_id: list[int] = Field(default_factory=list, description="回答が参照したdocumentのsource_id")
+    scope: str = Field(default="", description="回答を再利用できる範囲。ユーザー情報などから作成する")
+    similarity: float = Field(default=1.0, description="検索した質問との類似度")
+
+
+class SemanticAnswerCache:
+    """
+    質問の埋め込みをキーに回答を保持するキャッシュ
+
+    Args:
+        embedding (Embeddings, optional): 質問の埋め込みに使用するモデル. Defaults to embeddings.
+        threshold (float, optional): 回答を再利用する類似度のしきい値. Defaults to 0.95.
+        max_entries (int, optional): 保持する回答の最大数. 超えた場合は古い回答から削除する. Defaults to 1000.
+        ttl (float | None, optional): 回答の有効期限(秒). Defaults to None.
+    """
+    def __init__(
+        self,
+        embedding: Embeddings = embeddings,
+        threshold: float = DEFAULT_THRESHOLD,
+        max_entries: int = 1000,
+        ttl: float | None = None,
+    ) -> None:
+        self.embedding = embedding
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: list[CachedAnswer] = []
+        self._created_at: list[float] = []
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        # 検索と保存で同じ質問を二度埋め込まないよう、直近の質問の埋め込みを保持する
+        self._recent: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        add_document_change_listener(self.on_document_change)
+
+    def lookup(self, question: str, scope: str = "") -> CachedAnswer | None:
+        """類似する質問の回答のうち、同じscopeで保存した回答を取得する関数"""
+        return self._search(self._embed(question), scope)
+
+    async def alookup(self, question: str, scope: str = "") -> CachedAnswer | None:
+        """類似する質問の回答のうち、同じscopeで保存した回答を非同期で取得する関数"""
+        return self._search(await self._aembed(question), scope)
+
+    def store(self, question: str, answer: str, document_id: list[int] | None = None, scope: str = "") -> None:
+        """回答を保存する関数"""
+        self._add(CachedAnswer(question=question, answer=answer, document_id=document_id or [], scope=scope),
+                  self._embed(question))
+
+    async def astore(
+        self, question: str, answer: str, document_id: list[int] | None = None, scope: str = ""
+    ) -> None:
+        """回答を非同期で保存する関数"""
+        self._add(CachedAnswer(question=question, answer=answer, document_id=document_id or [], scope=scope),
+                  await self._aembed(question))
+
+    def invalidate(self, source_ids: set[int] | None = None) -> int:
+        """
+        回答を破棄する関数
+
+        source_idsを指定した場合は、そのいずれかを参照した回答のみを破棄します。
+        破棄した回答の数を返します。
+        """
+        with self._lock:
+            keep = [
+                i for i, entry in enumerate(self._entries)
+                if source_ids is not None and source_ids.isdisjoint(entry.document_id)
+            ]
+            removed = len(self._entries) - len(keep)
+            if removed:
+                self._keep(keep)
+        if removed:
+            logger.info(f"{removed}件のキャッシュした回答を破棄しました")
+        return removed
+
+    def on_document_change(self, change: DocumentChange) -> None:
+        """documentの変更時に、そのdocumentを参照した回答を破棄する関数"""
+        if change.source_id is not None:
+            self.invalidate({change.source_id})
+
+    def close(self) -> None:
+        """documentの変更の通知の登録を解除する関数"""
+        remove_document_change_listener(self.on_document_change)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _search(self, vector: np.ndarray, scope: str) -> CachedAnswer | None:
+        with self._lock:
+            self._expire()
+            if not self._entries:
+                self.misses += 1
+                return None
+            scores = self._vectors @ vector
+            # 別のscopeで保存した回答は使用しない
+            other = np.fromiter((entry.scope != scope for entry in self._entries), dtype=bool, count=len(scores))
+            scores[other] = -np.inf
+            best = int(np.argmax(scores))
+            score = float(scores[best])
+            if score < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry = self._entries[best]
+        logger.info(f"キャッシュした回答を使用します(類似度: {score:.3f}): {entry.question}")
+        return entry.model_copy(update={"similarity": score})
+
+    def _add(self, entry: CachedAnswer, vector: np.ndarray) -> None:
+        with self._lock:
+            self._entries.append(entry)
+            self._created_at.append(time.time())
+            self._vectors = vector[np.newaxis, :] if not self._vectors.size else np.vstack([self._vectors, vector])
+            if len(self._entries) > self.max_entries:
+                self._keep(list(range(len(self._entries) - self.max_entries, len(self._entries))))
+
+    def _expire(self) -> None:
+        """有効期限を過ぎた回答を破棄する関数。ロックを取得した状態で呼び出す"""
+        if self.ttl is None or not self._entries:
+            return
+        now = time.time()
+        keep = [i for i, created_at in enumerate(self._created_at) if now - created_at <= self.ttl]
+        if len(keep) != len(self._entries):
+            self._keep(keep)
+
+    def _keep(self, indexes: list[int]) -> None:
+        """指定した位置の回答のみを残す関数。ロックを取得した状態で呼び出す"""
+        self._entries = [self._entries[i] for i in indexes]
+        self._created_at = [self._created_at[i] for i in indexes]
+        self._vectors = self._vectors[indexes] if indexes else np.empty((0, 0), dtype=np.float32)
+
+    def _normalize(self, question: str, vector: list[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        array = array / norm if norm else array
+        with self._lock:
+            self._recent[question] = array
+            if len(self._recent) > 64:  # noqa: PLR2004
+                self._recent.popitem(last=False)
+        return array
+
+    def _recent_vector(self, question: str) -> np.ndarray | None:
+        with self._lock:
+            vector = self._recent.get(question)
+            if vector is not None:
+                self._recent.move_to_end(question)
+            return vector
+
+    def _embed(self, question: str) -> np.ndarray:
+        vector = self._recent_vector(question)
+        if vector is None:
+            vector = self._normalize(question, self.embedding.embed_query(question))
+        return vector
+
+    async def _aembed(self, question: str) -> np.ndarray:
+        vector = self._recent_vector(question)
+        if vector is None:
+            vector = self._normalize(question, await self.embedding.aembed_query(question))
+        return vector
+
+
+@cache
+def get_answer_cache() -> SemanticAnswerCache | None:
+    """環境変数の設定から既定のキャッシュを作成し取得する関数。無効な場合はNoneを返す"""
+    if os.environ.get("SEMANTIC_ANSWER_CACHE_ENABLED", "false").lower() != "true":
+        return None
+    return SemanticAnswerCache(
+        threshold=float(os.environ.get("SEMANTIC_ANSWER_CACHE_THRESHOLD", DEFAULT_THRESHOLD)),
+    )
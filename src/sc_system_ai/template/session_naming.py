@@ -3,6 +3,7 @@ from os import linesep
 from pydantic import BaseModel, Field
 
 from sc_system_ai.template.ai_settings import llm
+from sc_system_ai.template.structured_output_cache import invoke_structured_output
 
 
 class Output(BaseModel):
@@ -34,9 +35,7 @@ def create_prompt(conversation: list[tuple[str, str]]) -> str:
 
 def session_naming(conversation: list[tuple[str, str]]) -> str:
     prompt = create_prompt(conversation)
-    model = llm.with_structured_output(Output)
-
-    resullt = model.invoke(prompt)
+    resullt = invoke_structured_output(llm, Output, prompt, call_site="session_naming")
 
     if isinstance(resullt, Output):
         return resullt.session_name
@@ -1,5 +1,5 @@
+import asyncio
 import logging
-from queue import Queue
 from typing import Any
 
 from langchain.callbacks.base import BaseCallbackHandler
@@ -11,20 +11,47 @@ logger = logging.getLogger(__name__)
 
 # StreamingHandlerクラスの作成
 class StreamingAgentHandler(BaseCallbackHandler):
-    def __init__(self, queue: Queue):
+    """
+    生成されたトークンをasyncio.Queueに送るハンドラ
+
+    Args:
+        queue (asyncio.Queue): トークンを送るキュー
+        loop (asyncio.AbstractEventLoop, optional): キューを待ち受けるイベントループ
+
+    イベントループと同じスレッドで呼び出された場合はそのままキューに追加し、
+    別スレッドから呼び出された場合は`call_soon_threadsafe`でイベントループに追加を依頼します。
+    ストリームの終了は、エージェントを実行したタスクの完了時に`Agent.stream`が知らせます。
+    ツールから呼び出されたエージェントも同じキューを使用するため、ハンドラは終了を送りません。
+    """
+    # スレッドプールを経由せずにイベントループ上で直接呼び出す
+    run_inline = True
+
+    def __init__(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop | None = None):
         super().__init__()
         self.queue = queue
+        self.loop = loop
+
+    def _put(self, token: str) -> None:
+        """キューにトークンを追加する関数"""
+        try:
+            running_loop: asyncio.AbstractEventLoop | None = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if self.loop is not None and running_loop is not self.loop:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, token)
+        else:
+            self.queue.put_nowait(token)
 
     # トークンの生成時に呼び出される関数
     def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
         if token:
             logger.debug(token)
-            self.queue.put(token)
+            self._put(token)
 
     # トークン生成時にエラーが発生した場合呼び出される関数
     def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
         logger.error(f"トークンの生成時にエラーが発生しました:{error}")
-        self.queue.put(None)
 
     def on_agent_action(self, action: AgentAction, **kwargs: Any) -> None:
         pass
@@ -32,12 +59,13 @@ class StreamingAgentHandler(BaseCallbackHandler):
     # エージェントの実行終了時に呼び出される関数
     def on_agent_finish(self, finish: AgentFinish, **kwargs: Any) -> None:
         logger.info("エージェントの実行が終了しました。")
-        self.queue.put(None)
 
 
 # StreamingToolHandlerクラスの作成
 class StreamingToolHandler(BaseCallbackHandler):
-    def __init__(self, queue: Queue):
+    run_inline = True
+
+    def __init__(self, queue: asyncio.Queue):
         super().__init__()
         self.queue = queue
 
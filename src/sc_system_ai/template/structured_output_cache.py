@@ -0,0 +1,277 @@
+"""
+### 構造化出力の呼び出し結果を永続化するキャッシュを定義するモジュール
+
+`temperature=0`のモデルで同じプロンプトを構造化出力する呼び出しは、同じ結果を返します。
+プロンプト、出力のスキーマ、デプロイメント名をキーに、結果をSQLiteに保存して再利用します。
+キャッシュは`STRUCTURED_OUTPUT_CACHE_PATH`で保存先を指定した場合のみ使用します。
+
+class:
+    - StructuredOutputCache(構造化出力のキャッシュ)
+
+function:
+    - get_structured_output_cache(既定のキャッシュを取得する関数. 無効な場合はNone)
+    - invoke_structured_output(キャッシュを利用して構造化出力を呼び出す関数)
+    - ainvoke_structured_output(キャッシュを利用して構造化出力を非同期で呼び出す関数)
+
+環境変数:
+    - STRUCTURED_OUTPUT_CACHE_PATH: キャッシュの保存先. `:memory:`はメモリ上に保持する. 指定しない場合はキャッシュしない
+    - STRUCTURED_OUTPUT_CACHE_TTL: キャッシュの有効期限(秒). Defaults to 604800(7日)
+    - STRUCTURED_OUTPUT_CACHE_MAX_ENTRIES: キャッシュの最大件数. Defaults to 10000
+
+使用例：
+```python
+result = invoke_structured_output(llm, Output, prompt, call_site="keyword_similarity")
+
+# 呼び出し元ごとのヒット率
+if (cache := get_structured_output_cache()) is not None:
+    print(cache.stats())
+```
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from functools import cache
+from pathlib import Path
+from typing import Any, TypedDict, TypeVar
+
+from langchain_core.language_models import BaseChatModel
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 10_000
+
+SchemaT = TypeVar("SchemaT", bound=BaseModel)
+
+
+class CacheStats(TypedDict):
+    hits: int
+    misses: int
+    hit_rate: float
+
+
+@cache
+def _schema_json(schema: type[BaseModel]) -> str:
+    """スキーマのJSON表現を取得する関数"""
+    return json.dumps(schema.model_json_schema(), ensure_ascii=False, sort_keys=True)
+
+
+def _deployment_name(llm: BaseChatModel) -> str:
+    """モデルのデプロイメント名を取得する関数"""
+    return str(getattr(llm, "deployment_name", None) or getattr(llm, "model_name", None) or llm._llm_type)
+
+
+def _is_deterministic(llm: BaseChatModel) -> bool:
+    """同じ入力に対して同じ出力を返すモデルか判定する関数"""
+    return getattr(llm, "temperature", None) == 0
+
+
+class StructuredOutputCache:
+    """
+    構造化出力の呼び出し結果を保持するキャッシュ
+
+    Args:
+        path (str | Path): SQLiteのファイルパス. `:memory:`の場合はメモリ上に保持する
+        ttl (float | None, optional): 有効期限(秒). Noneの場合は期限なし
+        max_entries (int, optional): 最大件数. 超えた場合は最後に参照された日時が古いものから削除する
+
+    ヒット数とミス数は呼び出し元(call_site)ごとに集計します。
+    参照された日時はメモリ上に記録し、次の保存時にまとめて書き込むため、取得ではデータベースに書き込みません。
+    """
+    def __init__(
+        self,
+        path: str | Path,
+        ttl: float | None = DEFAULT_TTL,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        if str(path) != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS structured_output ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS structured_output_accessed_at ON structured_output (accessed_at)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._hits: dict[str, int] = {}
+        self._misses: dict[str, int] = {}
+        # まだ書き込んでいない参照日時
+        self._accessed: dict[str, float] = {}
+
+    @staticmethod
+    def make_key(prompt: str, schema: type[BaseModel], deployment: str) -> str:
+        """プロンプト、スキーマ、デプロイメント名からキーを作成する関数"""
+        source = "\x00".join([deployment, _schema_json(schema), prompt])
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def get(self, call_site: str, key: str, schema: type[SchemaT]) -> SchemaT | None:
+        """キャッシュから結果を取得する関数。期限切れ、または存在しない場合はNoneを返す"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM structured_output WHERE key = ?", (key,)
+            ).fetchone()
+            # 期限切れの結果は次の保存時に上書き、または削除する
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                row = None
+            if row is not None:
+                self._accessed[key] = now
+            counter = self._hits if row is not None else self._misses
+            counter[call_site] = counter.get(call_site, 0) + 1
+
+        if row is None:
+            return None
+        try:
+            return schema.model_validate_json(row[0])
+        except ValueError:
+            logger.warning(f"キャッシュの読み込みに失敗しました: {call_site}")
+            return None
+
+    def set(self, key: str, value: BaseModel) -> None:
+        """キャッシュに結果を保存する関数"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO structured_output (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value.model_dump_json(), now, now),
+            )
+            self._accessed.pop(key, None)
+            self._write_accessed()
+            self._evict(now)
+            self._conn.commit()
+
+    def _write_accessed(self) -> None:
+        """メモリ上に記録した参照日時をまとめて書き込む関数。ロックを取得した状態で呼び出す"""
+        if self._accessed:
+            self._conn.executemany(
+                "UPDATE structured_output SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._accessed.items()],
+            )
+            self._accessed.clear()
+
+    def _evict(self, now: float) -> None:
+        """期限切れの結果と、最大件数を超えた分を最後に参照された日時が古いものから削除する関数"""
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM structured_output WHERE created_at < ?", (now - self.ttl,))
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM structured_output").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM structured_output WHERE key IN "
+                "(SELECT key FROM structured_output ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def clear(self) -> None:
+        """キャッシュと集計を削除する関数"""
+        with self._lock:
+            self._conn.execute("DELETE FROM structured_output")
+            self._conn.commit()
+            self._accessed.clear()
+            self._hits.clear()
+            self._misses.clear()
+
+    def stats(self) -> dict[str, CacheStats]:
+        """呼び出し元ごとのヒット数、ミス数、ヒット率を取得する関数"""
+        with self._lock:
+            call_sites = set(self._hits) | set(self._misses)
+            stats: dict[str, CacheStats] = {}
+            for call_site in sorted(call_sites):
+                hits = self._hits.get(call_site, 0)
+                misses = self._misses.get(call_site, 0)
+                stats[call_site] = {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses)}
+            return stats
+
+
+@cache
+def get_structured_output_cache() -> StructuredOutputCache | None:
+    """
+    環境変数の設定から既定のキャッシュを作成し取得する関数。作成は最初の呼び出し時に一度だけ行う
+
+    `STRUCTURED_OUTPUT_CACHE_PATH`を指定していない場合はNoneを返します。
+    """
+    path = os.environ.get("STRUCTURED_OUTPUT_CACHE_PATH")
+    if not path:
+        return None
+    return StructuredOutputCache(
+        path=path,
+        ttl=float(os.environ.get("STRUCTURED_OUTPUT_CACHE_TTL", DEFAULT_TTL)),
+        max_entries=int(os.environ.get("STRUCTURED_OUTPUT_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+    )
+
+
+def _cache_key(
+    llm: BaseChatModel,
+    schema: type[BaseModel],
+    prompt: str,
+    cache: StructuredOutputCache | None,
+) -> str | None:
+    """キャッシュのキーを作成する関数。キャッシュが無効、または結果が一定でないモデルの場合はNoneを返す"""
+    if cache is None or not _is_deterministic(llm):
+        return None
+    return cache.make_key(prompt, schema, _deployment_name(llm))
+
+
+def invoke_structured_output(
+    llm: BaseChatModel,
+    schema: type[SchemaT],
+    prompt: str,
+    call_site: str,
+    cache: StructuredOutputCache | None = None,
+) -> SchemaT | Any:
+    """
+    キャッシュを利用して構造化出力を呼び出す関数
+
+    Args:
+        llm (BaseChatModel): 呼び出すモデル. `temperature=0`の場合のみキャッシュを利用する
+        schema (type[BaseModel]): 出力のスキーマ
+        prompt (str): プロンプト
+        call_site (str): 呼び出し元の名前. ヒット率の集計に使用する
+        cache (StructuredOutputCache | None, optional): 使用するキャッシュ. Defaults to 既定のキャッシュ.
+    """
+    cache = cache or get_structured_output_cache()
+    key = _cache_key(llm, schema, prompt, cache)
+    if cache is not None and key is not None and (cached := cache.get(call_site, key, schema)) is not None:
+        logger.debug(f"構造化出力のキャッシュを使用します: {call_site}")
+        return cached
+
+    result = llm.with_structured_output(schema).invoke(prompt)
+    if cache is not None and key is not None and isinstance(result, schema):
+        cache.set(key, result)
+    return result
+
+
+async def ainvoke_structured_output(
+    llm: BaseChatModel,
+    schema: type[SchemaT],
+    prompt: str,
+    call_site: str,
+    cache: StructuredOutputCache | None = None,
+) -> SchemaT | Any:
+    """
+    キャッシュを利用して構造化出力を非同期で呼び出す関数
+
+    SQLiteの読み書きはイベントループを止めないよう、別スレッドで実行します。
+    """
+    cache = cache or get_structured_output_cache()
+    key = _cache_key(llm, schema, prompt, cache)
+    if cache is not None and key is not None:
+        cached = await asyncio.to_thread(cache.get, call_site, key, schema)
+        if cached is not None:
+            logger.debug(f"構造化出力のキャッシュを使用します: {call_site}")
+            return cached
+
+    result = await llm.with_structured_output(schema).ainvoke(prompt)
+    if cache is not None and key is not None and isinstance(result, schema):
+        await asyncio.to_thread(cache.set, key, result)
+    return result
@@ -2,6 +2,8 @@
 ### ユーザー情報を保持するクラスとユーザー情報のプロンプトを生成するクラスを定義するモジュール
 
 class:
+    - HistoryPolicy(プロンプトに含める会話履歴の範囲を決めるクラス)
+    - TrimReport(会話履歴の切り捨て結果を保持するクラス)
     - Conversation(会話の情報を保持するクラス)
     - ConversationHistory(会話履歴を保持するクラス)
     - User(ユーザーの情報を保持するクラス)
@@ -42,15 +44,85 @@ conversations = [
 user.conversations.add_conversations_list(conversations)
 print(user.conversations.get_conversations())
 ```
+
+プロンプトに含める会話履歴は`HistoryPolicy`で制限できます。
+```python
+# 直近20件、かつ2000トークン以内の会話履歴のみをプロンプトに含める
+user.conversations.policy = HistoryPolicy(max_turns=20, max_tokens=2000)
+user.conversations.format_conversation()
+print(user.conversations.get_trim_report())
+```
 """
 
+import logging
+from collections.abc import Callable
+from functools import cache
 from typing import Any
 
-from langchain_core.messages import AIMessage, HumanMessage
-from pydantic import BaseModel, Field
+import tiktoken
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from pydantic import BaseModel, Field, PrivateAttr
 
 from sc_system_ai.template.prompts import user_info_template
 
+logger = logging.getLogger(__name__)
+
+# 1メッセージあたりのロールや区切りのトークン数
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@cache
+def _get_encoding(name: str) -> tiktoken.Encoding:
+    """tiktokenのエンコーディングを取得する関数"""
+    return tiktoken.get_encoding(name)
+
+
+class HistoryPolicy(BaseModel):
+    """
+    会話履歴のうちプロンプトに含める範囲を決めるクラス
+
+    Args:
+        max_turns (int | None): プロンプトに含める直近の発言数. Noneの場合は制限しない
+        max_tokens (int | None): 会話履歴のトークン数の上限. Noneの場合は制限しない
+        encoding (str): トークン数の計測に使用するtiktokenのエンコーディング
+        summarizer (Callable | None): 切り捨てた発言を要約する関数. 指定した場合は要約をプロンプトの先頭に含める
+        token_counter (Callable | None): tiktokenの代わりにトークン数を計測する関数
+
+    `summarizer`には`(これまでの要約, 新たに切り捨てた発言のリスト)`を受け取り、新しい要約を返す関数を指定します。
+    ```python
+    from sc_system_ai.template.conversation_summary import summarize_conversation
+
+    user.conversations.policy = HistoryPolicy(max_turns=20, max_tokens=2000, summarizer=summarize_conversation)
+    ```
+    """
+    max_turns: int | None = Field(default=None, description="プロンプトに含める直近の発言数")
+    max_tokens: int | None = Field(default=None, description="会話履歴のトークン数の上限")
+    encoding: str = Field(default="o200k_base", description="トークン数の計測に使用するtiktokenのエンコーディング")
+    summarizer: Callable[[str, list[tuple[str, str]]], str] | None = Field(
+        default=None, exclude=True, description="切り捨てた発言を要約する関数"
+    )
+    token_counter: Callable[[str], int] | None = Field(
+        default=None, exclude=True, description="tiktokenの代わりにトークン数を計測する関数"
+    )
+
+    @property
+    def tokenizer_key(self) -> str:
+        """発言ごとに保持するトークン数のキー"""
+        return self.encoding if self.token_counter is None else f"custom:{id(self.token_counter)}"
+
+    def count_tokens(self, text: str) -> int:
+        """テキストのトークン数を計測する関数"""
+        if self.token_counter is not None:
+            return self.token_counter(text) + MESSAGE_OVERHEAD_TOKENS
+        return len(_get_encoding(self.encoding).encode(text)) + MESSAGE_OVERHEAD_TOKENS
+
+
+class TrimReport(BaseModel):
+    """会話履歴の切り捨て結果を保持するクラス"""
+    trimmed_turns: int = Field(default=0, description="切り捨てた発言数")
+    trimmed_tokens: int = Field(default=0, description="切り捨てた発言のトークン数")
+    kept_tokens: int = Field(default=0, description="プロンプトに含めた会話履歴のトークン数")
+
 
 class Conversation(BaseModel):
     """会話の情報を保持するクラス"""
@@ -61,16 +133,105 @@ class Conversation(BaseModel):
 class ConversationHistory(BaseModel):
     """会話履歴を保持するクラス"""
     conversations: list[Conversation] = Field(default_factory=list, description="会話履歴のリスト")
+    policy: HistoryPolicy = Field(default_factory=HistoryPolicy, description="プロンプトに含める会話履歴の範囲")
+    summary: str = Field(default="", description="切り捨てた発言の要約")
+    summarized_turns: int = Field(default=0, description="要約済みの発言数")
+    _last_report: TrimReport = PrivateAttr(default_factory=TrimReport)
+    # 変換済みのLangChainのメッセージと、トークナイザごとの発言のトークン数
+    # いずれもconversationsと同じ位置に対応する
+    _messages: list[BaseMessage | None] = PrivateAttr(default_factory=list)
+    _token_counts: dict[str, list[int]] = PrivateAttr(default_factory=dict)
+    _source: list[Conversation] | None = PrivateAttr(default=None)
 
     def format_conversation(self) -> list:
-        """会話履歴をLangChainの会話履歴の形に整形して返す関数"""
-        chat_history: list[HumanMessage | AIMessage] = []
-        for conversation in self.conversations:
+        """
+        会話履歴をLangChainの会話履歴の形に整形して返す関数
+
+        `policy`に従って古い発言を切り捨て、切り捨てた発言数とトークン数を`get_trim_report`で取得できるようにします。
+        """
+        start, report = self._window_start()
+        chat_history: list[BaseMessage] = []
+        if self.policy.summarizer is not None:
+            self._update_summary(start)
+            # 要約済みの発言は要約としてのみ含める
+            start = max(start, self.summarized_turns)
+            if self.summary:
+                chat_history.append(SystemMessage(f"これまでの会話の要約:\n{self.summary}"))
+
+        chat_history.extend(m for m in self._converted_messages()[start:] if m is not None)
+
+        self._last_report = report
+        if report.trimmed_turns:
+            logger.info(
+                f"会話履歴を{report.trimmed_turns}件({report.trimmed_tokens}トークン)切り捨てました。"
+                f"残りの会話履歴: {report.kept_tokens}トークン"
+            )
+        return chat_history
+
+    def _sync_cache(self) -> None:
+        """
+        会話履歴のリストが置き換えられた、または短くなった場合にキャッシュを破棄する関数
+
+        会話履歴は追記のみを前提とし、キャッシュは追加された発言の分だけ更新します。
+        """
+        if self._source is not self.conversations or len(self._messages) > len(self.conversations):
+            self._messages = []
+            self._token_counts = {}
+            self._source = self.conversations
+
+    def _converted_messages(self) -> list[BaseMessage | None]:
+        """変換済みのメッセージを取得する関数。前回の呼び出しから追加された発言のみを変換する"""
+        self._sync_cache()
+        for conversation in self.conversations[len(self._messages):]:
             if conversation.role == "human":
-                chat_history.append(HumanMessage(conversation.content))
+                self._messages.append(HumanMessage(conversation.content))
             elif conversation.role == "ai":
-                chat_history.append(AIMessage(conversation.content))
-        return chat_history
+                self._messages.append(AIMessage(conversation.content))
+            else:
+                self._messages.append(None)
+        return self._messages
+
+    def _counted_tokens(self) -> list[int]:
+        """発言ごとのトークン数を取得する関数。前回の呼び出しから追加された発言のみを計測する"""
+        self._sync_cache()
+        policy = self.policy
+        counts = self._token_counts.setdefault(policy.tokenizer_key, [])
+        counts.extend(policy.count_tokens(c.content) for c in self.conversations[len(counts):])
+        return counts
+
+    def _window_start(self) -> tuple[int, TrimReport]:
+        """プロンプトに含める最初の発言の位置と切り捨ての結果を求める関数"""
+        policy = self.policy
+        total = len(self.conversations)
+        start = 0 if policy.max_turns is None else max(total - policy.max_turns, 0)
+
+        if policy.max_tokens is None and start == 0:
+            return 0, TrimReport()
+
+        # 新しい発言から順にトークン数の上限まで含める
+        counts = self._counted_tokens()
+        if policy.max_tokens is not None:
+            kept_tokens = 0
+            index = total
+            while index > start and kept_tokens + counts[index - 1] <= policy.max_tokens:
+                kept_tokens += counts[index - 1]
+                index -= 1
+            start = index
+        else:
+            kept_tokens = sum(counts[start:])
+        return start, TrimReport(trimmed_turns=start, trimmed_tokens=sum(counts[:start]), kept_tokens=kept_tokens)
+
+    def _update_summary(self, start: int) -> None:
+        """切り捨てた発言のうち、まだ要約していない発言を要約に追加する関数"""
+        if self.policy.summarizer is None or start <= self.summarized_turns:
+            return
+        new_turns = [(c.role, c.content) for c in self.conversations[self.summarized_turns:start]]
+        self.summary = self.policy.summarizer(self.summary, new_turns)
+        self.summarized_turns = start
+
+    def get_trim_report(self) -> TrimReport:
+        """直前の`format_conversation`で切り捨てた発言数とトークン数を取得する関数"""
+        return self._last_report
 
     def get_conversations(self) -> list[tuple[str, str]]:
         """会話履歴を取得する関数"""
@@ -104,8 +265,7 @@ class ConversationHistory(BaseModel):
         user.add_conversations_from_json(conversations)
         ```
         """
-        for role, content in conversations:
-            self.add_conversation(role, content)
+        self.conversations.extend(Conversation(role=role, content=content) for role, content in conversations)
 
 
 
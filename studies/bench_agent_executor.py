@@ -0,0 +1,69 @@
+"""
+### AgentExecutorキャッシュのマイクロベンチマーク
+
+偽のチャットモデルを使い、1ターンあたりのフレームワークのオーバーヘッドを計測します。
+- before: 毎ターン`create_tool_calling_agent`と`AgentExecutor`を作成する(以前の実装)
+- after: `Agent._get_executor`でキャッシュ済みのAgentExecutorを取得する
+
+```bash
+cd studies
+python bench_agent_executor.py
+```
+"""
+import time
+
+from fake_models import FakeChatModel
+from langchain.agents import AgentExecutor, create_tool_calling_agent
+
+from sc_system_ai.agents.tools import magic_function
+from sc_system_ai.template.agent import Agent
+from sc_system_ai.template.user_prompts import User
+
+TURNS = 200
+
+
+def build_agent() -> Agent:
+    user = User(name="hogehoge", major="fugafuga専攻")
+    user.conversations.add_conversations_list([
+        ("human", "こんにちは!"),
+        ("ai", "本日はどのようなご用件でしょうか？"),
+    ])
+    agent = Agent(llm=FakeChatModel(), user_info=user)  # type: ignore[arg-type]
+    agent.set_assistant_info("あなたは優秀な校正者です。")
+    agent.set_tools([magic_function])
+    return agent
+
+
+def legacy_executor(agent: Agent) -> AgentExecutor:
+    tool_calling_agent = create_tool_calling_agent(
+        llm=agent.llm,
+        tools=agent.tool.tools,
+        prompt=agent.prompt_template.full_prompt
+    )
+    return AgentExecutor(agent=tool_calling_agent, tools=agent.tool.tools)
+
+
+def bench(label: str, agent: Agent, get_executor: str) -> None:
+    inputs = {
+        "chat_history": agent.user_info.conversations.format_conversation(),
+        "messages": "こんにちは",
+    }
+
+    start = time.perf_counter()
+    for _ in range(TURNS):
+        legacy_executor(agent) if get_executor == "legacy" else agent._get_executor()
+    build = (time.perf_counter() - start) / TURNS
+
+    start = time.perf_counter()
+    for _ in range(TURNS):
+        executor = legacy_executor(agent) if get_executor == "legacy" else agent._get_executor()
+        executor.invoke(inputs)
+    turn = (time.perf_counter() - start) / TURNS
+
+    print(f"{label:<8} executor取得: {build * 1e6:9.1f} us/turn   1ターン全体: {turn * 1e3:7.3f} ms/turn")
+
+
+if __name__ == "__main__":
+    agent = build_agent()
+    bench("before", agent, "legacy")
+    bench("after", agent, "cached")
@@ -0,0 +1,78 @@
+"""
+### documentの一括登録のベンチマーク
+
+1学期分の学校の案内を想定した`DOCUMENTS`件のMarkdownを登録し、docs/sとchunks/sを比較します。
+埋め込みは1回のリクエストを`EMBEDDING_LATENCY`秒、Cosmos DBへの書き込みは1件を`UPSERT_LATENCY`秒として再現します。
+- serial: `create_document`を1件ずつ呼び出す(以前の方法)
+- bulk: `create_documents_bulk`でプロセスプールで分割し、埋め込みをまとめ、upsertを並行して行う
+
+```bash
+cd studies
+python bench_bulk_ingest.py
+```
+"""
+import random
+import time
+from collections.abc import Callable
+
+from fake_cosmos import FakeCosmosClient
+from langchain_core.embeddings import Embeddings
+
+from sc_system_ai.template.azure_cosmos import BulkDocument, CosmosDBManager
+
+DOCUMENTS = 200
+EMBEDDING_LATENCY = 0.05
+UPSERT_LATENCY = 0.005
+
+
+class SlowEmbeddings(Embeddings):
+    """1回のリクエストごとに待つ偽の埋め込みモデル"""
+    def __init__(self) -> None:
+        self.requests = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.requests += 1
+        time.sleep(EMBEDDING_LATENCY)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def build_documents() -> list[BulkDocument]:
+    rng = random.Random(0)
+    documents = []
+    for i in range(DOCUMENTS):
+        sections = [
+            f"## 項目{j}\n\n" + "京都テックの手続きについて説明します。" * rng.randint(10, 60)
+            for j in range(rng.randint(2, 6))
+        ]
+        documents.append(BulkDocument(f"# 案内{i}\n\n" + "\n\n".join(sections), "markdown", f"案内{i}", i))
+    return documents
+
+
+def bench(label: str, ingest: Callable[[CosmosDBManager, list[BulkDocument]], int]) -> None:
+    client = FakeCosmosClient(latency=UPSERT_LATENCY)
+    embedding = SlowEmbeddings()
+    manager = CosmosDBManager(cosmos_client=client, embedding=embedding)  # type: ignore[arg-type]
+    documents = build_documents()
+    start = time.perf_counter()
+    chunks = ingest(manager, documents)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:<7} {elapsed:6.2f} s  {len(documents) / elapsed:7.1f} docs/s  {chunks / elapsed:7.1f} chunks/s  "
+        f"埋め込みのリクエスト: {embedding.requests}回"
+    )
+
+
+def serial(manager: CosmosDBManager, documents: list[BulkDocument]) -> int:
+    return sum(len(manager.create_document(*document)) for document in documents)
+
+
+def bulk(manager: CosmosDBManager, documents: list[BulkDocument]) -> int:
+    return manager.create_documents_bulk(documents).chunks
+
+
+if __name__ == "__main__":
+    bench("serial", serial)
+    bench("bulk", bulk)
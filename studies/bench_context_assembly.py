@@ -0,0 +1,71 @@
+"""
+### 学校の情報の組み立てのベンチマーク
+
+長い文書を`text_formatter`で分割したchunkを検索結果として、プロンプトに含める学校の情報の大きさを比較します。
+同じエージェントで`TURNS`回質問する想定です。
+- before: 検索結果の全文を`assistant_info`に追加し続ける(以前の実装)
+- after: しきい値、重複の除去、隣接するchunkの結合、トークン数の上限で組み立てる現在の実装
+
+トークン数はtiktokenで計測します(取得できない環境では文字数)。
+
+```bash
+cd studies
+python bench_context_assembly.py
+```
+"""
+import random
+import time
+
+from langchain_core.documents import Document
+
+from sc_system_ai.template.context_assembly import ContextPolicy, assemble_context
+from sc_system_ai.template.document_formatter import text_formatter
+
+TURNS = 5
+FETCH_K = 6
+TOP_K = 2
+
+
+def build_chunks() -> list[Document]:
+    rng = random.Random(0)
+    chunks: list[Document] = []
+    for source_id in range(20):
+        paragraphs = [
+            f"{source_id}番目の案内の{i}段落目です。" + "京都テックの手続きについて説明します。" * rng.randint(5, 15)
+            for i in range(8)
+        ]
+        docs = text_formatter("\n\n".join(paragraphs), title=f"案内{source_id}", metadata={"source_id": source_id})
+        for i, doc in enumerate(docs):
+            doc.metadata["id"] = f"{source_id}-{i}"
+        chunks.extend(docs)
+    return chunks
+
+
+def main() -> None:
+    chunks = build_chunks()
+    rng = random.Random(1)
+    policy = ContextPolicy()
+
+    before = ""
+    for turn in range(1, TURNS + 1):
+        # 同じ文書の隣接するchunkと、スコアの低い無関係なchunkを含む検索結果
+        start = rng.randrange(len(chunks) - FETCH_K)
+        results: list[tuple[Document, float | None]] = [
+            (chunk, 0.8 - i * 0.1) for i, chunk in enumerate(chunks[start:start + FETCH_K])
+        ]
+        for doc, _ in results[:TOP_K]:
+            before += f"### {doc.metadata['title']}\n" + doc.page_content + "\n"
+
+        began = time.perf_counter()
+        context = assemble_context(results, policy)
+        elapsed = time.perf_counter() - began
+        print(
+            f"turn {turn}: before {policy.count_tokens(before):6d} tokens   "
+            f"after {context.used_tokens:6d} tokens ({context.sections} sections, "
+            f"merged {context.merged}, dropped {context.dropped_by_score + context.dropped_by_budget})   "
+            f"組み立て: {elapsed * 1e3:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
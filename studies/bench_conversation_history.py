@@ -0,0 +1,67 @@
+"""
+### 会話履歴の変換ベンチマーク
+
+1k〜10k件の会話履歴について、読み込みとLangChain形式への変換にかかる時間を計測します。
+1ターンごとに分類エージェントと呼び出し先のエージェントが`format_conversation`を呼び出す想定で、
+発言を1件追加するたびに`CHAIN`回変換します。
+- before: 発言ごとに`add_conversation`で追加し、毎回全ての履歴を変換する(以前の実装)
+- after: 一括で追加し、追加された発言のみを変換する現在の実装
+
+```bash
+cd studies
+python bench_conversation_history.py
+```
+"""
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from sc_system_ai.template.user_prompts import ConversationHistory
+
+CHAIN = 3
+TURNS = 50
+
+
+def legacy_add(history: ConversationHistory, conversations: list[tuple[str, str]]) -> None:
+    for role, content in conversations:
+        history.add_conversation(role, content)
+
+
+def legacy_format(history: ConversationHistory) -> list:
+    chat_history: list[HumanMessage | AIMessage] = []
+    for conversation in history.conversations:
+        if conversation.role == "human":
+            chat_history.append(HumanMessage(conversation.content))
+        elif conversation.role == "ai":
+            chat_history.append(AIMessage(conversation.content))
+    return chat_history
+
+
+def bench(size: int) -> None:
+    conversations = [
+        ("human" if i % 2 == 0 else "ai", f"{i}番目の発言です。京都テックの授業について教えてください。")
+        for i in range(size)
+    ]
+
+    for label in ("before", "after"):
+        history = ConversationHistory()
+        start = time.perf_counter()
+        if label == "before":
+            legacy_add(history, conversations)
+        else:
+            history.add_conversations_list(conversations)
+        load = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(TURNS):
+            history.add_conversation("human" if i % 2 == 0 else "ai", "追加の発言です。")
+            for _ in range(CHAIN):
+                legacy_format(history) if label == "before" else history.format_conversation()
+        turn = (time.perf_counter() - start) / TURNS
+
+        print(f"{label:<7} N={size:<6} 読み込み: {load * 1e3:8.2f} ms   1ターンの変換: {turn * 1e3:8.3f} ms")
+
+
+if __name__ == "__main__":
+    for size in (1_000, 5_000, 10_000):
+        bench(size)
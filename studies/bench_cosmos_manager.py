@@ -0,0 +1,49 @@
+"""
+### CosmosDBManagerの再利用のベンチマーク
+
+ローカルのCosmos DBの代替(1往復2ms)に対して、1回の検索にかかる時間と通信回数を計測します。
+- before: 検索ごとに`CosmosDBManager()`を作成する(以前の`search_school_database_cosmos`)
+- after: `get_cosmos_manager()`で共有のCosmosDBManagerを再利用する
+
+```bash
+cd studies
+python bench_cosmos_manager.py
+```
+"""
+import time
+from collections.abc import Callable
+from typing import Any
+
+from fake_cosmos import FakeCosmosClient
+from fake_models import FakeEmbeddings
+
+from sc_system_ai.template import azure_cosmos
+from sc_system_ai.template.azure_cosmos import CosmosDBManager, get_cosmos_manager
+
+SEARCHES = 200
+
+
+def bench(label: str, search: Callable[[], Any], client: FakeCosmosClient) -> None:
+    start = time.perf_counter()
+    for _ in range(SEARCHES):
+        search()
+    elapsed = (time.perf_counter() - start) / SEARCHES
+    print(f"{label:<7} {elapsed * 1e3:7.3f} ms/search  通信: {client.container.requests / SEARCHES:4.1f}回/search")
+
+
+if __name__ == "__main__":
+    embedding = FakeEmbeddings(size=8)
+
+    client = FakeCosmosClient()
+    bench(
+        "before",
+        lambda: CosmosDBManager(cosmos_client=client, embedding=embedding).similarity_search("京都テック", k=2),  # type: ignore[arg-type]
+        client,
+    )
+
+    client = FakeCosmosClient()
+    # 共有のCosmosDBManagerを代替のクライアントで作成する
+    azure_cosmos._cosmos_manager = azure_cosmos._Lazy(
+        lambda: CosmosDBManager(cosmos_client=client, embedding=embedding)  # type: ignore[arg-type]
+    )
+    bench("after", lambda: get_cosmos_manager().similarity_search("京都テック", k=2), client)
@@ -0,0 +1,77 @@
+"""
+### documentの埋め込みのストアのベンチマーク
+
+全てのdocumentに同じ案内文と問い合わせ先の節を含む`DOCUMENTS`件のMarkdownを`create_documents_bulk`で登録し、
+埋め込みを作成したchunkの数と文字数を比較します。
+- no store: ストアを使用しない(以前の方法)
+- store 1st: ストアを使用した初回の登録。同じ本文の節は1回のみ埋め込む
+- store 2nd: 同じストアで全てのdocumentを再登録する(移行や作り直しを想定)
+
+```bash
+cd studies
+python bench_document_embedding_store.py
+```
+"""
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from fake_cosmos import FakeCosmosClient
+from langchain_core.embeddings import Embeddings
+
+from sc_system_ai.template.azure_cosmos import BulkDocument, CosmosDBManager
+from sc_system_ai.template.embedding_cache import SQLiteEmbeddingStore
+
+DOCUMENTS = 200
+EMBEDDING_LATENCY = 0.05
+
+NOTICE = "## ご利用にあたって\n\n" + "この案内は在学生向けの情報です。内容は予告なく変更される場合があります。" * 10
+CONTACT = "## お問い合わせ\n\n" + "ご不明な点は京都テック事務局の窓口までお問い合わせください。" * 10
+
+
+class SlowEmbeddings(Embeddings):
+    def __init__(self) -> None:
+        self.texts = 0
+        self.characters = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(EMBEDDING_LATENCY)
+        self.texts += len(texts)
+        self.characters += sum(len(text) for text in texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def build_documents() -> list[BulkDocument]:
+    rng = random.Random(0)
+    return [
+        BulkDocument(
+            f"# 案内{i}\n\n{NOTICE}\n\n## 内容\n\n" + f"案内{i}の手続きについて説明します。" * rng.randint(10, 25)
+            + f"\n\n{CONTACT}",
+            "markdown",
+            f"案内{i}",
+            i,
+        )
+        for i in range(DOCUMENTS)
+    ]
+
+
+def bench(label: str, store: SQLiteEmbeddingStore | None) -> None:
+    embedding = SlowEmbeddings()
+    manager = CosmosDBManager(cosmos_client=FakeCosmosClient(latency=0.0), embedding=embedding)  # type: ignore[arg-type]
+    manager.set_document_embedding_store(store)
+    result = manager.create_documents_bulk(build_documents(), processes=0)
+    print(
+        f"{label:<9} {result.chunks:4d} chunk  埋め込み: {embedding.texts:4d} chunk ({embedding.characters:7d}文字)  "
+        f"埋め込みの時間: {result.embedding_seconds * 1e3:6.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        bench("no store", None)
+        bench("store 1st", SQLiteEmbeddingStore(Path(directory) / "documents"))
+        bench("store 2nd", SQLiteEmbeddingStore(Path(directory) / "documents"))
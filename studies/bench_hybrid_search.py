@@ -0,0 +1,134 @@
+"""
+### ハイブリッド検索の再現率と検索時間のベンチマーク
+
+合成したchunkのコーパスに対して、ベクトル検索、BM25、ハイブリッド検索(RRF)の上位k件の再現率と検索時間を計測します。
+
+- 埋め込みは話題ごとのベクトルにノイズを加えたもので再現する。ベクトル検索は話題は当てられるが、
+  手続き名のような固有の語句の一致は区別できない
+- exact: 「奨学金の〇〇届について」のように固有の語句を含む質問。正解はその語句を含むchunk
+- semantic: 「授業を休むには」のように語句が一致しない言い換えの質問。正解は同じ話題のchunk
+
+```bash
+cd studies
+python bench_hybrid_search.py
+```
+"""
+import hashlib
+import random
+import time
+from collections.abc import Callable
+from typing import Any
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from sc_system_ai.template.hybrid_search import BM25Index, HybridSearcher
+from sc_system_ai.template.local_vector_index import LocalVectorIndex
+
+DIM = 64
+K = 2
+QUERIES = 200
+NOISE = 0.6
+
+TOPICS = {
+    "公欠": "授業を休む",
+    "学食": "お昼ご飯を食べる",
+    "奨学金": "学費の支援を受ける",
+    "履修登録": "受ける授業を選ぶ",
+    "学生寮": "学校の近くに住む",
+    "就職支援": "仕事を探す",
+    "図書館": "本を借りる",
+    "資格取得": "検定を受ける",
+}
+KANJI = "甲乙丙丁戊己庚辛壬癸申酉戌亥寅卯辰巳午未"
+
+
+class TopicEmbeddings(Embeddings):
+    """話題のベクトルにテキストのハッシュから作るノイズを加えた偽の埋め込みモデル"""
+    def __init__(self) -> None:
+        rng = np.random.default_rng(0)
+        self.topics = {topic: rng.standard_normal(DIM) for topic in TOPICS}
+
+    def embed_query(self, text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:4], "little")
+        vector = NOISE * np.random.default_rng(seed).standard_normal(DIM)
+        for topic, paraphrase in TOPICS.items():
+            if topic in text or paraphrase in text:
+                vector += self.topics[topic]
+        return list(vector)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+class CorpusSource:
+    """合成したchunkを返す読み込み元"""
+    _embedding_key = "embedding"
+
+    def __init__(self, documents: list[Document]) -> None:
+        self._embedding = TopicEmbeddings()
+        self.documents = documents
+        self.vectors = self._embedding.embed_documents([doc.page_content for doc in documents])
+
+    def read_all_documents(self, with_metadata: bool = False, with_embedding: bool = False) -> list[Document]:
+        return [
+            Document(page_content=doc.page_content, metadata={**doc.metadata, "embedding": vector})
+            for doc, vector in zip(self.documents, self.vectors, strict=True)
+        ]
+
+    def read_item(self, values: Any = None, condition: Any = None) -> list[dict[str, Any]]:
+        raise ValueError
+
+
+def build_corpus(size: int) -> tuple[list[Document], list[tuple[str, set[str]]], list[tuple[str, set[str]]]]:
+    rng = random.Random(0)
+    documents: list[Document] = []
+    exact: list[tuple[str, set[str]]] = []
+    by_topic: dict[str, set[str]] = {topic: set() for topic in TOPICS}
+    for i in range(size):
+        topic = list(TOPICS)[i % len(TOPICS)]
+        term = "".join(rng.choices(KANJI, k=4)) + "届"
+        _id = f"doc-{i}"
+        documents.append(Document(
+            page_content=f"{topic}に関するお知らせです。{term}の手続きは事務局の窓口で受け付けます。",
+            metadata={"id": _id, "title": f"{topic}について"},
+        ))
+        by_topic[topic].add(_id)
+        exact.append((f"{topic}の{term}について教えてください", {_id}))
+    semantic = [(f"{paraphrase}にはどうすればいいですか", by_topic[topic]) for topic, paraphrase in TOPICS.items()]
+    return documents, rng.sample(exact, QUERIES), semantic * (QUERIES // len(semantic))
+
+
+def evaluate(label: str, search: Callable[[str], list[Document]], queries: list[tuple[str, set[str]]]) -> str:
+    start = time.perf_counter()
+    hits = sum(bool({doc.metadata["id"] for doc in search(query)} & relevant) for query, relevant in queries)
+    elapsed = (time.perf_counter() - start) / len(queries)
+    return f"{label}: recall@{K} {hits / len(queries):5.3f} {elapsed * 1e3:6.3f} ms"
+
+
+def bench(size: int) -> None:
+    documents, exact, semantic = build_corpus(size)
+    source = CorpusSource(documents)
+    vector_index = LocalVectorIndex(source, refresh_interval=None)  # type: ignore[arg-type]
+    vector_index.refresh()
+    searcher = HybridSearcher(source=source, vector_store=vector_index, refresh_interval=None)  # type: ignore[arg-type]
+
+    start = time.perf_counter()
+    searcher.refresh()
+    build = time.perf_counter() - start
+
+    bm25: BM25Index = searcher.index
+    strategies: dict[str, Callable[[str], list[Document]]] = {
+        "vector": lambda query: vector_index.similarity_search(query, k=K),
+        "bm25": lambda query: [doc for doc, _ in bm25.search(query, k=K)],
+        "hybrid": lambda query: searcher.search(query, k=K),
+    }
+    print(f"N={size}  BM25の索引の作成: {build * 1e3:.0f} ms")
+    for label, search in strategies.items():
+        print(f"  {label:<7} {evaluate('exact', search, exact)}   {evaluate('semantic', search, semantic)}")
+
+
+if __name__ == "__main__":
+    for size in (1_000, 10_000):
+        bench(size)
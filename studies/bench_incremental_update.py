@@ -0,0 +1,146 @@
+"""
+### documentのtextの差分更新のベンチマーク
+
+`SECTIONS`節の学生便覧のうち1節を書き換えたときの、埋め込みを作成したchunkの数と文字数、書き込みの回数を比較します。
+埋め込みは1回のリクエストを`EMBEDDING_LATENCY`秒、Cosmos DBへの書き込みは1回を`WRITE_LATENCY`秒として再現します。
+- before: 全てのchunkを削除し、`create_document`で作成し直す(以前の`_text_updater`)
+- after: 本文のハッシュで比較し、変わったchunkのみ埋め込みを作成して書き込む
+
+```bash
+cd studies
+python bench_incremental_update.py
+```
+"""
+import copy
+import re
+import time
+from collections import Counter
+from typing import Any
+
+from langchain_core.embeddings import Embeddings
+
+from sc_system_ai.template.azure_cosmos import CosmosDBManager
+
+SECTIONS = 50
+EMBEDDING_LATENCY = 0.05
+WRITE_LATENCY = 0.005
+
+
+class SlowEmbeddings(Embeddings):
+    def __init__(self) -> None:
+        self.texts = 0
+        self.characters = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(EMBEDDING_LATENCY)
+        self.texts += len(texts)
+        self.characters += sum(len(text) for text in texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+class MemoryContainer:
+    """read_itemのクエリに対応し、書き込みの種類ごとの回数を数えるコンテナ"""
+    def __init__(self) -> None:
+        self.items: dict[str, dict[str, Any]] = {}
+        self.writes: Counter[str] = Counter()
+
+    def query_items(self, query: str, parameters: list[dict[str, Any]] | None = None, **kwargs: Any) -> list[Any]:
+        values = {p["name"]: p["value"] for p in parameters or []}
+        conditions = [(key.split("."), values[name]) for key, name in re.findall(r"c\.([\w.]+) = (@\w+)", query)]
+
+        def lookup(item: dict[str, Any], path: list[str]) -> Any:
+            for key in path:
+                item = item.get(key, {})
+            return item
+
+        return [
+            copy.deepcopy(item) for item in self.items.values()
+            if all(lookup(item, path) == value for path, value in conditions)
+        ]
+
+    def _write(self, kind: str) -> None:
+        self.writes[kind] += 1
+        time.sleep(WRITE_LATENCY)
+
+    def create_item(self, body: dict[str, Any], **kwargs: Any) -> dict[str, Any]:
+        return self.upsert_item(body)
+
+    def upsert_item(self, body: dict[str, Any], **kwargs: Any) -> dict[str, Any]:
+        self._write("upsert")
+        self.items[body["id"]] = copy.deepcopy(body)
+        return body
+
+    def delete_item(self, item: str, partition_key: str) -> None:
+        self._write("delete")
+        del self.items[item]
+
+    def patch_item(self, item: str, partition_key: str, patch_operations: list[dict[str, Any]]) -> None:
+        self._write("patch")
+        metadata = self.items[item]["metadata"]
+        for operation in patch_operations:
+            key = operation["path"].removeprefix("/metadata/")
+            if operation["op"] == "remove":
+                metadata.pop(key, None)
+            else:
+                metadata[key] = operation["value"]
+
+
+class MemoryClient:
+    def __init__(self) -> None:
+        self.container = MemoryContainer()
+
+    def create_database_if_not_exists(self, **kwargs: Any) -> "MemoryClient":
+        return self
+
+    def create_container_if_not_exists(self, **kwargs: Any) -> MemoryContainer:
+        return self.container
+
+
+def handbook(edited: int | None = None) -> str:
+    sections = [
+        f"## 第{i}節\n\n" + ("改訂した" if i == edited else "") + f"第{i}節の規程について説明します。" * 20
+        for i in range(1, SECTIONS + 1)
+    ]
+    return "# 学生便覧\n\n" + "\n\n".join(sections)
+
+
+def recreate(manager: CosmosDBManager, source_id: int, text: str) -> list[str]:
+    """以前の`_text_updater`と同じく、全てのchunkを削除して作成し直す"""
+    items = manager.read_item(values=["id", "metadata"], condition={"metadata.source_id": source_id})
+    created_at = items[0]["metadata"]["created_at"]
+    for item in items:
+        manager.delete_document_by_id(item["id"])
+    ids = manager.create_document(text, "markdown", source_id=source_id)
+    patch = [{"op": "replace", "path": "/metadata/created_at", "value": created_at}]
+    for _id in ids:
+        manager._container.patch_item(item=_id, partition_key=_id, patch_operations=patch)
+    return ids
+
+
+def bench(label: str, incremental: bool) -> None:
+    client = MemoryClient()
+    embedding = SlowEmbeddings()
+    manager = CosmosDBManager(cosmos_client=client, embedding=embedding)  # type: ignore[arg-type]
+    manager.create_document(handbook(), "markdown", source_id=1)
+    embedding.texts = embedding.characters = 0
+    client.container.writes.clear()
+
+    start = time.perf_counter()
+    if incremental:
+        manager.update_document(source_id=1, text=handbook(edited=25), text_type="markdown")
+    else:
+        recreate(manager, 1, handbook(edited=25))
+    elapsed = time.perf_counter() - start
+    writes = client.container.writes
+    print(
+        f"{label:<7} {elapsed * 1e3:7.1f} ms  埋め込み: {embedding.texts:3d} chunk ({embedding.characters:6d}文字)  "
+        f"書き込み: {sum(writes.values()):3d}回 {dict(writes)}"
+    )
+
+
+if __name__ == "__main__":
+    bench("before", incremental=False)
+    bench("after", incremental=True)
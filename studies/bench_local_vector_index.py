@@ -0,0 +1,80 @@
+"""
+### ローカルのベクトルインデックスのベンチマーク
+
+1536次元の埋め込みを持つN件のdocumentについて、ローカルのインデックスの検索時間とメモリ使用量を計測します。
+- cosmos: Cosmos DBへのベクトル検索(1往復を`COSMOS_LATENCY`秒として再現)
+- float32: ローカルのインデックス
+- int8: int8に量子化したローカルのインデックス。float32の上位k件との一致率(recall@k)も表示する
+
+```bash
+cd studies
+python bench_local_vector_index.py
+```
+"""
+import time
+from collections.abc import Iterator
+from typing import Any
+
+import numpy as np
+from fake_models import FakeEmbeddings
+from langchain_core.documents import Document
+
+from sc_system_ai.template.azure_cosmos import READ_PAGE_SIZE, DocumentPage
+from sc_system_ai.template.local_vector_index import LocalVectorIndex
+
+DIM = 1536
+K = 5
+SEARCHES = 200
+COSMOS_LATENCY = 0.02
+
+
+class RandomSource:
+    """ランダムな埋め込みを持つdocumentを返す読み込み元"""
+    _embedding_key = "embedding"
+
+    def __init__(self, size: int) -> None:
+        self._embedding = FakeEmbeddings(size=DIM)
+        self.vectors = np.random.default_rng(0).standard_normal((size, DIM)).astype(np.float32)
+
+    def iter_document_pages(self, *args: Any, **kwargs: Any) -> Iterator[DocumentPage]:
+        for start in range(0, len(self.vectors), READ_PAGE_SIZE):
+            yield DocumentPage(
+                [
+                    Document(page_content=f"京都テックの情報{i}", metadata={"id": f"doc-{i}", "embedding": vector})
+                    for i, vector in enumerate(self.vectors[start:start + READ_PAGE_SIZE], start=start)
+                ],
+                None,
+            )
+
+    def read_item(self, values: Any = None, condition: Any = None) -> list[dict[str, Any]]:
+        raise ValueError
+
+
+def bench(size: int) -> None:
+    source = RandomSource(size)
+    queries = np.random.default_rng(1).standard_normal((SEARCHES, DIM)).astype(np.float32)
+    print(f"cosmos  N={size:<7} {COSMOS_LATENCY * 1e3:9.3f} ms/search")
+
+    expected: list[list[str]] = []
+    for quantize in (False, True):
+        index = LocalVectorIndex(source, quantize=quantize, refresh_interval=None)  # type: ignore[arg-type]
+        index.refresh()
+        start = time.perf_counter()
+        results = [index.search_by_vector(query, K) for query in queries]
+        elapsed = (time.perf_counter() - start) / SEARCHES
+        ids = [[doc.metadata["id"] for doc, _ in result] for result in results]
+        memory = index._current().vectors.nbytes / 2**20
+
+        label = "int8" if quantize else "float32"
+        line = f"{label:<7} N={size:<7} {elapsed * 1e3:9.3f} ms/search  行列: {memory:7.1f} MiB"
+        if quantize:
+            recall = np.mean([len(set(a) & set(b)) / K for a, b in zip(ids, expected, strict=True)])
+            line += f"  recall@{K}: {recall:.3f}"
+        else:
+            expected = ids
+        print(line)
+
+
+if __name__ == "__main__":
+    for size in (1_000, 10_000, 50_000):
+        bench(size)
@@ -0,0 +1,132 @@
+"""
+### MMRによる検索結果の並べ替えのベンチマーク
+
+`text_formatter`で分割した文書のchunkをローカルのインデックスに読み込み、上位k件(plain)とMMRで選んだk件について、
+プロンプトに含める学校の情報のトークン数、含まれる文書の数、検索時間を比較します。
+
+- 埋め込みは話題のベクトル、文書のベクトル、chunkごとのノイズの和で再現する。
+  同じ文書の隣接するchunkはほぼ同じベクトルになる
+- 質問は話題と、その話題の文書の1つに寄せたベクトル。plainでは同じ文書のchunkが上位を占める
+- langchain: langchain_communityの`maximal_marginal_relevance`で並べ替えた場合の時間
+
+トークン数はtiktokenで計測します(取得できない環境では文字数)。
+
+```bash
+cd studies
+python bench_mmr.py
+```
+"""
+import random
+import statistics
+import time
+from collections.abc import Callable, Iterator
+from typing import Any
+
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance as langchain_mmr
+from langchain_core.documents import Document
+
+from sc_system_ai.template.azure_cosmos import DocumentPage, remove_document_change_listener
+from sc_system_ai.template.context_assembly import ContextPolicy, assemble_context
+from sc_system_ai.template.document_formatter import text_formatter
+from sc_system_ai.template.local_vector_index import LocalVectorIndex
+from sc_system_ai.template.mmr import maximal_marginal_relevance
+
+DIM = 1536
+TOPICS = 8
+DOCUMENTS_PER_TOPIC = 25
+K = 6
+FETCH_K = 20
+QUESTIONS = 200
+
+
+class ChunkSource:
+    """合成した埋め込みを持つchunkを返す読み込み元"""
+    _embedding_key = "embedding"
+    _embedding = None
+
+    def __init__(self, documents: list[Document]) -> None:
+        self.documents = documents
+
+    def iter_document_pages(self, *args: Any, **kwargs: Any) -> Iterator[DocumentPage]:
+        documents = [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in self.documents]
+        yield DocumentPage(documents, None)
+
+    def read_item(self, values: Any = None, condition: Any = None) -> list[dict[str, Any]]:
+        raise ValueError
+
+
+def build_corpus() -> tuple[list[Document], list[np.ndarray]]:
+    rng = random.Random(0)
+    vectors = np.random.default_rng(0)
+    topics = vectors.standard_normal((TOPICS, DIM))
+    chunks: list[Document] = []
+    queries: list[np.ndarray] = []
+    for source_id in range(TOPICS * DOCUMENTS_PER_TOPIC):
+        topic = topics[source_id % TOPICS]
+        own = vectors.standard_normal(DIM)
+        paragraphs = [
+            f"{source_id}番目の案内の{i}段落目です。" + "京都テックの手続きについて説明します。" * rng.randint(5, 15)
+            for i in range(8)
+        ]
+        docs = text_formatter("\n\n".join(paragraphs), title=f"案内{source_id}", metadata={"source_id": source_id})
+        for i, doc in enumerate(docs):
+            doc.metadata["id"] = f"{source_id}-{i}"
+            doc.metadata["embedding"] = list(topic + own + 0.2 * vectors.standard_normal(DIM))
+        chunks.extend(docs)
+        queries.append(topic + 0.5 * own + 0.5 * vectors.standard_normal(DIM))
+    return chunks, rng.sample(queries, QUESTIONS)
+
+
+def measure(
+    label: str,
+    search: Callable[[np.ndarray], list[tuple[Document, float]]],
+    queries: list[np.ndarray],
+    policy: ContextPolicy,
+) -> None:
+    tokens: list[int] = []
+    documents: list[int] = []
+    start = time.perf_counter()
+    results = [search(query) for query in queries]
+    elapsed = (time.perf_counter() - start) / len(queries)
+    for result in results:
+        context = assemble_context(list(result), policy)
+        tokens.append(context.used_tokens)
+        documents.append(len({doc.metadata["source_id"] for doc, _ in result}))
+    print(
+        f"{label:<16} tokens/answer {statistics.mean(tokens):7.1f}   "
+        f"documents {statistics.mean(documents):4.2f}/{K}   "
+        f"tokens/document {statistics.mean(t / d for t, d in zip(tokens, documents, strict=True)):7.1f}   "
+        f"search {elapsed * 1e3:6.3f} ms"
+    )
+
+
+def main() -> None:
+    chunks, queries = build_corpus()
+    index = LocalVectorIndex(ChunkSource(chunks), refresh_interval=None)  # type: ignore[arg-type]
+    index.refresh()
+    remove_document_change_listener(index.on_document_change)
+    # 上限を設けず、選んだ結果がそのまま含まれる場合のトークン数を比較する
+    policy = ContextPolicy(min_score=None, max_tokens=None)
+    print(f"chunks={len(index)}  k={K}  fetch_k={FETCH_K}")
+
+    measure("plain", lambda query: index.search_by_vector(query, K), queries, policy)
+    for lambda_mult in (0.7, 0.5, 0.3):
+        def search(query: np.ndarray, lambda_mult: float = lambda_mult) -> list[tuple[Document, float]]:
+            return index.max_marginal_relevance_search_by_vector(query, K, FETCH_K, lambda_mult)
+        measure(f"mmr lambda={lambda_mult}", search, queries, policy)
+
+    # 並べ替えのみの時間の比較
+    candidates = np.random.default_rng(1).standard_normal((FETCH_K, DIM)).astype(np.float32)
+    for label, rerank in {
+        "numpy": lambda: maximal_marginal_relevance(queries[0], candidates, K),
+        "langchain": lambda: langchain_mmr(queries[0], list(candidates), k=K),
+    }.items():
+        start = time.perf_counter()
+        for _ in range(QUESTIONS):
+            rerank()
+        print(f"rerank {label:<9} {(time.perf_counter() - start) / QUESTIONS * 1e3:6.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+### 複数の検索ワードによる検索のベンチマーク
+
+「奨学金 学生寮」のように2つの話題を含む検索ワードについて、
+検索結果が含む話題の割合(話題の再現率)と検索時間を計測します。
+埋め込みの呼び出しは1回`EMBEDDING_LATENCY`秒、ベクトル検索は1回`SEARCH_LATENCY`秒かかるものとします。
+- single: 検索ワード全体を1つのクエリとして検索する(以前の実装)
+- serial: サブクエリごとに埋め込みと検索を順番に行う
+- multi: サブクエリをまとめて埋め込み、並行して検索する現在の実装
+
+```bash
+cd studies
+python bench_multi_query.py
+```
+"""
+import asyncio
+import itertools
+import time
+from collections.abc import Awaitable, Callable
+
+from bench_hybrid_search import TOPICS, CorpusSource, TopicEmbeddings, build_corpus
+from langchain_core.documents import Document
+
+from sc_system_ai.template.embedding_cache import CachedEmbeddings
+from sc_system_ai.template.hybrid_search import reciprocal_rank_fusion
+from sc_system_ai.template.local_vector_index import LocalVectorIndex
+from sc_system_ai.template.multi_query_search import amulti_query_search, split_search_words
+
+TOP_K = 2
+MAX_RESULTS = 4
+EMBEDDING_LATENCY = 0.03
+SEARCH_LATENCY = 0.02
+
+
+class DelayedEmbeddings(TopicEmbeddings):
+    async def aembed_query(self, text: str) -> list[float]:
+        await asyncio.sleep(EMBEDDING_LATENCY)
+        return self.embed_query(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        await asyncio.sleep(EMBEDDING_LATENCY)
+        return self.embed_documents(texts)
+
+
+class DelayedStore:
+    """ローカルのインデックスの検索に通信の待ち時間を加えた検索先"""
+    def __init__(self, index: LocalVectorIndex) -> None:
+        self.index = index
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: list[float], k: int = 4
+    ) -> list[tuple[Document, float]]:
+        time.sleep(SEARCH_LATENCY)
+        return self.index.search_by_vector(embedding, k)
+
+    async def asimilarity_search_by_vector_with_score(
+        self, embedding: list[float], k: int = 4
+    ) -> list[tuple[Document, float]]:
+        await asyncio.sleep(SEARCH_LATENCY)
+        return self.index.search_by_vector(embedding, k)
+
+
+def topic_of(document: Document) -> str:
+    return str(document.metadata["title"]).removesuffix("について")
+
+
+async def main() -> None:
+    documents, _, _ = build_corpus(2_000)
+    index = LocalVectorIndex(CorpusSource(documents), refresh_interval=None)  # type: ignore[arg-type]
+    index.refresh()
+    store = DelayedStore(index)
+    embedding = DelayedEmbeddings()
+    queries = [f"{a} {b}" for a, b in itertools.combinations(TOPICS, 2)]
+
+    async def single(query: str) -> list[Document]:
+        vector = await embedding.aembed_query(query)
+        return [doc for doc, _ in await store.asimilarity_search_by_vector_with_score(vector, k=TOP_K)]
+
+    async def serial(query: str) -> list[Document]:
+        rankings = []
+        for sub_query in split_search_words(query):
+            vector = await embedding.aembed_query(sub_query)
+            rankings.append([doc for doc, _ in await store.asimilarity_search_by_vector_with_score(vector, k=TOP_K)])
+        return [doc for doc, _ in reciprocal_rank_fusion(rankings, top_n=MAX_RESULTS)]
+
+    async def multi(query: str) -> list[Document]:
+        # 毎回埋め込みを呼び出すよう、キャッシュは検索ごとに作り直す
+        result = await amulti_query_search(
+            query, TOP_K, MAX_RESULTS, store=store, embedding=CachedEmbeddings(embedding)
+        )
+        return result.documents
+
+    strategies: dict[str, Callable[[str], Awaitable[list[Document]]]] = {
+        "single": single, "serial": serial, "multi": multi,
+    }
+    for label, search in strategies.items():
+        covered = 0
+        start = time.perf_counter()
+        for query in queries:
+            topics = {topic_of(doc) for doc in await search(query)}
+            covered += len(topics & set(query.split()))
+        elapsed = (time.perf_counter() - start) / len(queries)
+        print(f"{label:<7} 話題の再現率: {covered / (2 * len(queries)):5.3f}  {elapsed * 1e3:6.1f} ms/search")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
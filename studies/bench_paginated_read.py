@@ -0,0 +1,82 @@
+"""
+### ページごとの読み込みのベンチマーク
+
+`CHUNKS`件のchunkと埋め込みからローカルのベクトルインデックスを作成するときの、最大のメモリ使用量と時間を比較します。
+コンテナは`READ_PAGE_SIZE`件ごとにページを返し、Cosmos DBの応答と同じくページごとに新しいitemを作成します。
+- before: `read_all_documents`で全てのdocumentを読み込んでからインデックスを作成する(以前の`refresh`)
+- after: `iter_document_pages`でページごとに埋め込みを行列に変換する
+
+```bash
+cd studies
+python bench_paginated_read.py
+```
+"""
+import time
+import tracemalloc
+from typing import Any
+
+import numpy as np
+from azure.core.paging import ItemPaged
+from fake_models import FakeEmbeddings
+
+from sc_system_ai.template.azure_cosmos import READ_PAGE_SIZE, CosmosDBManager, remove_document_change_listener
+from sc_system_ai.template.local_vector_index import LocalVectorIndex
+
+CHUNKS = 5000
+DIM = 1536
+
+
+class PagedContainer:
+    """max_item_countごとにページを返し、継続トークンとして次の位置を返すコンテナ"""
+    def __init__(self, size: int) -> None:
+        self.vectors = np.random.default_rng(0).standard_normal((size, DIM)).astype(np.float32)
+
+    def query_items(
+        self, query: str, max_item_count: int = READ_PAGE_SIZE, **kwargs: Any
+    ) -> ItemPaged[dict[str, Any]]:
+        def extract_data(start: int) -> tuple[str | None, list[dict[str, Any]]]:
+            end = min(start + max_item_count, len(self.vectors))
+            items = [
+                {
+                    "id": f"doc-{i}",
+                    "text": f"京都テックの情報{i}",
+                    "metadata": {"source_id": i},
+                    "embedding": self.vectors[i].tolist(),
+                }
+                for i in range(start, end)
+            ]
+            return (str(end) if end < len(self.vectors) else None), items
+
+        return ItemPaged(lambda token: int(token or 0), extract_data)
+
+
+class PagedClient:
+    def __init__(self) -> None:
+        self.container = PagedContainer(CHUNKS)
+
+    def create_database_if_not_exists(self, **kwargs: Any) -> "PagedClient":
+        return self
+
+    def create_container_if_not_exists(self, **kwargs: Any) -> PagedContainer:
+        return self.container
+
+
+def bench(label: str, paged: bool) -> None:
+    manager = CosmosDBManager(cosmos_client=PagedClient(), embedding=FakeEmbeddings(size=DIM))  # type: ignore[arg-type]
+    index = LocalVectorIndex(manager)
+    tracemalloc.start()
+    start = time.perf_counter()
+    if paged:
+        index.refresh()
+    else:
+        index._snapshot = index._build(manager.read_all_documents(with_metadata=True, with_embedding=True))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    remove_document_change_listener(index.on_document_change)
+    print(f"{label:<7} {len(index):5d}件 {elapsed * 1e3:8.1f} ms  最大のメモリ使用量: {peak / 2**20:7.1f} MiB")
+
+
+if __name__ == "__main__":
+    bench("before", paged=False)
+    bench("after", paged=True)
@@ -0,0 +1,62 @@
+"""
+### 検索クエリの埋め込みキャッシュのベンチマーク
+
+偽の埋め込みモデル(1回5ms)で、偏りのある検索ワードの列を埋め込む時間とヒット率を計測します。
+- before: 毎回埋め込みモデルを呼び出す(以前の実装)
+- lru: メモリ上のLRUのみを使用する
+- lru+sqlite(再起動後): ファイルに保存した埋め込みを、新しいプロセスを想定した空のLRUから参照する
+
+```bash
+cd studies
+python bench_query_embedding_cache.py
+```
+"""
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from fake_models import FakeEmbeddings
+
+from sc_system_ai.template.embedding_cache import CachedEmbeddings, SQLiteEmbeddingStore
+
+QUERIES = 2000
+VOCABULARY = 300
+DELAY = 0.005
+
+
+def search_words() -> list[str]:
+    # よく使われる検索ワードほど出現しやすい分布(Zipf分布)にする
+    words = [f"京都テック 検索ワード{i}" for i in range(VOCABULARY)]
+    weights = [1 / (rank + 1) for rank in range(VOCABULARY)]
+    return random.Random(0).choices(words, weights, k=QUERIES)
+
+
+def bench(label: str, embedding: FakeEmbeddings | CachedEmbeddings, model: FakeEmbeddings, words: list[str]) -> None:
+    start = time.perf_counter()
+    for word in words:
+        embedding.embed_query(word)
+    elapsed = time.perf_counter() - start
+    stats = f"  hit rate: {embedding.stats()['hit_rate']:5.1%}" if isinstance(embedding, CachedEmbeddings) else ""
+    print(
+        f"{label:<22} {elapsed / len(words) * 1e3:7.3f} ms/query  "
+        f"モデル呼び出し: {model.calls:5d}回{stats}"
+    )
+
+
+if __name__ == "__main__":
+    words = search_words()
+
+    model = FakeEmbeddings(delay=DELAY)
+    bench("before", model, model, words)
+
+    model = FakeEmbeddings(delay=DELAY)
+    bench("lru(128)", CachedEmbeddings(model, max_size=128), model, words)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "query"
+        model = FakeEmbeddings(delay=DELAY)
+        bench("lru+sqlite(初回)", CachedEmbeddings(model, max_size=128, store=SQLiteEmbeddingStore(path)), model, words)
+        model = FakeEmbeddings(delay=DELAY)
+        restarted = CachedEmbeddings(model, max_size=128, store=SQLiteEmbeddingStore(path))
+        bench("lru+sqlite(再起動後)", restarted, model, words)
@@ -0,0 +1,75 @@
+"""
+### 投機的検索のベンチマーク
+
+検索ワードの生成(LLMの呼び出し)を`LLM_LATENCY`秒、埋め込みと検索を`SEARCH_LATENCY`秒として、
+検索の段階ごとの時間を計測します。
+- serial: 検索ワードを生成してから検索する(以前の実装)
+- merge: 検索ワードの生成と並行してメッセージそのもので検索し、両方の結果を統合する
+- accept: メッセージによる検索のスコアが`ACCEPT_SCORE`以上の場合は検索ワードの生成を打ち切る。
+  半数の質問でスコアが十分高いものとする
+
+```bash
+cd studies
+python bench_speculative_search.py
+```
+"""
+import asyncio
+import importlib
+import statistics
+import time
+
+from langchain_core.documents import Document
+
+from sc_system_ai.agents.tools.search_school_data import aspeculative_search
+
+module = importlib.import_module("sc_system_ai.agents.tools.search_school_data")
+
+LLM_LATENCY = 0.4
+SEARCH_LATENCY = 0.15
+ACCEPT_SCORE = 0.8
+QUESTIONS = 10
+
+
+async def agenarate_search_word(message: str) -> str:
+    await asyncio.sleep(LLM_LATENCY)
+    return message + " 検索ワード"
+
+
+async def avector_search_with_score(query: str, top_k: int, mmr: object = None) -> list[tuple[Document, float]]:
+    await asyncio.sleep(SEARCH_LATENCY)
+    # 偶数番目の質問はメッセージそのものでも十分なスコアが得られるものとする
+    score = 0.9 if int(query.split(maxsplit=1)[0]) % 2 == 0 else 0.5
+    return [(Document(page_content=query, metadata={"id": f"{query}-{i}"}), score - i * 0.01) for i in range(top_k)]
+
+
+async def serial(message: str) -> dict[str, float]:
+    start = time.perf_counter()
+    word = await agenarate_search_word(message)
+    generated = time.perf_counter()
+    await avector_search_with_score(word, 2)
+    end = time.perf_counter()
+    return {"search_word": generated - start, "word_search": end - generated, "total": end - start}
+
+
+async def main() -> None:
+    module.agenarate_search_word = agenarate_search_word
+    module._avector_search_with_score = avector_search_with_score
+
+    async def merge(message: str) -> dict[str, float]:
+        return (await aspeculative_search(message)).timings
+
+    async def accept(message: str) -> dict[str, float]:
+        return (await aspeculative_search(message, accept_score=ACCEPT_SCORE)).timings
+
+    for label, run in {"serial": serial, "merge": merge, "accept": accept}.items():
+        timings = [await run(f"{i} 公欠届の出し方") for i in range(QUESTIONS)]
+        stages = ("search_word", "raw_search", "word_search", "total", "saved")
+        means = {
+            stage: statistics.mean(t.get(stage, 0.0) for t in timings) * 1e3
+            for stage in stages if any(stage in t for t in timings)
+        }
+        print(f"{label:<7} " + "  ".join(f"{stage}: {ms:6.1f} ms" for stage, ms in means.items()))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+"""
+### ストリーミングの並行実行ベンチマーク
+
+偽のチャットモデルでN本のストリーミングを同じイベントループ上で並行に実行し、
+CPU時間とスループットを計測します。
+- before: スレッドを起動し、キューをビジーウェイトで監視する(以前の実装)
+- after: asyncio.Queueでトークンを待ち受ける現在の実装
+
+```bash
+cd studies
+python bench_streaming.py
+```
+"""
+import asyncio
+import time
+from collections.abc import AsyncIterator
+from queue import Queue
+from threading import Thread
+
+from fake_models import FakeChatModel
+
+from sc_system_ai.template.agent import Agent, StreamingAgentResponse
+from sc_system_ai.template.streaming_handler import StreamingAgentHandler
+
+TOKEN_DELAY = 0.005
+
+
+class LegacyStreamingAgent(Agent):
+    """以前のスレッド + ビジーウェイトによるストリーミングを再現したエージェント"""
+
+    async def stream(
+        self,
+        message: str,
+        return_length: int = 5
+    ) -> AsyncIterator[StreamingAgentResponse]:
+        self.queue = Queue()  # type: ignore[assignment]
+        self.handler = StreamingAgentHandler(self.queue)  # type: ignore[arg-type]
+        self.is_streaming = True
+        self.tool.setup_streaming(self.queue)
+        phrase = ""
+
+        def run() -> None:
+            # 以前のハンドラと同じく、実行の終了時にNoneを送る
+            self._invoke(message, True)
+            self.queue.put(None)
+
+        thread = Thread(target=run)
+        thread.start()
+        while True:
+            if self.queue.empty():
+                continue
+            token = self.handler.queue.get_nowait()
+            if token is None:
+                break
+            phrase += token
+            if len(phrase) >= return_length:
+                yield StreamingAgentResponse(output=phrase, status="processing")
+                phrase = ""
+        thread.join()
+        yield StreamingAgentResponse(output=phrase, status="completed")
+
+
+async def consume(agent: Agent) -> int:
+    chars = 0
+    async for resp in agent.stream("こんにちは", 5):
+        chars += len(resp.output or "")
+    return chars
+
+
+async def run(agent_class: type[Agent], n: int) -> None:
+    # 各エージェントに個別のモデルを渡し、ストリーミング設定の競合を避ける
+    agents = [agent_class(llm=FakeChatModel(token_delay=TOKEN_DELAY)) for _ in range(n)]  # type: ignore[arg-type]
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    chars = await asyncio.gather(*(consume(agent) for agent in agents))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    print(
+        f"{agent_class.__name__:<22} N={n:<4} wall: {wall:7.3f} s  cpu: {cpu:7.3f} s  "
+        f"cpu/wall: {cpu / wall:5.2f}  throughput: {sum(chars) / wall:9.1f} chars/s"
+    )
+
+
+if __name__ == "__main__":
+    for n in (1, 10):
+        asyncio.run(run(LegacyStreamingAgent, n))
+    for n in (1, 10, 100, 300):
+        asyncio.run(run(Agent, n))
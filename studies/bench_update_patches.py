@@ -0,0 +1,66 @@
+"""
+### documentのtitleとmetadataの更新のベンチマーク
+
+`CHUNKS`件のchunkに分割された文書のtitleとmetadataを更新するときの、パッチ操作の回数と時間を比較します。
+Cosmos DBへの書き込みは1回を`WRITE_LATENCY`秒として再現します。
+- before: title、metadata、updated_atをそれぞれ全てのchunkに1件ずつ順番にパッチする(以前の`update_document`)
+- after: chunkごとに1回のパッチ操作にまとめ、並行して実行する
+
+```bash
+cd studies
+python bench_update_patches.py
+```
+"""
+import time
+from datetime import datetime
+from typing import Any
+
+import bench_incremental_update
+from bench_incremental_update import MemoryClient, SlowEmbeddings
+
+from sc_system_ai.template.azure_cosmos import CosmosDBManager
+
+CHUNKS = 100
+WRITE_LATENCY = 0.005
+
+
+def document() -> str:
+    return "# 学生便覧\n\n" + "\n\n".join(f"## 第{i}節\n\n第{i}節の規程について説明します。" for i in range(CHUNKS))
+
+
+def serial(manager: CosmosDBManager, title: str, metadata: dict[str, Any]) -> None:
+    """以前の`update_document`と同じく、更新の種類ごとに全てのchunkを1件ずつパッチする"""
+    items = manager.read_item(values=["id", "metadata"], condition={"metadata.source_id": 1})
+    group_id = items[0]["metadata"]["group_id"]
+    container = manager._container
+    for item in manager.read_item(values=["id"], condition={"metadata.group_id": group_id}):
+        patch = [{"op": "replace", "path": "/metadata/title", "value": title}]
+        container.patch_item(item=item["id"], partition_key=item["id"], patch_operations=patch)
+    for item in manager.read_item(values=["id", "metadata"], condition={"metadata.group_id": group_id}):
+        patch = manager._create_patch(item["metadata"], metadata, [])
+        container.patch_item(item=item["id"], partition_key=item["id"], patch_operations=patch)
+    date = datetime.now().strftime("%Y-%m-%d")
+    for item in items:
+        patch = [{"op": "replace", "path": "/metadata/updated_at", "value": date}]
+        container.patch_item(item=item["id"], partition_key=item["id"], patch_operations=patch)
+
+
+def bench(label: str, merged: bool) -> None:
+    client = MemoryClient()
+    manager = CosmosDBManager(cosmos_client=client, embedding=SlowEmbeddings())  # type: ignore[arg-type]
+    manager.create_document(document(), "markdown", source_id=1)
+    client.container.writes.clear()
+
+    start = time.perf_counter()
+    if merged:
+        manager.update_document(source_id=1, title="新しい学生便覧", metadata={"tag": "便覧"})
+    else:
+        serial(manager, "新しい学生便覧", {"tag": "便覧"})
+    elapsed = time.perf_counter() - start
+    print(f"{label:<7} {elapsed * 1e3:7.1f} ms  パッチ操作: {client.container.writes['patch']}回")
+
+
+if __name__ == "__main__":
+    bench_incremental_update.WRITE_LATENCY = WRITE_LATENCY
+    bench("before", merged=False)
+    bench("after", merged=True)
@@ -0,0 +1,70 @@
+"""
+### ベンチマーク用のCosmos DBの代替
+
+`CosmosClient`と同じ呼び出し方で使用できる、ローカルで動作する代替のクライアントです。
+データベースとコンテナの作成、クエリの実行ごとに`latency`秒待ち、1往復の通信を再現します。
+"""
+import time
+from typing import Any
+
+
+class FakeContainer:
+    def __init__(self, items: list[dict[str, Any]], latency: float):
+        self.items = items
+        self.latency = latency
+        self.requests = 0
+        self.written: list[str] = []
+
+    def query_items(self, query: str, parameters: Any = None, **kwargs: Any) -> list[dict[str, Any]]:
+        self.requests += 1
+        time.sleep(self.latency)
+        return [dict(item, metadata=dict(item["metadata"])) for item in self.items]
+
+    def upsert_item(self, body: dict[str, Any], **kwargs: Any) -> dict[str, Any]:
+        # 並行して呼び出されるため、itemの追加のみ行う(検索結果は変わらない)
+        self.requests += 1
+        time.sleep(self.latency)
+        self.written.append(body["id"])
+        return body
+
+    def create_item(self, body: dict[str, Any], **kwargs: Any) -> dict[str, Any]:
+        return self.upsert_item(body, **kwargs)
+
+
+class FakeDatabase:
+    def __init__(self, container: FakeContainer, latency: float):
+        self.container = container
+        self.latency = latency
+
+    def create_container_if_not_exists(self, id: str, **kwargs: Any) -> FakeContainer:
+        self.container.requests += 1
+        time.sleep(self.latency)
+        return self.container
+
+
+class FakeCosmosClient:
+    """
+    Cosmos DBの代替のクライアント
+
+    Args:
+        latency (float): 1往復の通信にかかる時間(秒)
+        documents (int): 検索結果として返すdocumentの数
+    """
+    def __init__(self, latency: float = 0.002, documents: int = 2):
+        items = [
+            {
+                "id": f"doc-{i}",
+                "text": f"京都テックの情報{i}",
+                "metadata": {"title": f"タイトル{i}", "source_id": i},
+                "SimilarityScore": 0.9 - i * 0.1,
+            }
+            for i in range(documents)
+        ]
+        self.container = FakeContainer(items, latency)
+        self.database = FakeDatabase(self.container, latency)
+        self.latency = latency
+
+    def create_database_if_not_exists(self, id: str, **kwargs: Any) -> FakeDatabase:
+        self.container.requests += 1
+        time.sleep(self.latency)
+        return self.database
@@ -0,0 +1,19 @@
+import os
+
+# sc_system_ai.template.ai_settingsの読み込みに必要な環境変数
+# .envが存在しない環境でもテストを実行できるようにダミーの値を設定する
+for key, value in {
+    "AZURE_OPENAI_ENDPOINT": "https://example.openai.azure.com",
+    "AZURE_OPENAI_API_KEY": "dummy",
+    "AZURE_DEPLOYMENT_NAME": "dummy",
+    "AZURE_EMBEDDINGS_DEPLOYMENT_NAME": "dummy",
+    "OPENAI_API_VERSION": "2024-06-01",
+    # sc_system_ai.template.azure_cosmosの読み込みに必要な環境変数. 接続は行わない
+    "AZURE_COSMOS_DB_ENDPOINT": "https://localhost:8081/",
+    "AZURE_COSMOS_DB_KEY": "ZHVtbXk=",
+    "AZURE_COSMOS_DB_DATABASE": "dummy",
+    "AZURE_COSMOS_DB_CONTAINER": "dummy",
+    # 構造化出力のキャッシュをファイルに保存しない
+    "STRUCTURED_OUTPUT_CACHE_PATH": ":memory:",
+}.items():
+    os.environ.setdefault(key, value)
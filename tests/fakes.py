@@ -0,0 +1,174 @@
+"""
+### テストで共有する偽のモデルとCosmos DB
+
+Azure OpenAIとCosmos DBに接続せずにエージェントや`CosmosDBManager`を実行するための代替を定義します。
+"""
+import asyncio
+import copy
+import re
+import threading
+import time
+from collections.abc import AsyncIterator
+from typing import Any
+
+from azure.core.paging import ItemPaged
+from azure.cosmos.exceptions import CosmosHttpResponseError
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.chat_models import agenerate_from_stream
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+from pydantic import Field
+
+
+class EchoChatModel(BaseChatModel):
+    """最後のユーザーメッセージを一文字ずつ返す偽のチャットモデル"""
+    token_delay: float = 0.001
+    streaming: bool = False
+    # 生成したトークンの記録(model_copyでコピーされたモデルとも共有される)
+    emitted: list[str] = Field(default_factory=list)
+
+    @property
+    def _llm_type(self) -> str:
+        return "echo-chat-model"
+
+    def bind_tools(self, tools: Any, **kwargs: Any) -> Runnable:
+        return self
+
+    def _generate(self, messages: list[BaseMessage], *args: Any, **kwargs: Any) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=str(messages[-1].content)))])
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.streaming:
+            return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+        return self._generate(messages)
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        for token in str(messages[-1].content):
+            await asyncio.sleep(self.token_delay)
+            self.emitted.append(token)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+class CountingEmbeddings(Embeddings):
+    """本文の長さを先頭の値とするベクトルを返し、埋め込みを作成した本文を呼び出しごとに記録する偽のモデル"""
+    def __init__(self) -> None:
+        self.batches: list[list[str]] = []
+
+    @property
+    def texts(self) -> list[str]:
+        return [text for batch in self.batches for text in batch]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.batches.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+class MemoryContainer:
+    """
+    Cosmos DBのコンテナの代わりにメモリ上でitemを保持するコンテナ
+
+    クエリは`c.<key> = @<name>`の条件のみに対応し、`max_item_count`件ごとのページで結果を返します。
+    `throttle`に追加したidのパッチ操作は、1回だけ429で失敗します。
+
+    Args:
+        latency (float, optional): upsertの待ち時間(秒). Defaults to 0.0.
+    """
+    def __init__(self, latency: float = 0.0) -> None:
+        self.items: dict[str, dict[str, Any]] = {}
+        self.latency = latency
+        self.queries = 0
+        self.patches = 0
+        self.throttle: set[str] = set()
+        # 同時に実行されたupsertの最大数
+        self.peak = 0
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def query_items(
+        self,
+        query: str,
+        parameters: list[dict[str, Any]] | None = None,
+        max_item_count: int = 100,
+        **kwargs: Any,
+    ) -> ItemPaged[dict[str, Any]]:
+        values = {p["name"]: p["value"] for p in parameters or []}
+        conditions = [(key.split("."), values[name]) for key, name in re.findall(r"c\.([\w.]+) = (@\w+)", query)]
+
+        def lookup(item: dict[str, Any], path: list[str]) -> Any:
+            for key in path:
+                item = item.get(key, {})
+            return item
+
+        def get_next(token: str | None) -> int:
+            self.queries += 1
+            return int(token or 0)
+
+        def extract_data(start: int) -> tuple[str | None, list[dict[str, Any]]]:
+            matched = [item for item in self.items.values() if all(lookup(item, p) == v for p, v in conditions)]
+            end = start + max_item_count
+            return (str(end) if end < len(matched) else None), copy.deepcopy(matched[start:end])
+
+        return ItemPaged(get_next, extract_data)
+
+    def create_item(self, body: dict[str, Any], **kwargs: Any) -> dict[str, Any]:
+        return self.upsert_item(body)
+
+    def upsert_item(self, body: dict[str, Any], **kwargs: Any) -> dict[str, Any]:
+        with self._lock:
+            self._running += 1
+            self.peak = max(self.peak, self._running)
+        time.sleep(self.latency)
+        with self._lock:
+            self._running -= 1
+            self.items[body["id"]] = copy.deepcopy(body)
+        return body
+
+    def delete_item(self, item: str, partition_key: str) -> None:
+        del self.items[item]
+
+    def patch_item(self, item: str, partition_key: str, patch_operations: list[dict[str, Any]]) -> None:
+        with self._lock:
+            if item in self.throttle:
+                self.throttle.remove(item)
+                raise CosmosHttpResponseError(status_code=429, message="Request rate is large")
+            self.patches += 1
+        metadata = self.items[item]["metadata"]
+        for operation in patch_operations:
+            key = operation["path"].removeprefix("/metadata/")
+            if operation["op"] == "remove":
+                del metadata[key]
+            else:
+                metadata[key] = operation["value"]
+
+
+class MemoryClient:
+    """MemoryContainerを返すCosmosClientの代わり"""
+    def __init__(self, latency: float = 0.0) -> None:
+        self.container = MemoryContainer(latency)
+
+    def create_database_if_not_exists(self, **kwargs: Any) -> "MemoryClient":
+        return self
+
+    def create_container_if_not_exists(self, **kwargs: Any) -> MemoryContainer:
+        return self.container
@@ -0,0 +1,95 @@
+from pathlib import Path
+from typing import Any
+
+import pytest
+from azure.cosmos.exceptions import CosmosHttpResponseError
+from fakes import CountingEmbeddings, MemoryClient
+
+from sc_system_ai.template.azure_cosmos import (
+    BulkDocument,
+    CosmosDBManager,
+    DocumentChange,
+    add_document_change_listener,
+    remove_document_change_listener,
+)
+from sc_system_ai.template.embedding_cache import SQLiteEmbeddingStore
+
+UPSERT_LATENCY = 0.01
+
+
+def test_bulk_ingestion_batches_embeddings_and_bounds_upserts() -> None:
+    client = MemoryClient(UPSERT_LATENCY)
+    embedding = CountingEmbeddings()
+    manager = CosmosDBManager(cosmos_client=client, embedding=embedding)  # type: ignore[arg-type]
+    changes: list[DocumentChange] = []
+    add_document_change_listener(changes.append)
+    documents = [
+        BulkDocument(f"# 案内{i}\n\n## 手続き\n\n公欠届は前日までに提出します。\n\n## 窓口\n\n事務局", source_id=i)
+        for i in range(4)
+    ]
+
+    result = manager.create_documents_bulk(
+        [*documents[:3], ("京都テックの学食は11時から営業します。", "plain", "学食", 3, {"tag": "学食"})],
+        embedding_batch_size=3,
+        max_concurrency=2,
+        processes=0,
+    )
+    remove_document_change_listener(changes.append)
+
+    assert result.documents == 4  # noqa: PLR2004
+    assert result.chunks == len(client.container.items) == len(embedding.texts)
+    assert max(len(batch) for batch in embedding.batches) <= 3  # noqa: PLR2004
+    assert client.container.peak <= 2  # noqa: PLR2004
+    assert [change.source_id for change in changes] == [0, 1, 2, 3]
+    assert [change.ids for change in changes] == result.ids
+    last = client.container.items[result.ids[3][0]]
+    assert last["metadata"]["source_id"] == 3  # noqa: PLR2004
+    assert last["metadata"]["tag"] == "学食"
+    assert result.chunks_per_second > 0
+
+
+def test_bulk_ingestion_formats_in_process_pool_in_input_order() -> None:
+    client = MemoryClient()
+    manager = CosmosDBManager(cosmos_client=client, embedding=CountingEmbeddings())  # type: ignore[arg-type]
+    documents = [BulkDocument(f"案内{i}の本文です。", "plain", f"案内{i}", i) for i in range(10)]
+
+    result = manager.create_documents_bulk(documents, processes=2)
+
+    sources = [client.container.items[ids[0]]["metadata"]["source_id"] for ids in result.ids]
+    assert sources == list(range(10))
+
+
+def test_reingestion_reuses_stored_document_embeddings(tmp_path: Path) -> None:
+    embedding = CountingEmbeddings()
+    documents = [BulkDocument(f"案内{i}の本文です。", "plain", f"案内{i}", i) for i in range(3)]
+    for _ in range(2):
+        manager = CosmosDBManager(cosmos_client=MemoryClient(), embedding=embedding)  # type: ignore[arg-type]
+        manager.set_document_embedding_store(SQLiteEmbeddingStore(tmp_path / "documents"))
+        manager.create_documents_bulk(documents, processes=0)
+
+    assert [len(batch) for batch in embedding.batches] == [3]
+
+
+def test_bulk_ingestion_stops_at_the_first_failed_upsert() -> None:
+    client = MemoryClient(UPSERT_LATENCY)
+    embedding = CountingEmbeddings()
+    manager = CosmosDBManager(cosmos_client=client, embedding=embedding)  # type: ignore[arg-type]
+    upsert_item = client.container.upsert_item
+
+    def fail_second_document(body: dict[str, Any], **kwargs: Any) -> dict[str, Any]:
+        if body["metadata"]["source_id"] == 1:
+            raise CosmosHttpResponseError(status_code=413, message="Request entity too large")
+        return upsert_item(body, **kwargs)
+
+    client.container.upsert_item = fail_second_document  # type: ignore[method-assign]
+    changes: list[DocumentChange] = []
+    add_document_change_listener(changes.append)
+    documents = [BulkDocument(f"案内{i}の本文です。", "plain", f"案内{i}", i) for i in range(10)]
+
+    with pytest.raises(CosmosHttpResponseError):
+        manager.create_documents_bulk(documents, embedding_batch_size=1, max_concurrency=1, processes=0)
+    remove_document_change_listener(changes.append)
+
+    assert len(embedding.batches) <= 3  # noqa: PLR2004
+    assert [change.source_id for change in changes] == [0]
+    assert [item["metadata"]["source_id"] for item in client.container.items.values()] == [0]
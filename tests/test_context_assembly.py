@@ -0,0 +1,57 @@
+from langchain_core.documents import Document
+
+from sc_system_ai.agents.search_school_data_agent import SearchSchoolDataAgent
+from sc_system_ai.template.context_assembly import ContextPolicy, assemble_context
+
+
+def chunk(text: str, source_id: int, group_id: str | None = None, section: int | None = None) -> Document:
+    metadata: dict[str, object] = {
+        "id": f"{source_id}-{section}", "title": f"タイトル{source_id}", "source_id": source_id,
+    }
+    if group_id is not None:
+        metadata.update(group_id=group_id, section_number=section)
+    return Document(page_content=text, metadata=metadata)
+
+
+def policy(**kwargs: object) -> ContextPolicy:
+    return ContextPolicy(token_counter=len, **kwargs)  # type: ignore[arg-type]
+
+
+def test_drops_low_scores_and_duplicates_and_merges_neighbours() -> None:
+    results: list[tuple[Document, float | None]] = [
+        (chunk("公欠届は前日までに", 1, "g", 1), 0.8),
+        (chunk("前日までに提出します", 1, "g", 2), 0.7),
+        (chunk("公欠届は前日までに", 1, "g", 1), 0.6),
+        (chunk("学食の営業時間", 2), 0.1),
+    ]
+
+    context = assemble_context(results, policy(min_score=0.3, max_tokens=None))
+
+    assert context.text == "### タイトル1\n公欠届は前日までに提出します\n"
+    assert (context.dropped_by_score, context.duplicates, context.merged) == (1, 1, 1)
+    assert context.source_ids == [1]
+
+
+def test_packs_highest_scores_into_token_budget() -> None:
+    results: list[tuple[Document, float | None]] = [
+        (chunk("あ" * 50, 1), 0.5),
+        (chunk("い" * 20, 2), 0.9),
+        (chunk("う" * 20, 3), 0.7),
+    ]
+
+    context = assemble_context(results, policy(max_tokens=70))
+
+    assert context.source_ids == [2, 3]
+    assert context.dropped_by_budget == 1
+    assert context.used_tokens <= 70  # noqa: PLR2004
+
+
+def test_reused_agent_does_not_accumulate_search_results() -> None:
+    agent = SearchSchoolDataAgent(context_policy=policy())
+    results: list[tuple[Document, float | None]] = [(chunk("公欠届は前日までに提出します", 1), 0.8)]
+
+    assert agent._set_search_result(results) == [1]
+    first = agent.assistant_info
+    agent._set_search_result(results)
+
+    assert agent.assistant_info == first
@@ -0,0 +1,119 @@
+import asyncio
+import threading
+from collections.abc import Sequence
+from pathlib import Path
+
+import numpy as np
+from fakes import CountingEmbeddings
+
+from sc_system_ai.template.embedding_cache import CachedEmbeddings, ContentAddressedEmbeddings, SQLiteEmbeddingStore
+
+
+def test_warm_queries_skip_the_model(tmp_path: Path) -> None:
+    model = CountingEmbeddings()
+    cached = CachedEmbeddings(model, max_size=1, store=SQLiteEmbeddingStore(tmp_path / "query"))
+
+    first = cached.embed_query("京都テック")
+    cached.embed_query("専攻")  # LRUから"京都テック"を追い出す
+    again = cached.embed_query("京都テック")
+
+    assert first == again
+    assert len(model.texts) == 2  # noqa: PLR2004
+    assert cached.stats() == {"hits": 0, "store_hits": 1, "misses": 2, "hit_rate": 1 / 3}
+
+
+def test_store_is_reloaded_from_disk(tmp_path: Path) -> None:
+    store = SQLiteEmbeddingStore(tmp_path / "query")
+    store.put_many(["a", "b"], [[1.0, 2.0], [3.0, 4.0]])
+
+    reloaded = SQLiteEmbeddingStore(tmp_path / "query")
+
+    assert len(reloaded) == 2  # noqa: PLR2004
+    assert [v.tolist() if v is not None else None for v in reloaded.get_many(["b", "c"])] == [[3.0, 4.0], None]
+
+
+def test_document_embeddings_are_shared_across_runs(tmp_path: Path) -> None:
+    model = CountingEmbeddings()
+    footer = "お問い合わせは事務局まで"
+    first = ContentAddressedEmbeddings(model, SQLiteEmbeddingStore(tmp_path / "documents"), namespace="model")
+    vectors = first.embed_documents(["公欠届について", footer, footer])
+
+    # 別の実行で同じストアを読み込む
+    second = ContentAddressedEmbeddings(model, SQLiteEmbeddingStore(tmp_path / "documents"), namespace="model")
+    again = second.embed_documents([footer, "学食について"])
+
+    assert len(model.texts) == 3  # noqa: PLR2004
+    assert again[0] == vectors[1]
+    assert second.stats()["store_hits"] == 1
+
+
+def test_concurrent_writers_keep_keys_and_vectors_aligned(tmp_path: Path) -> None:
+    # 別々のプロセスを想定し、同じファイルを2つのストアから開く
+    first = SQLiteEmbeddingStore(tmp_path / "documents")
+    second = SQLiteEmbeddingStore(tmp_path / "documents")
+    first.put_many(["a", "b"], [[1.0, 1.0], [2.0, 2.0]])
+    second.put_many(["c", "a"], [[3.0, 3.0], [9.0, 9.0]])
+    first.put("d", [4.0, 4.0])
+
+    reloaded = SQLiteEmbeddingStore(tmp_path / "documents")
+    vectors = reloaded.get_many(["a", "b", "c", "d"])
+
+    assert len(reloaded) == 4  # noqa: PLR2004
+    assert [v.tolist() if v is not None else None for v in vectors] == [[1.0, 1.0], [2.0, 2.0], [3.0, 3.0], [4.0, 4.0]]
+
+
+def test_corrupted_rows_are_ignored(tmp_path: Path) -> None:
+    store = SQLiteEmbeddingStore(tmp_path / "query")
+    store.put_many(["a", "b"], [[1.0, 2.0], [3.0, 4.0]])
+    with store._conn:
+        store._conn.execute("UPDATE embeddings SET vector = ? WHERE key = 'b'", (b"\x00" * 3,))
+
+    assert [v.tolist() if v is not None else None for v in store.get_many(["a", "b"])] == [[1.0, 2.0], None]
+
+
+class ThreadRecordingStore(SQLiteEmbeddingStore):
+    """読み書きを実行したスレッドを記録するストア"""
+    def __init__(self, path: Path) -> None:
+        super().__init__(path)
+        self.threads: list[int] = []
+
+    def get_many(self, keys: list[str]) -> list[np.ndarray | None]:
+        self.threads.append(threading.get_ident())
+        return super().get_many(keys)
+
+    def put_many(self, keys: list[str], vectors: Sequence[list[float] | np.ndarray]) -> None:
+        self.threads.append(threading.get_ident())
+        super().put_many(keys, vectors)
+
+
+def test_async_queries_use_the_store_off_the_event_loop(tmp_path: Path) -> None:
+    store = ThreadRecordingStore(tmp_path / "query")
+    model = CountingEmbeddings()
+    cached = CachedEmbeddings(model, max_size=1, store=store)
+
+    async def run() -> int:
+        await cached.aembed_query("京都テック")
+        await cached.aembed_queries(["専攻", "京都テック"])
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+
+    assert len(model.texts) == 2  # noqa: PLR2004
+    assert store.threads and loop_thread not in store.threads
+
+
+def test_async_document_embeddings_use_the_store_off_the_event_loop(tmp_path: Path) -> None:
+    store = ThreadRecordingStore(tmp_path / "documents")
+    model = CountingEmbeddings()
+    documents = ContentAddressedEmbeddings(model, store, namespace="model")
+
+    async def run() -> int:
+        await documents.aembed_documents(["公欠届について", "学食について"])
+        await documents.aembed_documents(["公欠届について"])
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+
+    assert len(model.texts) == 2  # noqa: PLR2004
+    assert len(store.threads) == 3  # noqa: PLR2004
+    assert loop_thread not in store.threads
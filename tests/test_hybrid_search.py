@@ -0,0 +1,144 @@
+import asyncio
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any
+
+from langchain_core.documents import Document
+
+from sc_system_ai.template.azure_cosmos import DocumentChange, remove_document_change_listener
+from sc_system_ai.template.document_formatter import md_formatter
+from sc_system_ai.template.hybrid_search import BM25Index, HybridSearcher, char_ngrams, reciprocal_rank_fusion
+
+
+def doc(_id: str, text: str, title: str = "", source_id: int = 0) -> Document:
+    return Document(page_content=text, metadata={"id": _id, "title": title, "source_id": source_id})
+
+
+def test_char_ngrams_normalizes_width_and_splits_on_symbols() -> None:
+    assert char_ngrams("ＡＩ専攻、寮") == ["ai", "i専", "専攻", "ai専", "i専攻", "寮"]
+
+
+def test_bm25_finds_exact_terms_in_formatted_chunks() -> None:
+    index = BM25Index()
+    text = "# 公欠届について\n公欠届は授業の前日までに提出してください。\n# 学食\n学食は11時から営業しています。"
+    chunks = md_formatter(text, metadata={"source_id": 1})
+    index.add_documents([Document(c.page_content, metadata={**c.metadata, "id": str(i)}) for i, c in enumerate(chunks)])
+    index.add_documents([doc("x", "レポートの提出について説明します。")])
+
+    results = index.search("公欠届を提出したい", k=2)
+
+    assert results[0][0].metadata["id"] == "0"
+    index.remove_source(1)
+    assert [d.metadata["id"] for d, _ in index.search("公欠届を提出したい", k=2)] == ["x"]
+
+
+def test_rrf_merges_duplicates_and_rewards_agreement() -> None:
+    a, b, c = doc("a", "A"), doc("b", "B"), doc("c", "C")
+
+    fused = reciprocal_rank_fusion([[a, b], [c, b]])
+
+    assert [d.metadata["id"] for d, _ in fused] == ["b", "a", "c"]
+
+
+class FakeStore:
+    """ベクトル検索の結果を固定で返す検索先と読み込み元"""
+    def __init__(self, documents: list[Document]) -> None:
+        self.documents = documents
+
+    def similarity_search(self, query: str, k: int = 4) -> list[Document]:
+        return self.documents[:k]
+
+    async def asimilarity_search(self, query: str, k: int = 4) -> list[Document]:
+        return self.documents[:k]
+
+    def iter_all_documents(self, with_metadata: bool = False) -> Iterator[Document]:
+        yield from self.documents
+
+    def read_item(self, values: Any = None, condition: Any = None) -> list[dict[str, Any]]:
+        raise ValueError
+
+
+def test_hybrid_search_promotes_lexical_match() -> None:
+    documents = [doc(str(i), f"学校の案内{i}") for i in range(5)] + [doc("kouketsu", "公欠届の提出方法")]
+    store = FakeStore(documents)
+    searcher = HybridSearcher(source=store, vector_store=store, fetch_k=5)
+
+    results = searcher.search("公欠届", k=2)
+
+    assert "kouketsu" in [d.metadata["id"] for d in results]
+    remove_document_change_listener(searcher.on_document_change)
+
+
+class SlowStore(FakeStore):
+    def __init__(self, documents: list[Document]) -> None:
+        super().__init__(documents)
+        self.full_reads = 0
+
+    def iter_all_documents(self, with_metadata: bool = False) -> Iterator[Document]:
+        self.full_reads += 1
+        time.sleep(0.1)
+        yield from self.documents
+
+
+def test_first_async_search_builds_bm25_off_the_event_loop() -> None:
+    store = SlowStore([doc("a", "学校の案内"), doc("kouketsu", "公欠届の提出方法")])
+    searcher = HybridSearcher(source=store, vector_store=store, fetch_k=2)
+    ticks = 0
+
+    async def tick() -> None:
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    async def main() -> list[list[Document]]:
+        ticker = asyncio.create_task(tick())
+        results = await asyncio.gather(*(searcher.asearch("公欠届", k=1) for _ in range(2)))
+        ticker.cancel()
+        return list(results)
+
+    results = asyncio.run(main())
+    remove_document_change_listener(searcher.on_document_change)
+
+    assert [[d.metadata["id"] for d in result] for result in results] == [["kouketsu"], ["kouketsu"]]
+    assert ticks >= 5  # noqa: PLR2004
+    assert store.full_reads == 1
+
+
+class BlockingStore(FakeStore):
+    """全件の読み込みの途中で止まり、read_itemで追加されたdocumentを返す読み込み元"""
+    def __init__(self, documents: list[Document]) -> None:
+        super().__init__(documents)
+        self.reading = threading.Event()
+        self.resume = threading.Event()
+
+    def iter_all_documents(self, with_metadata: bool = False) -> Iterator[Document]:
+        snapshot = list(self.documents)
+        self.reading.set()
+        self.resume.wait(timeout=5)
+        yield from snapshot
+
+    def read_item(self, values: Any = None, condition: Any = None) -> list[dict[str, Any]]:
+        source_id = condition["metadata.source_id"]
+        return [
+            {"id": d.metadata["id"], "text": d.page_content, "metadata": d.metadata}
+            for d in self.documents
+            if d.metadata["source_id"] == source_id
+        ]
+
+
+def test_changes_during_refresh_are_kept_in_the_new_index() -> None:
+    store = BlockingStore([doc("a", "学校の案内", source_id=1)])
+    searcher = HybridSearcher(source=store, vector_store=store)
+    refresh = threading.Thread(target=searcher.refresh)
+    refresh.start()
+    store.reading.wait(timeout=5)
+
+    store.documents.append(doc("kouketsu", "公欠届の提出方法", source_id=2))
+    searcher.on_document_change(DocumentChange(action="create", source_id=2, ids=["kouketsu"]))
+    store.resume.set()
+    refresh.join()
+    remove_document_change_listener(searcher.on_document_change)
+
+    assert [d.metadata["id"] for d in searcher.lexical_search("公欠届", k=1)] == ["kouketsu"]
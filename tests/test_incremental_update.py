@@ -0,0 +1,96 @@
+import copy
+
+import pytest
+from fakes import CountingEmbeddings, MemoryClient
+
+from sc_system_ai.template.azure_cosmos import CONTENT_HASH_KEY, CosmosDBManager
+
+
+def handbook(*sections: str) -> str:
+    return "# 学生便覧\n\n" + "\n\n".join(f"## {section}\n\n{section}についての説明です。" for section in sections)
+
+
+def test_text_update_reembeds_only_changed_chunks() -> None:
+    client = MemoryClient()
+    embedding = CountingEmbeddings()
+    manager = CosmosDBManager(cosmos_client=client, embedding=embedding)  # type: ignore[arg-type]
+    old_ids = manager.create_document(handbook("公欠", "学食", "図書館"), source_id=1)
+    container = client.container
+    group_id = container.items[old_ids[0]]["metadata"]["group_id"]
+    for _id in old_ids:
+        container.items[_id]["metadata"]["created_at"] = "2024-04-01"
+    embedding.batches.clear()
+
+    new_ids = manager.update_document(source_id=1, text=handbook("公欠", "学生寮", "図書館"), text_type="markdown")
+
+    assert embedding.texts == ["学生寮についての説明です。"]
+    assert new_ids[0] == old_ids[0] and new_ids[2] == old_ids[2]
+    assert old_ids[1] not in container.items
+    assert set(container.items) == set(new_ids)
+    for number, _id in enumerate(new_ids, start=1):
+        metadata = container.items[_id]["metadata"]
+        assert (metadata["group_id"], metadata["section_number"]) == (group_id, number)
+        assert metadata["created_at"] == "2024-04-01"
+        assert CONTENT_HASH_KEY in metadata
+
+
+def test_text_update_deletes_removed_sections_and_reuses_legacy_chunks() -> None:
+    client = MemoryClient()
+    embedding = CountingEmbeddings()
+    manager = CosmosDBManager(cosmos_client=client, embedding=embedding)  # type: ignore[arg-type]
+    old_ids = manager.create_document(handbook("公欠", "学食", "図書館"), source_id=1)
+    # ハッシュを保存する前に作成したchunk
+    for _id in old_ids:
+        del client.container.items[_id]["metadata"][CONTENT_HASH_KEY]
+    embedding.batches.clear()
+
+    new_ids = manager.update_document(source_id=1, text=handbook("学食", "図書館"), text_type="markdown")
+
+    assert embedding.texts == []
+    assert new_ids == old_ids[1:]
+    assert set(client.container.items) == set(old_ids[1:])
+    assert client.container.items[new_ids[0]]["metadata"]["section_number"] == 1
+
+
+def test_title_and_metadata_updates_are_one_patch_per_chunk() -> None:
+    client = MemoryClient()
+    manager = CosmosDBManager(cosmos_client=client, embedding=CountingEmbeddings())  # type: ignore[arg-type]
+    ids = manager.create_document(handbook("公欠", "学食", "図書館"), source_id=1)
+    container = client.container
+    # 1件目のパッチ操作はスロットリングされ、再試行する
+    container.throttle.add(ids[0])
+
+    result = manager.update_document(source_id=1, title="新しい学生便覧", metadata={"tag": "便覧"})
+
+    assert sorted(result) == sorted(ids)
+    assert container.patches == len(ids)
+    for _id in ids:
+        metadata = container.items[_id]["metadata"]
+        assert (metadata["title"], metadata["tag"]) == ("新しい学生便覧", "便覧")
+
+
+def test_text_update_keeps_new_title() -> None:
+    client = MemoryClient()
+    manager = CosmosDBManager(cosmos_client=client, embedding=CountingEmbeddings())  # type: ignore[arg-type]
+    manager.create_document(handbook("公欠", "学食"), source_id=1)
+
+    ids = manager.update_document(
+        source_id=1, text=handbook("公欠", "学生寮"), text_type="markdown", title="新しい学生便覧"
+    )
+
+    assert {client.container.items[_id]["metadata"]["title"] for _id in ids} == {"新しい学生便覧"}
+
+
+def test_text_update_rejects_metadata_patch_options() -> None:
+    client = MemoryClient()
+    manager = CosmosDBManager(cosmos_client=client, embedding=CountingEmbeddings())  # type: ignore[arg-type]
+    manager.create_document(handbook("公欠", "学食"), source_id=1, metadata={"tag": "便覧"})
+    before = copy.deepcopy(client.container.items)
+    text = handbook("公欠", "学生寮")
+
+    with pytest.raises(ValueError):
+        manager.update_document(source_id=1, text=text, text_type="markdown", del_metadata=["tag"])
+    with pytest.raises(ValueError):
+        manager.update_document(source_id=1, text=text, text_type="markdown", metadata={"tag": "寮"}, is_patch=True)
+
+    assert client.container.items == before
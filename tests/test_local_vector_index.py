@@ -0,0 +1,162 @@
+import asyncio
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from sc_system_ai.template.azure_cosmos import (
+    DocumentChange,
+    DocumentPage,
+    _notify_document_change,
+    remove_document_change_listener,
+)
+from sc_system_ai.template.local_vector_index import LocalVectorIndex
+
+VECTORS = {
+    "専攻": [1.0, 0.0, 0.0],
+    "学食": [0.0, 0.0, 1.0],
+}
+
+
+class TableEmbeddings(Embeddings):
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [VECTORS[text] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return VECTORS[text]
+
+
+class FakeSource:
+    """CosmosDBManagerの代わりにメモリ上のitemを返す読み込み元"""
+    _embedding_key = "embedding"
+
+    def __init__(self, items: list[dict[str, Any]]) -> None:
+        self._embedding = TableEmbeddings()
+        self.items = items
+        self.full_reads = 0
+
+    def iter_document_pages(self, with_metadata: bool = False, with_embedding: bool = False, page_size: int = 2,
+                            continuation_token: str | None = None) -> Iterator[DocumentPage]:
+        self.full_reads += 1
+        documents = [
+            Document(
+                page_content=item["text"],
+                metadata={**item["metadata"], "id": item["id"], "embedding": item["embedding"]},
+            )
+            for item in self.items
+        ]
+        for start in range(0, len(documents), page_size):
+            yield DocumentPage(documents[start:start + page_size], str(start + page_size))
+
+    def read_item(
+        self,
+        values: list[str] | None = None,
+        condition: dict[str, Any] | None = None,
+    ) -> list[dict[str, Any]]:
+        assert condition == {"metadata.source_id": 2}
+        items = [item for item in self.items if item["metadata"]["source_id"] == 2]  # noqa: PLR2004
+        if not items:
+            raise ValueError("documentが見つかりませんでした")
+        return items
+
+
+def item(_id: str, source_id: int, vector: list[float]) -> dict[str, Any]:
+    return {"id": _id, "text": _id, "metadata": {"source_id": source_id}, "embedding": vector}
+
+
+@pytest.fixture
+def source() -> FakeSource:
+    return FakeSource([item("major", 1, [0.9, 0.1, 0.0]), item("lunch", 2, [0.1, 0.0, 0.9])])
+
+
+@pytest.mark.parametrize("quantize", [False, True])
+def test_search_returns_nearest_documents(source: FakeSource, quantize: bool) -> None:
+    index = LocalVectorIndex(source, quantize=quantize, refresh_interval=None)  # type: ignore[arg-type]
+
+    results = index.similarity_search_with_score("専攻", k=2)
+
+    assert [doc.metadata["id"] for doc, _ in results] == ["major", "lunch"]
+    assert results[0][1] == pytest.approx(0.9 / (0.82 ** 0.5), abs=1e-2)
+    assert "embedding" not in results[0][0].metadata
+    remove_document_change_listener(index.on_document_change)
+
+
+def test_document_changes_update_only_affected_rows(source: FakeSource) -> None:
+    index = LocalVectorIndex(source, refresh_interval=None)  # type: ignore[arg-type]
+    index.refresh()
+
+    source.items[1] = item("lunch-v2", 2, [0.0, 0.1, 0.9])
+    _notify_document_change(DocumentChange(action="update", source_id=2, ids=["lunch-v2"]))
+    assert index.similarity_search("学食", k=1)[0].metadata["id"] == "lunch-v2"
+
+    del source.items[1]
+    _notify_document_change(DocumentChange(action="delete", source_id=2))
+    assert [doc.metadata["id"] for doc in index.similarity_search("学食", k=2)] == ["major"]
+    assert source.full_reads == 1
+    remove_document_change_listener(index.on_document_change)
+
+
+class SlowSource(FakeSource):
+    def iter_document_pages(self, *args: Any, **kwargs: Any) -> Iterator[DocumentPage]:
+        time.sleep(0.1)
+        return super().iter_document_pages(*args, **kwargs)
+
+
+def test_first_async_search_loads_off_the_event_loop() -> None:
+    source = SlowSource([item("major", 1, [0.9, 0.1, 0.0]), item("lunch", 2, [0.1, 0.0, 0.9])])
+    index = LocalVectorIndex(source, refresh_interval=None)  # type: ignore[arg-type]
+    ticks = 0
+
+    async def tick() -> None:
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    async def main() -> list[list[tuple[Document, float]]]:
+        ticker = asyncio.create_task(tick())
+        results = await asyncio.gather(*(index.asimilarity_search_with_score("専攻", k=1) for _ in range(2)))
+        ticker.cancel()
+        return list(results)
+
+    results = asyncio.run(main())
+    remove_document_change_listener(index.on_document_change)
+
+    assert [[doc.metadata["id"] for doc, _ in result] for result in results] == [["major"], ["major"]]
+    # 読み込み中もイベントループは他の処理を実行でき、読み込みは1回のみ行う
+    assert ticks >= 5  # noqa: PLR2004
+    assert source.full_reads == 1
+
+
+class BlockingSource(FakeSource):
+    """全件の読み込みの途中で止まる読み込み元"""
+    def __init__(self, items: list[dict[str, Any]]) -> None:
+        super().__init__(items)
+        self.reading = threading.Event()
+        self.resume = threading.Event()
+
+    def iter_document_pages(self, *args: Any, **kwargs: Any) -> Iterator[DocumentPage]:
+        pages = list(super().iter_document_pages(*args, **kwargs))
+        self.reading.set()
+        self.resume.wait(timeout=5)
+        return iter(pages)
+
+
+def test_changes_during_refresh_are_kept_in_the_new_snapshot() -> None:
+    source = BlockingSource([item("major", 1, [0.9, 0.1, 0.0]), item("lunch", 2, [0.1, 0.0, 0.9])])
+    index = LocalVectorIndex(source, refresh_interval=None)  # type: ignore[arg-type]
+    refresh = threading.Thread(target=index.refresh)
+    refresh.start()
+    source.reading.wait(timeout=5)
+
+    source.items[1] = item("lunch-v2", 2, [0.0, 0.1, 0.9])
+    _notify_document_change(DocumentChange(action="update", source_id=2, ids=["lunch-v2"]))
+    source.resume.set()
+    refresh.join()
+    remove_document_change_listener(index.on_document_change)
+
+    assert [doc.metadata["id"] for doc in index.similarity_search("学食", k=2)] == ["lunch-v2", "major"]
@@ -0,0 +1,65 @@
+from collections.abc import Iterator
+from typing import Any
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from sc_system_ai.template.azure_cosmos import DocumentPage, remove_document_change_listener
+from sc_system_ai.template.local_vector_index import LocalVectorIndex
+from sc_system_ai.template.mmr import maximal_marginal_relevance
+
+# 同じ文書の隣接するchunk(a-1, a-2)はほぼ同じベクトルを持つ
+VECTORS = {
+    "a-1": [1.0, 0.1, 0.0],
+    "a-2": [0.98, 0.1, 0.15],
+    "b-1": [0.6, 0.8, 0.0],
+    "c-1": [0.0, 0.0, 1.0],
+}
+QUERY = [1.0, 0.3, 0.0]
+
+
+class TableEmbeddings(Embeddings):
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [QUERY for _ in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return QUERY
+
+
+class TableSource:
+    _embedding_key = "embedding"
+
+    def __init__(self) -> None:
+        self._embedding = TableEmbeddings()
+
+    def iter_document_pages(self, *args: Any, **kwargs: Any) -> Iterator[DocumentPage]:
+        yield DocumentPage(
+            [Document(page_content=_id, metadata={"id": _id, "embedding": vector}) for _id, vector in VECTORS.items()],
+            None,
+        )
+
+    def read_item(self, values: Any = None, condition: Any = None) -> list[dict[str, Any]]:
+        raise ValueError
+
+
+def test_mmr_skips_near_duplicate_neighbours() -> None:
+    candidates = np.array(list(VECTORS.values()))
+
+    assert maximal_marginal_relevance(QUERY, candidates, k=2, lambda_mult=1.0) == [0, 1]
+    assert maximal_marginal_relevance(QUERY, candidates, k=2, lambda_mult=0.5) == [0, 2]
+    assert sorted(maximal_marginal_relevance(QUERY, candidates, k=10)) == [0, 1, 2, 3]
+    assert maximal_marginal_relevance(QUERY, candidates[:0], k=2) == []
+
+
+def test_local_index_mmr_keeps_similarity_scores() -> None:
+    for quantize in (False, True):
+        index = LocalVectorIndex(TableSource(), quantize=quantize, refresh_interval=None)  # type: ignore[arg-type]
+        top = index.similarity_search_with_score("公欠", k=2)
+        diverse = index.max_marginal_relevance_search_with_score("公欠", k=2, fetch_k=3, lambda_mult=0.5)
+        remove_document_change_listener(index.on_document_change)
+
+        assert [doc.metadata["id"] for doc, _ in top] == ["a-1", "a-2"]
+        assert [doc.metadata["id"] for doc, _ in diverse] == ["a-1", "b-1"]
+        assert diverse[0][1] == top[0][1]
+        assert "embedding" not in diverse[1][0].metadata
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+from fakes import CountingEmbeddings
+from langchain_core.documents import Document
+
+from sc_system_ai.template.embedding_cache import CachedEmbeddings
+from sc_system_ai.template.multi_query_search import amulti_query_search, multi_query_search, split_search_words
+
+LATENCY = 0.05
+
+
+class SlowStore:
+    """埋め込みの値ごとに決まったdocumentを、一定の待ち時間の後に返す検索先"""
+    def _search(self, embedding: list[float], k: int) -> list[tuple[Document, float]]:
+        key = int(embedding[0])
+        return [(Document(page_content="", metadata={"id": f"{key}-{i}" if i else "shared"}), 1.0) for i in range(k)]
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: list[float], k: int = 4
+    ) -> list[tuple[Document, float]]:
+        time.sleep(LATENCY)
+        return self._search(embedding, k)
+
+    async def asimilarity_search_by_vector_with_score(
+        self, embedding: list[float], k: int = 4
+    ) -> list[tuple[Document, float]]:
+        await asyncio.sleep(LATENCY)
+        return self._search(embedding, k)
+
+
+def test_split_search_words() -> None:
+    queries = split_search_words("京都テック　学費 奨学金 学費")
+    assert queries == ["京都テック 学費 奨学金", "京都テック", "学費", "奨学金"]
+    assert split_search_words("学食") == ["学食"]
+    assert split_search_words("  ") == []
+
+
+def test_multi_query_embeds_once_and_searches_concurrently() -> None:
+    embedding = CountingEmbeddings()
+    cached = CachedEmbeddings(embedding)
+
+    start = time.perf_counter()
+    result = multi_query_search("AI 学費 奨学金", top_k=2, max_results=10, store=SlowStore(), embedding=cached)
+    elapsed = time.perf_counter() - start
+
+    assert len(embedding.batches) == 1
+    assert result.sub_queries == ["AI 学費 奨学金", "AI", "学費", "奨学金"]
+    assert [t.query for t in result.timings] == result.sub_queries
+    assert elapsed < LATENCY * 3
+    # 全てのサブクエリに含まれる"shared"は1件にまとめ、最上位にする
+    ids = [doc.metadata["id"] for doc in result.documents]
+    assert ids[0] == "shared"
+    assert len(ids) == len(set(ids))
+
+    asyncio.run(amulti_query_search("AI 学費 奨学金", store=SlowStore(), embedding=cached))
+    assert len(embedding.batches) == 1
+
+
+def test_result_count_follows_the_callers_top_k() -> None:
+    cached = CachedEmbeddings(CountingEmbeddings())
+
+    few = multi_query_search("AI 学費 奨学金", top_k=1, store=SlowStore(), embedding=cached)
+    many = asyncio.run(amulti_query_search("AI 学費 奨学金", top_k=6, store=SlowStore(), embedding=cached))
+
+    assert len(few.documents) == 1
+    assert len(many.documents) == 6  # noqa: PLR2004
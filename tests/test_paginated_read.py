@@ -0,0 +1,23 @@
+from fakes import CountingEmbeddings, MemoryClient
+
+from sc_system_ai.template.azure_cosmos import CosmosDBManager
+
+
+def test_document_pages_are_lazy_and_resumable() -> None:
+    client = MemoryClient()
+    for i in range(5):
+        client.container.upsert_item(
+            {"id": f"doc-{i}", "text": f"案内{i}", "metadata": {"source_id": i}, "embedding": [float(i), 1.0]}
+        )
+    manager = CosmosDBManager(cosmos_client=client, embedding=CountingEmbeddings())  # type: ignore[arg-type]
+
+    pages = manager.iter_document_pages(with_metadata=True, with_embedding=True, page_size=2)
+    first = next(pages)
+    assert client.container.queries == 1
+    assert [doc.metadata["id"] for doc in first.documents] == ["doc-0", "doc-1"]
+    assert first.documents[1].metadata["embedding"] == [1.0, 1.0]
+
+    resumed = manager.iter_document_pages(page_size=2, continuation_token=first.continuation_token)
+    ids = [doc.metadata["id"] for page in resumed for doc in page.documents]
+    assert ids == ["doc-2", "doc-3", "doc-4"]
+    assert [doc.page_content for doc in manager.read_all_documents()] == [f"案内{i}" for i in range(5)]
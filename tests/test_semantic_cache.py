@@ -0,0 +1,140 @@
+import asyncio
+import gc
+import weakref
+
+from fakes import EchoChatModel
+from langchain_core.embeddings import Embeddings
+
+from sc_system_ai.agents.search_school_data_agent import SearchSchoolDataAgent
+from sc_system_ai.template.azure_cosmos import DocumentChange, _document_change_listeners, _notify_document_change
+from sc_system_ai.template.semantic_cache import SemanticAnswerCache
+from sc_system_ai.template.user_prompts import User
+
+VECTORS = {
+    "京都テックの専攻は？": [1.0, 0.0, 0.0],
+    "京都テックにはどんな専攻がありますか": [0.99, 0.1, 0.0],
+    "学食のメニューは？": [0.0, 0.0, 1.0],
+}
+
+
+class TableEmbeddings(Embeddings):
+    """決められたベクトルを返す偽の埋め込みモデル"""
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        self.calls += 1
+        return VECTORS[text]
+
+
+def test_paraphrase_hits_and_unrelated_question_misses() -> None:
+    embedding = TableEmbeddings()
+    cache = SemanticAnswerCache(embedding=embedding, threshold=0.95)
+    cache.store("京都テックの専攻は？", "専攻の一覧です", [1, 2])
+
+    hit = cache.lookup("京都テックにはどんな専攻がありますか")
+
+    assert hit is not None
+    assert (hit.answer, hit.document_id) == ("専攻の一覧です", [1, 2])
+    assert cache.lookup("学食のメニューは？") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_document_change_invalidates_cited_answers() -> None:
+    cache = SemanticAnswerCache(embedding=TableEmbeddings())
+    cache.store("京都テックの専攻は？", "専攻の一覧です", [1, 2])
+    cache.store("学食のメニューは？", "メニューです", [3])
+
+    _notify_document_change(DocumentChange(action="update", source_id=2))
+
+    assert cache.lookup("京都テックの専攻は？") is None
+    assert cache.lookup("学食のメニューは？") is not None
+
+
+def test_cached_answer_is_replayed_as_chunks() -> None:
+    cache = SemanticAnswerCache(embedding=TableEmbeddings())
+    cache.store("京都テックの専攻は？", "専攻の一覧です", [1], scope="None\nNone")
+    agent = SearchSchoolDataAgent(answer_cache=cache)
+
+    async def run() -> list[tuple[str | None, str]]:
+        return [(r.output, r.status) async for r in agent.stream("京都テックにはどんな専攻がありますか", 3)]
+
+    chunks = asyncio.run(run())
+
+    assert chunks == [("専攻の", "processing"), ("一覧で", "processing"), ("す", "completed")]
+    assert agent.get_response().document_id == [1]
+
+
+class NoSearchAgent(SearchSchoolDataAgent):
+    """学校の情報を検索せず、質問をそのまま返すエージェント"""
+    async def _aadd_search_result(self, message: str) -> list[int]:
+        return [1]
+
+
+def test_users_do_not_share_personalized_answers() -> None:
+    cache = SemanticAnswerCache(embedding=TableEmbeddings())
+
+    def ask(user: User, message: str) -> str | None:
+        agent = NoSearchAgent(llm=EchoChatModel(), user_info=user, answer_cache=cache)  # type: ignore[arg-type]
+        return asyncio.run(agent.ainvoke(message)).output
+
+    assert ask(User(name="一人目", major="情報工学"), "京都テックの専攻は？") == "京都テックの専攻は？"
+    # 別のユーザーの言い換えにはキャッシュを使用せず、回答を生成する
+    answer = ask(User(name="二人目", major="デジタルエンタメ"), "京都テックにはどんな専攻がありますか")
+    assert answer == "京都テックにはどんな専攻がありますか"
+    assert cache.hits == 0
+    # 同じユーザーの言い換えにはキャッシュした回答を使用する
+    assert ask(User(name="一人目", major="情報工学"), "京都テックにはどんな専攻がありますか") == "京都テックの専攻は？"
+    assert cache.hits == 1
+
+
+def test_cache_is_skipped_with_conversation_history() -> None:
+    cache = SemanticAnswerCache(embedding=TableEmbeddings())
+    user = User(name="一人目", major="情報工学")
+    user.conversations.add_conversations_list([("human", "学食について教えて"), ("ai", "学食は2階です")])
+    agent = NoSearchAgent(llm=EchoChatModel(), user_info=user, answer_cache=cache)  # type: ignore[arg-type]
+
+    asyncio.run(agent.ainvoke("京都テックの専攻は？"))
+
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def live_listeners() -> int:
+    return sum(ref() is not None for ref in _document_change_listeners)
+
+
+def test_discarded_caches_are_unregistered_from_document_changes() -> None:
+    gc.collect()
+    registered = live_listeners()
+    agents = [SearchSchoolDataAgent(answer_cache=SemanticAnswerCache(embedding=TableEmbeddings())) for _ in range(3)]
+    ref = weakref.ref(agents[0].answer_cache)
+    assert live_listeners() == registered + 3
+
+    del agents
+    gc.collect()
+    _notify_document_change(DocumentChange(action="update", source_id=1))
+
+    assert ref() is None
+    # 破棄されたインスタンスのメソッドは通知時に登録から取り除く
+    assert len(_document_change_listeners) == registered
+
+    cache = SemanticAnswerCache(embedding=TableEmbeddings())
+    cache.close()
+    assert live_listeners() == registered
+
+
+def test_unregistering_a_listener_drops_discarded_ones() -> None:
+    gc.collect()
+    registered = live_listeners()
+    discarded = SemanticAnswerCache(embedding=TableEmbeddings())
+    cache = SemanticAnswerCache(embedding=TableEmbeddings())
+    del discarded
+    gc.collect()
+
+    cache.close()
+
+    assert len(_document_change_listeners) == registered
@@ -0,0 +1,96 @@
+import asyncio
+import importlib
+import time
+
+import pytest
+from langchain_core.documents import Document
+
+from sc_system_ai.agents.tools.search_school_data import aspeculative_search, speculative_search
+
+# toolsパッケージの`search_school_data`はツールのため、モジュールを取得する
+search_school_data = importlib.import_module("sc_system_ai.agents.tools.search_school_data")
+
+LLM_LATENCY = 0.1
+SEARCH_LATENCY = 0.05
+
+RESULTS = {
+    "公欠届を出したいのですが、どうすればいいですか": [("raw", 0.6), ("shared", 0.5)],
+    "公欠届 提出": [("shared", 0.8), ("word", 0.7)],
+}
+
+
+def scored(query: str) -> list[tuple[Document, float]]:
+    return [(Document(page_content=_id, metadata={"id": _id}), score) for _id, score in RESULTS[query]]
+
+
+@pytest.fixture(autouse=True)
+def fake_search(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    # 打ち切られた検索ワードの生成
+    cancelled: list[str] = []
+
+    async def agenarate(message: str) -> str:
+        try:
+            await asyncio.sleep(LLM_LATENCY)
+        except asyncio.CancelledError:
+            cancelled.append(message)
+            raise
+        return "公欠届 提出"
+
+    def generate(message: str) -> str:
+        time.sleep(LLM_LATENCY)
+        return "公欠届 提出"
+
+    async def asearch(query: str, top_k: int, mmr: object = None) -> list[tuple[Document, float]]:
+        await asyncio.sleep(SEARCH_LATENCY)
+        return scored(query)[:top_k]
+
+    def search(query: str, top_k: int, mmr: object = None) -> list[tuple[Document, float]]:
+        time.sleep(SEARCH_LATENCY)
+        return scored(query)[:top_k]
+
+    monkeypatch.setattr(search_school_data, "agenarate_search_word", agenarate)
+    monkeypatch.setattr(search_school_data, "genarate_search_word", generate)
+    monkeypatch.setattr(search_school_data, "_avector_search_with_score", asearch)
+    monkeypatch.setattr(search_school_data, "_vector_search_with_score", search)
+    return cancelled
+
+
+MESSAGE = "公欠届を出したいのですが、どうすればいいですか"
+
+
+def test_raw_search_overlaps_search_word_generation() -> None:
+    result = asyncio.run(aspeculative_search(MESSAGE, top_k=3))
+
+    assert [doc.metadata["id"] for doc in result.documents] == ["shared", "word", "raw"]
+    assert result.search_word == "公欠届 提出"
+    # メッセージによる検索は検索ワードの生成と重なるため、全体の時間は生成と検索ワードによる検索の合計に近い
+    assert result.timings["total"] < LLM_LATENCY + SEARCH_LATENCY * 1.8
+    assert result.timings["saved"] > SEARCH_LATENCY * 0.5
+
+
+def test_confident_raw_result_skips_search_word_generation(fake_search: list[str]) -> None:
+    start = time.perf_counter()
+    result = asyncio.run(aspeculative_search(MESSAGE, accept_score=0.55))
+
+    assert time.perf_counter() - start < LLM_LATENCY
+    assert result.search_word is None
+    assert [doc.metadata["id"] for doc in result.documents] == ["raw", "shared"]
+    assert fake_search == [MESSAGE]
+    # 打ち切った検索ワードの生成の時間は記録しない
+    assert "search_word" not in result.timings
+    assert result.timings["raw_search"] < LLM_LATENCY
+
+
+def test_sync_confident_result_does_not_record_the_abandoned_generation() -> None:
+    result = speculative_search(MESSAGE, accept_score=0.55)
+    time.sleep(LLM_LATENCY * 1.5)
+
+    assert result.search_word is None
+    assert "search_word" not in result.timings
+
+
+def test_sync_speculative_search_merges_by_score() -> None:
+    result = speculative_search(MESSAGE, top_k=2)
+
+    assert [doc.metadata["id"] for doc in result.documents] == ["shared", "word"]
+    assert result.timings["total"] < LLM_LATENCY + SEARCH_LATENCY * 1.8
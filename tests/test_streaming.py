@@ -0,0 +1,164 @@
+import asyncio
+import contextlib
+
+import pytest
+from fakes import EchoChatModel
+
+from sc_system_ai import main
+from sc_system_ai.template.agent import Agent
+from sc_system_ai.template.agent_pool import AgentPool, AgentRegistry
+from sc_system_ai.template.flush_policy import FlushPolicy, create_flush_policy
+from sc_system_ai.template.user_prompts import User
+
+
+async def _consume(agent: Agent, message: str) -> str:
+    return "".join([resp.output or "" async for resp in agent.stream(message, 3)])
+
+
+def test_concurrent_streams_receive_only_own_tokens() -> None:
+    llm = EchoChatModel()
+    sessions = 30
+    agents = [Agent(llm=llm) for _ in range(sessions)]  # type: ignore[arg-type]
+    messages = [f"セッション{i}番のメッセージです" for i in range(sessions)]
+
+    async def run() -> list[str]:
+        return await asyncio.gather(*(_consume(agent, msg) for agent, msg in zip(agents, messages, strict=True)))
+
+    assert asyncio.run(run()) == messages
+    # 共有のLLMは変更されない
+    assert llm.streaming is False
+    assert llm.callbacks is None
+
+
+def test_invoke_after_stream_does_not_stream() -> None:
+    llm = EchoChatModel()
+    agent = Agent(llm=llm)  # type: ignore[arg-type]
+
+    asyncio.run(_consume(agent, "ストリーミング"))
+    resp = agent.invoke("通常呼び出し")
+
+    assert resp.output == "通常呼び出し"
+    assert llm.streaming is False
+
+
+def test_same_agent_streams_on_separate_event_loops() -> None:
+    agent = Agent(llm=EchoChatModel())  # type: ignore[arg-type]
+
+    first = asyncio.run(_consume(agent, "一回目のメッセージ"))
+    second = asyncio.run(_consume(agent, "二回目のメッセージ"))
+
+    assert (first, second) == ("一回目のメッセージ", "二回目のメッセージ")
+
+
+def test_pooled_agent_streams_on_separate_event_loops_and_is_reset() -> None:
+    registry = AgentRegistry()
+    registry.register("echo", Agent)
+    pool = AgentPool(registry, llm=EchoChatModel(), max_size=1)  # type: ignore[arg-type]
+    outputs: list[str] = []
+
+    for name in ("一人目", "二人目"):
+        agent = pool.acquire("echo", User(name=name, major="情報工学"))
+        outputs.append(asyncio.run(_consume(agent, f"{name}のメッセージ")))
+        pool.release(agent)
+
+    assert outputs == ["一人目のメッセージ", "二人目のメッセージ"]
+    assert pool.stats()["echo"]["hits"] == 1
+    # 返却したエージェントには前のユーザーの情報と実行結果が残らない
+    assert agent.user_info.name == User().name
+    assert agent.get_response().output is None
+
+
+def test_each_chat_call_returns_its_agent_to_the_pool(monkeypatch: pytest.MonkeyPatch) -> None:
+    registry = AgentRegistry()
+    registry.register("classify", Agent)
+    pool = AgentPool(registry, llm=EchoChatModel(), max_size=1)  # type: ignore[arg-type]
+    monkeypatch.setattr(main, "agent_pool", pool)
+
+    first = main.Chat(user_name="一人目", user_major="情報工学").invoke("一回目")
+    second = main.Chat(user_name="二人目", user_major="情報工学").invoke("二回目")
+
+    async def stream() -> list[str]:
+        chat = main.Chat(user_name="三人目", user_major="情報工学")
+        outputs = [resp["output"] or "" async for resp in chat.stream("三回目")]
+        assert chat.get_response().output == "三回目"
+        return outputs
+
+    assert "".join(asyncio.run(stream())) == "三回目"
+    assert (first["output"], second["output"]) == ("一回目", "二回目")
+    # 2回目以降の呼び出しは、1回目に返却されたエージェントを再利用する
+    assert pool.stats()["classify"] == {"hits": 2, "misses": 1, "idle": 1}
+
+
+async def _chunks(agent: Agent, message: str, policy: FlushPolicy) -> list[str]:
+    return [resp.output or "" async for resp in agent.stream(message, flush_policy=policy)]
+
+
+def test_flush_on_sentence_boundary() -> None:
+    agent = Agent(llm=EchoChatModel())  # type: ignore[arg-type]
+    policy = create_flush_policy(return_length=None, sentence_boundary=True)
+
+    chunks = asyncio.run(_chunks(agent, "こんにちは。元気ですか？\nはい", policy))
+
+    assert chunks == ["こんにちは。", "元気ですか？", "\n", "はい"]
+
+
+def test_flush_after_max_wait() -> None:
+    agent = Agent(llm=EchoChatModel(token_delay=0.05))  # type: ignore[arg-type]
+    policy = create_flush_policy(return_length=100, max_wait_ms=10)
+
+    chunks = asyncio.run(_chunks(agent, "遅いモデル", policy))
+
+    # 文字数に達しなくても、待ち時間を過ぎたトークンは次のトークンを待たずに送出される
+    assert "".join(chunks) == "遅いモデル"
+    assert [c for c in chunks if c] == list("遅いモデル")
+
+
+def test_policy_without_should_flush_cannot_be_created() -> None:
+    class IncompletePolicy(FlushPolicy):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompletePolicy()  # type: ignore[abstract]
+
+
+def test_closing_stream_cancels_generation() -> None:
+    llm = EchoChatModel(token_delay=0.02)
+    agent = Agent(llm=llm)  # type: ignore[arg-type]
+
+    async def run() -> int:
+        stream = agent.stream("とても長い返答" * 10, 1)
+        await anext(stream)
+        emitted = len(llm.emitted)
+        await stream.aclose()
+        await asyncio.sleep(0.2)
+        return emitted
+
+    emitted = asyncio.run(run())
+
+    # キャンセル後は多くとも1トークンしか生成されない
+    assert len(llm.emitted) <= emitted + 1
+
+
+def test_cancelling_consumer_cancels_generation() -> None:
+    llm = EchoChatModel(token_delay=0.02)
+    agent = Agent(llm=llm)  # type: ignore[arg-type]
+    received: list[str] = []
+
+    async def consume() -> None:
+        async for resp in agent.stream("とても長い返答" * 10, 1):
+            received.append(resp.output or "")
+
+    async def run() -> int:
+        task = asyncio.create_task(consume())
+        while not received:
+            await asyncio.sleep(0.001)
+        task.cancel()
+        emitted = len(llm.emitted)
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.2)
+        return emitted
+
+    emitted = asyncio.run(run())
+
+    assert len(llm.emitted) <= emitted + 1
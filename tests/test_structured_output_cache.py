@@ -0,0 +1,106 @@
+import asyncio
+from typing import Any
+
+import pytest
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import Runnable, RunnableLambda
+from pydantic import BaseModel
+
+from sc_system_ai.template.structured_output_cache import (
+    StructuredOutputCache,
+    ainvoke_structured_output,
+    get_structured_output_cache,
+    invoke_structured_output,
+)
+
+
+class Output(BaseModel):
+    word: str
+
+
+class CountingChatModel(BaseChatModel):
+    """構造化出力の呼び出し回数を数える偽のチャットモデル"""
+    temperature: float = 0
+    deployment_name: str = "deployment-a"
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "counting-chat-model"
+
+    def _generate(self, messages: list[BaseMessage], *args: Any, **kwargs: Any) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=""))])
+
+    def with_structured_output(self, schema: Any, **kwargs: Any) -> Runnable:
+        def run(prompt: str) -> BaseModel:
+            self.calls += 1
+            return schema(word=prompt.upper())
+        return RunnableLambda(run)
+
+
+def test_repeated_calls_hit_the_cache() -> None:
+    cache = StructuredOutputCache(":memory:")
+    llm = CountingChatModel()
+
+    results = [invoke_structured_output(llm, Output, "abc", "site", cache) for _ in range(3)]
+
+    assert results == [Output(word="ABC")] * 3
+    assert llm.calls == 1
+    assert cache.stats() == {"site": {"hits": 2, "misses": 1, "hit_rate": 2 / 3}}
+
+
+def test_key_includes_deployment_and_skips_non_zero_temperature() -> None:
+    cache = StructuredOutputCache(":memory:")
+    llm_a = CountingChatModel()
+    llm_b = CountingChatModel(deployment_name="deployment-b")
+    llm_hot = CountingChatModel(temperature=0.7)
+
+    for llm in (llm_a, llm_b, llm_hot, llm_hot):
+        invoke_structured_output(llm, Output, "abc", "site", cache)
+
+    assert (llm_a.calls, llm_b.calls, llm_hot.calls) == (1, 1, 2)
+
+
+def test_ttl_and_lru_limits() -> None:
+    llm = CountingChatModel()
+    expired = StructuredOutputCache(":memory:", ttl=0)
+    invoke_structured_output(llm, Output, "abc", "site", expired)
+    invoke_structured_output(llm, Output, "abc", "site", expired)
+    assert llm.calls == 2  # noqa: PLR2004
+
+    cache = StructuredOutputCache(":memory:", max_entries=2)
+    for prompt in ("a", "b", "a", "c"):
+        invoke_structured_output(llm, Output, prompt, "site", cache)
+    # 最後に参照された日時が最も古い"b"が削除される
+    key = cache.make_key("b", Output, "deployment-a")
+    assert cache.get("site", key, Output) is None
+    assert cache.get("site", cache.make_key("a", Output, "deployment-a"), Output) == Output(word="A")
+
+
+def test_reads_do_not_write_and_async_calls_share_the_cache() -> None:
+    cache = StructuredOutputCache(":memory:")
+    llm = CountingChatModel()
+    invoke_structured_output(llm, Output, "abc", "site", cache)
+    changes = cache._conn.total_changes
+
+    result = asyncio.run(ainvoke_structured_output(llm, Output, "abc", "site", cache))
+
+    assert result == Output(word="ABC")
+    assert llm.calls == 1
+    assert cache._conn.total_changes == changes
+
+
+def test_cache_is_disabled_without_a_path(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.delenv("STRUCTURED_OUTPUT_CACHE_PATH")
+    get_structured_output_cache.cache_clear()
+    llm = CountingChatModel()
+    try:
+        assert get_structured_output_cache() is None
+        invoke_structured_output(llm, Output, "abc", "site")
+        invoke_structured_output(llm, Output, "abc", "site")
+    finally:
+        get_structured_output_cache.cache_clear()
+
+    assert llm.calls == 2  # noqa: PLR2004
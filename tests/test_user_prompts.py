@@ -0,0 +1,57 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from sc_system_ai.template.user_prompts import MESSAGE_OVERHEAD_TOKENS, ConversationHistory, HistoryPolicy
+
+
+def _history(turns: int) -> ConversationHistory:
+    history = ConversationHistory()
+    for i in range(turns):
+        history.add_conversation("human" if i % 2 == 0 else "ai", f"発言{i:02d}")
+    return history
+
+
+def test_format_conversation_keeps_all_turns_by_default() -> None:
+    history = _history(6)
+
+    messages = history.format_conversation()
+
+    assert [m.content for m in messages] == [f"発言{i:02d}" for i in range(6)]
+    assert history.get_trim_report().trimmed_turns == 0
+
+
+def test_max_turns_and_token_budget() -> None:
+    trimmed, kept = 6, 4
+    history = _history(trimmed + kept)
+    # 1発言あたり len("発言00") + オーバーヘッド のトークン数として計測する
+    per_turn = 4 + MESSAGE_OVERHEAD_TOKENS
+    history.policy = HistoryPolicy(max_turns=6, max_tokens=per_turn * kept, token_counter=len)
+
+    messages = history.format_conversation()
+    report = history.get_trim_report()
+
+    assert [m.content for m in messages] == [f"発言{i:02d}" for i in range(6, 10)]
+    assert isinstance(messages[0], HumanMessage)
+    assert isinstance(messages[1], AIMessage)
+    assert report.trimmed_turns == trimmed
+    assert report.trimmed_tokens == per_turn * trimmed
+    assert report.kept_tokens == per_turn * kept
+
+
+def test_rolling_summary_only_summarizes_new_turns() -> None:
+    calls: list[list[tuple[str, str]]] = []
+
+    def summarizer(summary: str, turns: list[tuple[str, str]]) -> str:
+        calls.append(turns)
+        return summary + "".join(content for _, content in turns)
+
+    history = _history(4)
+    history.policy = HistoryPolicy(max_turns=2, summarizer=summarizer, token_counter=len)
+
+    history.format_conversation()
+    history.add_conversation("human", "発言04")
+    messages = history.format_conversation()
+
+    assert calls == [[("human", "発言00"), ("ai", "発言01")], [("human", "発言02")]]
+    assert isinstance(messages[0], SystemMessage)
+    assert "発言00発言01発言02" in str(messages[0].content)
+    assert [m.content for m in messages[1:]] == ["発言03", "発言04"]